@@ -0,0 +1,85 @@
+'''Read and write the persistent detection cache files.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import json
+import logging
+import tempfile
+
+# A file which was changed this short a time (in ns) before it is read can
+# change again without a visible change of its mtime, so it is never cached.
+RACY_NS = 2 * 10**9
+
+
+def read_cache(path, mode='r', what='cache file'):
+    '''Return the contents of the cache file path.
+
+    Return None if it does not exist or cannot be read; what describes the
+    file in log messages.
+    '''
+    try:
+        with open(path, mode) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.debug('Ignoring unreadable %s %s: %s', what, path, e)
+        return None
+
+
+def atomic_write(path, data, mode='w', what='cache file'):
+    '''Atomically replace the cache file path with data.
+
+    Caches are only an optimization, so this silently does nothing if path
+    cannot be written (e. g. when not running as root). Return whether the
+    file was written.
+    '''
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory, mode=0o755, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path))
+    except OSError as e:
+        logging.debug('Cannot write %s %s: %s', what, path, e)
+        return False
+
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except (OSError, TypeError, ValueError) as e:
+        logging.debug('Cannot write %s %s: %s', what, path, e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def load_json_cache(path, what='cache file'):
+    '''Return the parsed contents of the JSON cache file path, or None'''
+    data = read_cache(path, what=what)
+    if data is None:
+        return None
+    try:
+        return json.loads(data)
+    except ValueError as e:
+        logging.debug('Ignoring unreadable %s %s: %s', what, path, e)
+        return None
+
+
+def save_json_cache(path, data, what='cache file'):
+    '''Atomically write data as JSON to the cache file path (see atomic_write())'''
+    try:
+        text = json.dumps(data)
+    except (TypeError, ValueError) as e:
+        logging.debug('Cannot write %s %s: %s', what, path, e)
+        return False
+    return atomic_write(path, text, 'w', what)
@@ -12,17 +12,25 @@ import os
 import logging
 import fnmatch
 import subprocess
-import functools
 import re
-import json
+import hashlib
 
 import apt_pkg
 
 from UbuntuDrivers import kerneldetection
+from UbuntuDrivers.cachefile import load_json_cache, save_json_cache
+from UbuntuDrivers.hwdb import Hwdb, udev_data_properties
+from UbuntuDrivers.moduleindex import ModuleIndex
+from UbuntuDrivers.supportedgpus import SupportedGpus
+from UbuntuDrivers.plugins import PluginLoader, PluginResultCache, run_plugins
+from UbuntuDrivers.modaliasindex import ModaliasIndex, parse_pm_aliases
 
 system_architecture = ''
-lookup_cache = {}
 custom_supported_gpus_json = '/etc/custom_supported_gpus.json'
+default_cache_dir = '/var/cache/ubuntu-drivers'
+default_run_dir = '/run/ubuntu-drivers'
+default_plugin_timeout = 10
+boot_id_path = '/proc/sys/kernel/random/boot_id'
 
 
 class NvidiaPkgNameInfo(object):
@@ -81,6 +89,178 @@ class NvidiaPkgNameInfo(object):
         return self._flavour
 
 
+class PackageDigest(object):
+    '''Candidate record fields of a package which detection needs.
+
+    All fields are read with a single records lookup. A field which the record
+    does not have is '' (as apt_pkg.PackageRecords returns it), and None if
+    the package has no candidate or the field cannot be decoded.
+    '''
+    # attribute -> record field
+    RECORD_FIELDS = (('component', 'Component'),
+                     ('support', 'Support'),
+                     ('modaliases', 'Modaliases'),
+                     ('pm_aliases', 'PmAliases'),
+                     ('runtimepm', 'runtimepm'))
+
+    __slots__ = ('name', 'candidate') + tuple(attr for attr, field in RECORD_FIELDS)
+
+    def __init__(self, depcache, records, pkg):
+        self.name = pkg.name
+        self.candidate = depcache.get_candidate_ver(pkg)
+        if self.candidate is not None:
+            records.lookup(self.candidate.file_list[0])
+        for attr, field in self.RECORD_FIELDS:
+            value = None
+            if self.candidate is not None:
+                try:
+                    value = records[field]
+                except UnicodeDecodeError:
+                    logging.debug('%s has an invalid %s field', pkg.name, field)
+            setattr(self, attr, value)
+
+
+class DetectionContext(object):
+    '''apt state shared by all lookups of one detection run.
+
+    Creating an apt_pkg.DepCache or apt_pkg.PackageRecords is expensive on big
+    caches, so this holds one of each for the given apt_pkg.Cache (a new one is
+    created if apt_cache is None).
+
+    All functions in this module which take an apt_cache argument also accept
+    a DetectionContext instead.
+    '''
+    def __init__(self, apt_cache=None):
+        if apt_cache is None:
+            apt_cache = apt_pkg.Cache(None)
+        self.apt_cache = apt_cache
+        self.depcache = apt_pkg.DepCache(apt_cache)
+        self.records = apt_pkg.PackageRecords(apt_cache)
+        self._digests = {}
+        self._kernel = None
+        self._kernel_state = None
+        # ModaliasIndex of apt_cache, once _cached_modalias_map() looked it up
+        self.modalias_index = None
+
+    @property
+    def kernel(self):
+        '''KernelInfo for the system's kernel.
+
+        Packages which are marked for installation count as installed, so this
+        is resolved again whenever the marks in the depcache change.
+        '''
+        depcache = self.depcache
+        state = (depcache.inst_count, depcache.del_count, depcache.keep_count,
+                 depcache.broken_count, depcache.usr_size, depcache.deb_size)
+        if self._kernel is None or state != self._kernel_state:
+            self._kernel = KernelInfo(self)
+            self._kernel_state = state
+        return self._kernel
+
+    def package_digest(self, pkg):
+        '''Return the PackageDigest for an apt_pkg.Package'''
+        key = pkg.get_fullname()
+        try:
+            return self._digests[key]
+        except KeyError:
+            digest = PackageDigest(self.depcache, self.records, pkg)
+            self._digests[key] = digest
+            return digest
+
+
+class KernelInfo(object):
+    '''The kernel packages of the system (see DetectionContext.kernel).
+
+    image, headers and linux are the image, headers and linux metapackages of
+    the newest installed kernel, version is the version its image metapackage
+    depends on, and flavour the part after "linux-image-" of the image package
+    (e. g. "5.4.0-25-generic"). Each is determined on first access, and the
+    installed kernels are scanned only once for all of them.
+    '''
+    def __init__(self, ctx):
+        self._ctx = ctx
+        self._kernel_detection = kerneldetection.KernelDetection(ctx.apt_cache, ctx.depcache)
+        self._values = {}
+
+    def _get(self, key, compute):
+        try:
+            return self._values[key]
+        except KeyError:
+            value = compute()
+            self._values[key] = value
+            return value
+
+    @property
+    def image(self):
+        return self._get('image', self._kernel_detection.get_linux_image_metapackage)
+
+    @property
+    def headers(self):
+        return self._get('headers', self._kernel_detection.get_linux_headers_metapackage)
+
+    @property
+    def linux(self):
+        return self._get('linux', self._kernel_detection.get_linux_metapackage)
+
+    @property
+    def version(self):
+        return self._get('version', self._kernel_detection.get_linux_version)
+
+    @property
+    def flavour(self):
+        def compute():
+            linux_image = get_linux_image_from_meta(self._ctx, self.image)
+            if linux_image:
+                return linux_image.replace('linux-image-', '')
+            return None
+        return self._get('flavour', compute)
+
+
+def _detection_context(apt_cache=None):
+    '''Return a DetectionContext for an apt_pkg.Cache or DetectionContext.
+
+    The context for the most recently used cache object is reused, so that
+    callers which pass around a plain apt_pkg.Cache share it as well.
+    '''
+    if isinstance(apt_cache, DetectionContext):
+        return apt_cache
+    memo = _detection_context.memo
+    if apt_cache is not None and memo is not None and memo.apt_cache is apt_cache:
+        return memo
+    ctx = DetectionContext(apt_cache)
+    _detection_context.memo = ctx
+    return ctx
+
+
+_detection_context.memo = None
+
+
+def get_cache_dir():
+    '''Return the directory for persistent detection caches'''
+    return os.environ.get('UBUNTU_DRIVERS_CACHE_DIR', default_cache_dir)
+
+
+def get_run_dir():
+    '''Return the directory for detection caches which are valid for one boot'''
+    return os.environ.get('UBUNTU_DRIVERS_RUN_DIR', default_run_dir)
+
+
+def get_plugin_timeout():
+    '''Return the time in seconds after which detection plugins are given up'''
+    value = os.environ.get('UBUNTU_DRIVERS_PLUGIN_TIMEOUT')
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            logging.warning('Ignoring invalid $UBUNTU_DRIVERS_PLUGIN_TIMEOUT %s', value)
+    return default_plugin_timeout
+
+
+def get_modules_dir():
+    '''Return the module directory of the running kernel'''
+    return os.environ.get('UBUNTU_DRIVERS_MODULES_DIR') or os.path.join('/lib/modules', os.uname().release)
+
+
 def get_apt_arch():
     '''Cache system architecture'''
     global system_architecture
@@ -89,45 +269,163 @@ def get_apt_arch():
     return system_architecture
 
 
-def system_modaliases(sys_path=None):
-    '''Get modaliases present in the system.
+def _in_walk_order(devices, paths):
+    '''Sort sysfs device paths in the order os.walk(devices) visits them.
 
-    This ignores devices whose drivers are statically built into the kernel, as
-    you cannot replace them with other driver packages anyway.
+    Callers of system_modaliases() pick the last device for a driver, so this
+    keeps the result independent of how the devices were found. Siblings are
+    ordered like the listing of their parent directory, so only directories
+    with more than one device below them need to be read.
+    '''
+    # node: [path of the device or None, {name: node}]
+    tree = [None, {}]
+    for path in paths:
+        node = tree
+        for name in path[len(devices) + 1:].split(os.sep):
+            node = node[1].setdefault(name, [None, {}])
+        node[0] = path
+
+    result = []
+
+    def visit(directory, node):
+        if node[0]:
+            result.append(node[0])
+        names = list(node[1])
+        if len(names) > 1:
+            try:
+                order = dict((name, i) for i, name in enumerate(os.listdir(directory)))
+            except OSError:
+                order = {}
+            names.sort(key=lambda name: order.get(name, len(order)))
+        for name in names:
+            visit(os.path.join(directory, name), node[1][name])
+
+    visit(devices, tree)
+    return result
 
-    Return a modalias → sysfs path map.
+
+def _linked_device_paths(sys_path, devices):
+    '''Get the paths of all devices which are on a bus or in a class.
+
+    This follows the /sys/bus/*/devices/* and /sys/class/*/* symlinks, which
+    is much cheaper than walking the whole /sys/devices tree. The
+    /sys/devices/system/* directories are included as well, as some of them
+    (e. g. "cpu") have a modalias of their own. The paths are
+    returned in the same form and order as os.walk(devices) would produce
+    them.
+
+    Return None if sys_path has neither a "bus" nor a "class" directory.
+    '''
+    real_devices = None
+    paths = set()
+    found = False
+    for top in ('bus', 'class'):
+        try:
+            groups = os.scandir(os.path.join(sys_path, top))
+        except OSError:
+            continue
+        found = True
+        with groups:
+            for group in groups:
+                link_dir = top == 'bus' and os.path.join(group.path, 'devices') or group.path
+                try:
+                    entries = os.scandir(link_dir)
+                except OSError:
+                    continue
+                with entries:
+                    for entry in entries:
+                        try:
+                            target = os.readlink(entry.path)
+                        except OSError:
+                            continue
+                        path = os.path.normpath(os.path.join(link_dir, target))
+                        if path.startswith(devices + os.sep):
+                            paths.add(path)
+                            continue
+                        # the link might go through a different name of sys_path
+                        if real_devices is None:
+                            real_devices = os.path.realpath(devices)
+                        path = os.path.realpath(path)
+                        if path.startswith(real_devices + os.sep):
+                            paths.add(devices + path[len(real_devices):])
+
+    if not found:
+        return None
+
+    try:
+        with os.scandir(os.path.join(devices, 'system')) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    paths.add(os.path.join(devices, 'system', entry.name))
+    except OSError:
+        pass
+
+    return _in_walk_order(devices, paths)
+
+
+def _walked_device_paths(devices):
+    '''Get the paths of all directories in devices with a modalias.
+
+    This is the fallback for sysfs trees without bus and class links.
     '''
-    aliases = {}
-    devices = sys_path and '%s/devices' % (sys_path) or '/sys/devices'
     for path, dirs, files in os.walk(devices):
-        modalias = None
+        if 'modalias' in files or ('ssb' in path and 'uevent' in files):
+            yield path
 
-        # most devices have modalias files
-        if 'modalias' in files:
-            try:
-                with open(os.path.join(path, 'modalias')) as f:
-                    modalias = f.read().strip()
-            except IOError as e:
-                logging.debug('system_modaliases(): Cannot read %s/modalias: %s',
-                              path, e)
-                continue
 
-        # devices on SSB bus only mention the modalias in the uevent file (as
-        # of 2.6.24)
-        elif 'ssb' in path and 'uevent' in files:
+def _device_modalias(path):
+    '''Get the modalias of the device at sysfs path.
+
+    Return None if the device has no modalias.
+    '''
+    # most devices have modalias files
+    try:
+        with open(os.path.join(path, 'modalias')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    except IOError as e:
+        logging.debug('system_modaliases(): Cannot read %s/modalias: %s',
+                      path, e)
+        return None
+
+    # devices on SSB bus only mention the modalias in the uevent file (as
+    # of 2.6.24)
+    if 'ssb' in path:
+        try:
             with open(os.path.join(path, 'uevent')) as fd:
                 for line in fd:
                     if line.startswith('MODALIAS='):
-                        modalias = line.split('=', 1)[1].strip()
-                        break
+                        return line.split('=', 1)[1].strip()
+        except FileNotFoundError:
+            pass
+    return None
+
+
+def system_modaliases(sys_path=None):
+    '''Get modaliases present in the system.
+
+    This ignores devices whose drivers are statically built into the kernel, as
+    you cannot replace them with other driver packages anyway.
 
+    Return a modalias → sysfs path map.
+    '''
+    aliases = {}
+    sys_path = sys_path or '/sys'
+    devices = '%s/devices' % (sys_path)
+    paths = _linked_device_paths(sys_path, devices)
+    if paths is None:
+        logging.debug('system_modaliases(): no bus or class links in %s, walking %s', sys_path, devices)
+        paths = _walked_device_paths(devices)
+
+    for path in paths:
+        modalias = _device_modalias(path)
         if not modalias:
             continue
 
         # ignore drivers which are statically built into the kernel
         driverlink = os.path.join(path, 'driver')
-        modlink = os.path.join(driverlink, 'module')
-        if os.path.islink(driverlink) and not os.path.islink(modlink):
+        if os.path.islink(driverlink) and not os.path.islink(os.path.join(driverlink, 'module')):
             # logging.debug('system_modaliases(): ignoring device %s which has no module (built into kernel)', path)
             continue
 
@@ -136,75 +434,298 @@ def system_modaliases(sys_path=None):
     return aliases
 
 
-def _check_video_abi_compat(apt_cache, package):
-    xorg_video_abi = None
+class HardwareSnapshot(object):
+    '''The devices of a system, as found in sysfs.
 
-    if package.name.startswith('nvidia-driver-'):
-        xorg_driver_name = package.name.replace('nvidia-driver-', 'xserver-xorg-video-nvidia-')
+    sysfs is only scanned on the first access of modaliases, and again after
+    refresh(). Use hardware_snapshot() to get the snapshot which is shared by
+    the system_*() functions.
+
+    If persistent is True, the devices are also kept in the run directory
+    (see get_run_dir()) together with the boot ID and the uevent sequence
+    number, so that later runs in the same boot can reuse them as long as no
+    device was added, removed or changed. reused tells whether the last scan
+    was avoided that way.
+    '''
+    # bump this whenever the on-disk format changes
+    FORMAT = 1
+
+    def __init__(self, sys_path=None, persistent=True):
+        self.sys_path = sys_path
+        self.persistent = persistent
+        self.reused = False
+        self._modaliases = None
+
+    @property
+    def modaliases(self):
+        '''The modalias → sysfs path map of system_modaliases()'''
+        if self._modaliases is None:
+            self._modaliases = self._load_or_scan()
+        return dict(self._modaliases)
+
+    def refresh(self):
+        '''Forget the devices, so that the next access scans sysfs again.
+
+        Long running programs should call this when devices might have been
+        added or removed.
+        '''
+        self._modaliases = None
+
+    def key(self):
+        '''Return the sysfs directory, boot ID and uevent sequence number.
+
+        Return None if they cannot be determined, e. g. for a fake sysfs
+        without kernel/uevent_seqnum.
+        '''
+        sys_path = os.path.realpath(self.sys_path or '/sys')
         try:
-            package = apt_cache[xorg_driver_name]
-        except KeyError:
-            logging.debug('Cannot find %s package in the cache. Cannot check ABI' % (xorg_driver_name))
-            return True
+            with open(boot_id_path) as f:
+                boot_id = f.read().strip()
+            with open(os.path.join(sys_path, 'kernel', 'uevent_seqnum')) as f:
+                seqnum = int(f.read())
+        except (OSError, ValueError):
+            return None
+        return [sys_path, boot_id, seqnum]
+
+    def _load_or_scan(self):
+        self.reused = False
+        # read the key before scanning, so that a hotplug during the scan
+        # invalidates the result
+        key = self.persistent and self.key() or None
+        if key is None:
+            return system_modaliases(self.sys_path)
+
+        path = os.path.join(get_run_dir(), 'hardware.json')
+        modaliases = self._load(path, key)
+        if modaliases is not None:
+            logging.debug('Reusing hardware snapshot %s (uevent %i)', path, key[2])
+            self.reused = True
+            return modaliases
+
+        logging.debug('Hardware snapshot %s is missing or out of date, scanning sysfs', path)
+        modaliases = system_modaliases(self.sys_path)
+        self._save(path, key, modaliases)
+        return modaliases
+
+    def _load(self, path, key):
+        data = load_json_cache(path, 'hardware snapshot')
+        if data is None:
+            return None
+        try:
+            if data['format'] != self.FORMAT or data['key'] != key:
+                return None
+            return dict((alias, syspath) for alias, syspath in data['modaliases'])
+        except (KeyError, TypeError, ValueError) as e:
+            logging.debug('Ignoring invalid hardware snapshot %s: %s', path, e)
+            return None
 
-    depcache = apt_pkg.DepCache(apt_cache)
-    candidate = depcache.get_candidate_ver(package)
+    def _save(self, path, key, modaliases):
+        # a list, to keep the order of the devices
+        save_json_cache(path, {'format': self.FORMAT, 'key': key, 'modaliases': list(modaliases.items())},
+                        'hardware snapshot')
 
-    needs_video_abi = False
-    try:
-        for dep_list in candidate.depends_list_str.get('Depends'):
-            for dep_name, dep_ver, dep_op in dep_list:
-                if dep_name.startswith('xorg-video-abi-'):
-                    needs_video_abi = True
-                    break
-    except (KeyError, TypeError):
-        logging.debug('The %s package seems to have no dependencies. Skipping ABI check' % (package))
-        needs_video_abi = False
 
-    if not needs_video_abi:
-        logging.debug('Skipping check for %s since it does not depend on video abi' % package.name)
-        return True
+def hardware_snapshot(sys_path=None):
+    '''Return the HardwareSnapshot for a sysfs directory or HardwareSnapshot.
 
-    # determine current X.org video driver ABI
+    There is one snapshot per sys_path for the whole process, so that the
+    system_*() functions only scan sysfs once. Call its refresh() method to
+    pick up hardware changes.
+    '''
+    if isinstance(sys_path, HardwareSnapshot):
+        return sys_path
     try:
-        xorg_core = apt_cache['xserver-xorg-core']
+        return hardware_snapshot.memo[sys_path]
     except KeyError:
-        logging.debug('xserver-xorg-core not available, cannot check ABI')
-        return True
+        snapshot = HardwareSnapshot(sys_path)
+        hardware_snapshot.memo[sys_path] = snapshot
+        return snapshot
+
+
+hardware_snapshot.memo = {}
+
 
-    candidate = depcache.get_candidate_ver(xorg_core)
+class VideoAbiIndex(object):
+    '''X.org video driver ABI compatibility of packages.
 
-    for provides_name, provides_ver, p_version in candidate.provides_list:
-        if provides_name.startswith('xorg-video-abi-'):
-            xorg_video_abi = provides_name
+    abi is the xorg-video-abi-* which the candidate of xserver-xorg-core
+    provides (None if that is unknown, then no package is filtered out), and
+    dependents is the set of names of the packages which depend on it.
 
-    if xorg_video_abi:
-        abi_pkg = apt_cache[xorg_video_abi]
-        for dep in abi_pkg.rev_depends_list:
-            if dep.parent_pkg.name == package.name:
+    rejected maps the names of packages which were filtered out to the reason,
+    for packages checked in this process as well as the ones remembered in the
+    modalias index.
+    '''
+    def __init__(self, abi, dependents):
+        self.abi = abi
+        self.dependents = frozenset(dependents)
+        self.rejected = {}
+
+    @classmethod
+    def from_cache(klass, apt_cache):
+        '''Determine the current video ABI from an apt_pkg.Cache or DetectionContext'''
+        ctx = _detection_context(apt_cache)
+        try:
+            xorg_core = ctx.apt_cache['xserver-xorg-core']
+        except KeyError:
+            logging.debug('xserver-xorg-core not available, cannot check ABI')
+            return klass(None, ())
+
+        abi = None
+        candidate = ctx.depcache.get_candidate_ver(xorg_core)
+        if candidate is not None:
+            for provides_name, provides_ver, p_version in candidate.provides_list:
+                if provides_name.startswith('xorg-video-abi-'):
+                    abi = provides_name
+        if abi is None:
+            return klass(None, ())
+
+        return klass(abi, [dep.parent_pkg.name for dep in ctx.apt_cache[abi].rev_depends_list])
+
+    def check(self, apt_cache, package):
+        '''Check whether package can be installed with the current video ABI.
+
+        Packages which do not depend on any video ABI are always compatible.
+        For nvidia-driver-* this checks the corresponding
+        xserver-xorg-video-nvidia-* package.
+        '''
+        ctx = _detection_context(apt_cache)
+        name = package.name
+        if name.startswith('nvidia-driver-'):
+            xorg_driver_name = name.replace('nvidia-driver-', 'xserver-xorg-video-nvidia-')
+            try:
+                package = ctx.apt_cache[xorg_driver_name]
+            except KeyError:
+                logging.debug('Cannot find %s package in the cache. Cannot check ABI' % (xorg_driver_name))
                 return True
 
+        candidate = ctx.depcache.get_candidate_ver(package)
+        needs_video_abi = False
+        try:
+            for dep_list in candidate.depends_list_str.get('Depends'):
+                for dep_name, dep_ver, dep_op in dep_list:
+                    if dep_name.startswith('xorg-video-abi-'):
+                        needs_video_abi = True
+                        break
+        except (KeyError, TypeError, AttributeError):
+            logging.debug('The %s package seems to have no dependencies. Skipping ABI check' % (package))
+            needs_video_abi = False
+
+        if not needs_video_abi:
+            logging.debug('Skipping check for %s since it does not depend on video abi' % package.name)
+            return True
+
+        if self.abi is None or package.name in self.dependents:
+            return True
+
         logging.debug('Driver package %s is incompatible with current X.org server ABI %s',
-                      package.name, xorg_video_abi)
-        logging.debug('%s is not in %s' % (package, [x.parent_pkg for x in abi_pkg.rev_depends_list]))
+                      package.name, self.abi)
+        if package.name != name:
+            self.rejected[name] = '%s does not support X.org video ABI %s' % (package.name, self.abi)
+        else:
+            self.rejected[name] = 'does not support X.org video ABI %s' % self.abi
         return False
 
-    return True
+    def explain(self, name):
+        '''Return why the named package was filtered out, or None'''
+        return self.rejected.get(name)
+
+
+def video_abi_index(apt_cache):
+    '''Return the VideoAbiIndex for an apt_pkg.Cache or DetectionContext.
+
+    This is computed only once per cache generation (see
+    apt_cache_fingerprint()).
+    '''
+    ctx = _detection_context(apt_cache)
+    fingerprint = apt_cache_fingerprint(ctx.apt_cache)
+    try:
+        return video_abi_index.memo[fingerprint]
+    except KeyError:
+        index = VideoAbiIndex.from_cache(ctx)
+        video_abi_index.memo[fingerprint] = index
+        return index
+
+
+video_abi_index.memo = {}
+
+
+def _check_video_abi_compat(apt_cache, package):
+    ctx = _detection_context(apt_cache)
+    return video_abi_index(ctx).check(ctx, package)
+
+
+def apt_cache_fingerprint(apt_cache):
+    '''Return a digest which identifies the contents of an apt_pkg.Cache.
+
+    The digest covers the native architecture, the package indexes the cache
+    was built from (including the dpkg status file), the apt preferences and
+    the available versions of all packages. Two cache objects built from the
+    same state have the same fingerprint, and running "apt update" or
+    installing/removing packages changes it.
+
+    The result is remembered for the most recently used cache object, as
+    computing it means walking all packages.
+    '''
+    memo = apt_cache_fingerprint.memo
+    if memo is not None and memo[0] is apt_cache:
+        return memo[1]
+
+    digest = hashlib.sha1()
+    digest.update(('%s %i %i %i %i\n' % (get_apt_arch(), apt_cache.package_count,
+                                         apt_cache.version_count, apt_cache.depends_count,
+                                         apt_cache.provides_count)).encode('UTF-8'))
+    for pfile in apt_cache.file_list:
+        line = '%s %s %s %s %i\n' % (pfile.filename, pfile.index_type, pfile.archive,
+                                     pfile.component, pfile.size)
+        digest.update(line.encode('UTF-8'))
+
+    # pinning changes the candidate versions, and thus the Modaliases headers
+    prefs = [apt_pkg.config.find_file('Dir::Etc::preferences')]
+    prefs_dir = apt_pkg.config.find_dir('Dir::Etc::preferencesparts')
+    try:
+        prefs += [os.path.join(prefs_dir, f) for f in sorted(os.listdir(prefs_dir))]
+    except OSError:
+        pass
+    for pref in prefs:
+        try:
+            st = os.stat(pref)
+        except OSError:
+            continue
+        digest.update(('%s %i %i\n' % (pref, st.st_size, st.st_mtime_ns)).encode('UTF-8'))
+
+    for package in apt_cache.packages:
+        digest.update(package.get_fullname().encode('UTF-8'))
+        for version in package.version_list:
+            digest.update(version.ver_str.encode('UTF-8'))
+
+    fingerprint = digest.hexdigest()
+    apt_cache_fingerprint.memo = (apt_cache, fingerprint)
+    return fingerprint
+
+
+apt_cache_fingerprint.memo = None
 
 
 def _apt_cache_modalias_map(apt_cache):
-    '''Build a modalias map from an apt_pkg.Cache object.
+    '''Build a modalias index from an apt_pkg.Cache object.
 
     This filters out uninstallable video drivers (i. e. which depend on a video
     ABI that xserver-xorg-core does not provide).
 
-    Return a map bus -> modalias -> [package, ...], where "bus" is the prefix of
-    the modalias up to the first ':' (e. g. "pci" or "usb").
+    Return a ModaliasIndex, which maps bus -> modalias -> [package, ...], where
+    "bus" is the prefix of the modalias up to the first ':' (e. g. "pci" or
+    "usb").
     '''
-    depcache = apt_pkg.DepCache(apt_cache)
-    records = apt_pkg.PackageRecords(apt_cache)
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
+    depcache = ctx.depcache
+    records = ctx.records
 
+    abi_index = video_abi_index(ctx)
     result = {}
+    package_fields = {}
+    rejected = {}
     for package in apt_cache.packages:
         # skip packages without a modalias field
         try:
@@ -213,6 +734,7 @@ def _apt_cache_modalias_map(apt_cache):
             m = records['Modaliases']
             if not m:
                 continue
+            fields = dict((field, records[field] or None) for field in ModaliasIndex.RECORD_FIELDS)
         except (KeyError, AttributeError, UnicodeDecodeError):
             continue
 
@@ -221,7 +743,8 @@ def _apt_cache_modalias_map(apt_cache):
         if (package.architecture not in ('all', get_apt_arch())):
             continue
 
-        if not _check_video_abi_compat(apt_cache, package):
+        if not abi_index.check(ctx, package):
+            rejected[package.name] = abi_index.explain(package.name)
             continue
 
         try:
@@ -237,96 +760,168 @@ def _apt_cache_modalias_map(apt_cache):
         except ValueError:
             logging.error('Package %s has invalid modalias header: %s' % (
                 package.name, m))
+        package_fields[package.name] = fields
 
-    result2 = {}
-    for bus, alias_map in result.items():
-        pat = re.compile(
-            '|'.join([fnmatch.translate(pat) for pat in alias_map.keys()]),
-            re.IGNORECASE)
-        result2[bus] = (pat, alias_map)
-
-    return result2
+    return ModaliasIndex(apt_cache_fingerprint(apt_cache), result, package_fields, rejected)
 
 
 def path_get_custom_supported_gpus():
     return custom_supported_gpus_json
 
 
+def supported_gpus():
+    '''Return the SupportedGpus index of the custom supported GPUs list.
+
+    The list (see path_get_custom_supported_gpus()) is parsed only once per
+    process and version of the file, and the index is also kept in the cache
+    directory (see get_cache_dir()) for later runs. Return None if there is
+    no valid list.
+    '''
+    path = path_get_custom_supported_gpus()
+    key = SupportedGpus.file_key(path)
+    if key is None:
+        return None
+    try:
+        memo_key, index = supported_gpus.memo[path]
+        if memo_key == key:
+            return index
+    except KeyError:
+        pass
+
+    index = SupportedGpus.load(path, key, os.path.join(get_cache_dir(), 'supported-gpus.marshal'))
+    if SupportedGpus.is_stable(key):
+        supported_gpus.memo[path] = (key, index)
+    return index
+
+
+supported_gpus.memo = {}
+
+
 def package_get_nv_allowing_driver(did):
     '''Get nvidia allowing driver for specific devices.
 
     did: 0x1234
     Return the situable nvidia driver version for it.
     '''
-    path = path_get_custom_supported_gpus()
-    version = None
-    try:
-        with open(path, "r") as stream:
-            try:
-                gpus = list(json.load(stream)['chips'])
-                for gpu in gpus:
-                    if gpu['devid'] == did:
-                        version = gpu['branch'].split('.')[0]
-                        logging.info("Found a specific nv driver version %s for %s(%s)" %
-                                     (version, gpu['name'], did))
-                        break
-            except Exception:
-                logging.debug('package_get_nv_allowing_driver(): unexpected json detected.')
-                pass
-    except Exception:
-        logging.debug('package_get_nv_allowing_driver(): unable to read %s' % path)
-        pass
+    gpus = supported_gpus()
+    entry = gpus and gpus.branch(did)
+    if not entry:
+        return None
+    name, version = entry
+    logging.info("Found a specific nv driver version %s for %s(%s)" % (version, name, did))
     return version
 
 
+def _nv_allowed_package(apt_cache, did):
+    '''Return the nvidia-driver-* package which the allow-list selects for a device.
+
+    did: 1234
+    Return None if there is no entry for the device, or if its package is not
+    in the package pool.
+    '''
+    nvamd = package_get_nv_allowing_driver("0x" + did)
+    if nvamd is None:
+        return None
+    nvamdn = "nvidia-driver-%s" % nvamd
+    if nvamdn in apt_cache:
+        return nvamdn
+    logging.debug('%s is not in the package pool.' % nvamdn)
+    return None
+
+
+def packages_for_modaliases(apt_cache, modaliases):
+    '''Search packages which match the given modaliases.
+
+    This resolves all modaliases in one pass, sharing the modalias index,
+    the NVIDIA allow-list lookups and the package objects between them.
+    The allow-list packages are kept in a separate overlay, so that the
+    shared modalias index is never modified.
+
+    Return a dictionary which maps each modalias (in the order given) to a
+    list of apt.Package objects.
+    '''
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
+    cache_map = _cached_modalias_map(ctx)
+
+    # allow-list overlay: device ID -> nvidia-driver-* package name, or
+    # None if there is none
+    nv_overlay = {}
+    pkg_objects = {}
+    result = {}
+    for modalias in modaliases:
+        if modalias in result:
+            continue
+        pkgs = cache_map.match(modalias)
+
+        vid, did = _get_vendor_model_from_alias(modalias)
+        if vid == "10DE":
+            if did not in nv_overlay:
+                nv_overlay[did] = _nv_allowed_package(apt_cache, did)
+            nvamda = "pci:v000010DEd0000%s*" % did
+            if nv_overlay[did] and fnmatch.fnmatchcase(modalias.lower(), nvamda.lower()):
+                pkgs.add(nv_overlay[did])
+
+        for p in pkgs:
+            if p not in pkg_objects:
+                pkg_objects[p] = apt_cache[p]
+        result[modalias] = [pkg_objects[p] for p in sorted(pkgs)]
+
+    return result
+
+
 def packages_for_modalias(apt_cache, modalias):
     '''Search packages which match the given modalias.
 
     Return a list of apt.Package objects.
     '''
-    pkgs = set()
+    return packages_for_modaliases(apt_cache, [modalias])[modalias]
 
-    apt_cache_hash = hash(package.get_fullname() for package in apt_cache.packages)
-    try:
-        cache_map = packages_for_modalias.cache_maps[apt_cache_hash]
-    except KeyError:
-        cache_map = _apt_cache_modalias_map(apt_cache)
-        packages_for_modalias.cache_maps[apt_cache_hash] = cache_map
-
-    pat, bus_map = cache_map.get(modalias.split(':', 1)[0], (None, {}))
-    vid, did = _get_vendor_model_from_alias(modalias)
-    nvamd = None
-    found = 0
-    if vid == "10DE":
-        nvamd = package_get_nv_allowing_driver("0x" + did)
-        nvamdn = "nvidia-driver-%s" % nvamd
-        nvamda = "pci:v000010DEd0000%s*" % did
-        for p in apt_cache.packages:
-            if p.get_fullname().split(':')[0] == nvamdn:
-                bus_map[nvamda] = set([nvamdn])
-                found = 1
-        if nvamd is not None and not found:
-            logging.debug('%s is not in the package pool.' % nvamdn)
 
-    if not found:
-        if pat is None or not pat.match(modalias):
-            return []
+packages_for_modalias.cache_maps = {}
+packages_for_modalias.cache_stats = {'hits': 0, 'misses': 0, 'loaded': 0}
 
-    for alias in bus_map:
-        if fnmatch.fnmatchcase(modalias.lower(), alias.lower()):
-            for p in bus_map[alias]:
-                pkgs.add(p)
 
-    return [apt_cache[p] for p in pkgs]
+def _modalias_index_path():
+    return os.path.join(get_cache_dir(), 'modaliases.json')
 
 
-packages_for_modalias.cache_maps = {}
+def _cached_modalias_map(apt_cache):
+    '''Return the ModaliasIndex for an apt_pkg.Cache object.
+
+    The index is built only once per cache generation (see
+    apt_cache_fingerprint()) and then shared by all callers. It is also kept
+    in the cache directory (see get_cache_dir()), so that later runs only need
+    to load it. Lookups are counted in packages_for_modalias.cache_stats.
+    '''
+    ctx = _detection_context(apt_cache)
+    fingerprint = apt_cache_fingerprint(ctx.apt_cache)
+    try:
+        cache_map = packages_for_modalias.cache_maps[fingerprint]
+        packages_for_modalias.cache_stats['hits'] += 1
+        ctx.modalias_index = cache_map
+        return cache_map
+    except KeyError:
+        packages_for_modalias.cache_stats['misses'] += 1
+
+    path = _modalias_index_path()
+    cache_map = ModaliasIndex.load(path, fingerprint)
+    if cache_map is not None:
+        logging.debug('Loaded modalias index %s', path)
+        packages_for_modalias.cache_stats['loaded'] += 1
+    else:
+        logging.debug('Building modalias index for apt cache %s', fingerprint)
+        cache_map = _apt_cache_modalias_map(ctx)
+        cache_map.save(path)
+    video_abi_index(ctx).rejected.update(cache_map.rejected)
+    packages_for_modalias.cache_maps[fingerprint] = cache_map
+    ctx.modalias_index = cache_map
+    return cache_map
 
 
 def _is_package_free(apt_cache, pkg):
-    depcache = apt_pkg.DepCache(apt_cache)
-    candidate = depcache.get_candidate_ver(pkg)
-    assert candidate is not None
+    digest = _detection_context(apt_cache).package_digest(pkg)
+    assert digest.candidate is not None
     # it would be better to check the actual license, as we do not have
     # the component for third-party packages; but this is the best we can do
     # at the moment
@@ -335,17 +930,12 @@ def _is_package_free(apt_cache, pkg):
     if pkg.name.startswith('nvidia'):
         return False
 
-    records = apt_pkg.PackageRecords(apt_cache)
-    records.lookup(candidate.file_list[0])
-
     for pfile, _ in pkg.version_list[0].file_list:
         if not pfile.component:
             # This is probably from the test suite
-            try:
-                component = records['Component']
-                return (component not in ('restricted', 'multiverse'))
-            except KeyError:
+            if digest.component is None:
                 return False
+            return (digest.component not in ('restricted', 'multiverse'))
         else:
             if pfile.component in ('restricted', 'multiverse'):
                 return False
@@ -353,7 +943,8 @@ def _is_package_free(apt_cache, pkg):
 
 
 def _is_package_from_distro(apt_cache, pkg):
-    depcache = apt_pkg.DepCache(apt_cache)
+    ctx = _detection_context(apt_cache)
+    depcache = ctx.depcache
     candidate = depcache.get_candidate_ver(pkg)
     if candidate is None:
         return False
@@ -366,14 +957,8 @@ def _is_package_from_distro(apt_cache, pkg):
 
 def _pkg_get_module(apt_cache, pkg):
     '''Determine module name from apt Package object'''
-    depcache = apt_pkg.DepCache(apt_cache)
-    candidate = depcache.get_candidate_ver(pkg)
-    records = apt_pkg.PackageRecords(apt_cache)
-    records.lookup(candidate.file_list[0])
-
-    try:
-        m = records['Modaliases']
-    except (KeyError, AttributeError):
+    m = _detection_context(apt_cache).package_digest(pkg).modaliases
+    if m is None:
         logging.debug('_pkg_get_module %s: package has no Modaliases header, cannot determine module', pkg.name)
         return None
 
@@ -389,14 +974,8 @@ def _pkg_get_module(apt_cache, pkg):
 def _pkg_get_support(apt_cache, pkg):
     '''Determine support level from apt Package object'''
 
-    depcache = apt_pkg.DepCache(apt_cache)
-    candidate = depcache.get_candidate_ver(pkg)
-    records = apt_pkg.PackageRecords(apt_cache)
-    records.lookup(candidate.file_list[0])
-
-    try:
-        support = records['Support']
-    except (KeyError, AttributeError):
+    support = _detection_context(apt_cache).package_digest(pkg).support
+    if support is None:
         logging.debug('_pkg_get_support %s: package has no Support header, cannot determine support level', pkg.name)
         return None
 
@@ -416,49 +995,33 @@ def _is_nv_allowing_runtimepm_supported(alias, ver):
     if vid != "10DE":
         return False
     did = "0x%s" % did
-    path = path_get_custom_supported_gpus()
-    try:
-        with open(path, "r") as stream:
-            try:
-                gpus = list(json.load(stream)['chips'])
-                for gpu in gpus:
-                    if gpu['devid'] == did and 'runtimepm' in gpu['features']:
-                        if gpu['branch'].split('.')[0] != ver:
-                            logging.debug('Candidate version does not match %s != %s' %
-                                          (gpu['branch'].split('.')[0], ver))
-                            return False
-                        logging.info("Found runtimepm supports on %s." % did)
-                        return True
-            except Exception:
-                logging.debug('_is_nv_allowing_runtimepm_supported(): unexpected json detected')
-                pass
-    except Exception:
-        logging.debug('_is_nv_allowing_runtimepm_supported(): unable to read %s' % path)
-        pass
-    return False
+    gpus = supported_gpus()
+    branch = gpus and gpus.runtimepm_branch(did)
+    if not branch:
+        return False
+    if branch != ver:
+        logging.debug('Candidate version does not match %s != %s' % (branch, ver))
+        return False
+    logging.info("Found runtimepm supports on %s." % did)
+    return True
 
 
 def _is_runtimepm_supported(apt_cache, pkg, alias):
     '''Check if the package supports runtimepm for the given modalias'''
-    try:
-        depcache = apt_pkg.DepCache(apt_cache)
-        candidate = depcache.get_candidate_ver(pkg)
-        records = apt_pkg.PackageRecords(apt_cache)
-        records.lookup(candidate.file_list[0])
-        section = apt_pkg.TagSection(records.record)
-        ver = candidate.ver_str.split('.')[0]
-        m = section['PmAliases']
-    except (KeyError, AttributeError, UnicodeDecodeError):
+    ctx = _detection_context(apt_cache)
+    digest = ctx.package_digest(pkg)
+    m = digest.pm_aliases
+    if not m or m.find('nvidia(') != 0:
         return False
-    else:
-        if m.find('nvidia(') != 0:
-            return False
 
-        n = m[m.find('(')+1: m.find(')')]
-        modaliases = n.split(', ')
-        if _is_nv_allowing_runtimepm_supported(alias, ver):
-            return True
-        return any(fnmatch.fnmatch(alias.lower(), regex.lower()) for regex in modaliases)
+    ver = digest.candidate.ver_str.split('.')[0]
+    if _is_nv_allowing_runtimepm_supported(alias, ver):
+        return True
+    cache_map = ctx.modalias_index or _cached_modalias_map(ctx)
+    if pkg.name in cache_map.packages:
+        return pkg.name in cache_map.runtimepm(alias)
+    # not in the index (e. g. selected by the allow-list only)
+    return any(fnmatch.fnmatchcase(alias.lower(), glob.lower()) for glob in parse_pm_aliases(m))
 
 
 def is_wayland_session():
@@ -466,6 +1029,20 @@ def is_wayland_session():
     return os.environ.get('WAYLAND_DISPLAY') is not None
 
 
+def _kernel_module_index():
+    '''Return the ModuleIndex of the running kernel (see get_modules_dir())'''
+    modules_dir = get_modules_dir()
+    try:
+        return _kernel_module_index.memo[modules_dir]
+    except KeyError:
+        index = ModuleIndex(modules_dir)
+        _kernel_module_index.memo[modules_dir] = index
+        return index
+
+
+_kernel_module_index.memo = {}
+
+
 def _is_manual_install(apt_cache, pkg):
     '''Determine if the kernel module from an apt.Package is manually installed.'''
 
@@ -483,42 +1060,162 @@ def _is_manual_install(apt_cache, pkg):
     if not module:
         return False
 
-    try:
-        modinfo = subprocess.Popen(['modinfo', module], stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        modinfo.communicate()
-    except (OSError, FileNotFoundError, subprocess.CalledProcessError) as e:
-        logging.debug('_is_manual_install failed: %s', str(e))
-        return False
-    else:
-        if modinfo.returncode == 0:
-            logging.debug('_is_manual_install %s: builds module %s which is available, manual install',
-                          pkg.name, module)
-            return True
+    if module in _kernel_module_index():
+        logging.debug('_is_manual_install %s: builds module %s which is available, manual install',
+                      pkg.name, module)
+        return True
 
     logging.debug('_is_manual_install %s: builds module %s which is not available, no manual install',
                   pkg.name, module)
     return False
 
 
-def _get_db_name(syspath, alias):
-    '''Return (vendor, model) names for given device.
+def _get_hwdb():
+    '''Return the system's compiled udev hardware database, or None'''
+    try:
+        return _get_hwdb.memo['hwdb']
+    except KeyError:
+        hwdb = Hwdb.open()
+        _get_hwdb.memo['hwdb'] = hwdb
+        logging.debug('_get_hwdb(): using %s', hwdb and hwdb.path)
+        return hwdb
 
-    Values are None if unknown.
-    '''
+
+_get_hwdb.memo = {}
+
+
+# udev device records have many properties; only these come from the
+# hardware database (like the output of "udevadm hwdb")
+_udev_hwdb_name_keys = ('ID_VENDOR_FROM_DATABASE', 'ID_MODEL_FROM_DATABASE')
+
+
+def _udev_hwdb_names(props):
+    '''Return the hardware database names of a udev device record'''
+    return dict((k, props[k]) for k in _udev_hwdb_name_keys if k in props)
+
+
+def _udevadm_db_properties():
+    '''Return a devpath → properties map of all devices in the udev database'''
     try:
-        out = subprocess.check_output(['udevadm', 'hwdb', '--test=' + alias],
+        out = subprocess.check_output(['udevadm', 'info', '--export-db'],
                                       universal_newlines=True)
     except (OSError, subprocess.CalledProcessError) as e:
-        logging.debug('_get_db_name(%s, %s): udevadm hwdb failed: %s', syspath, alias, str(e))
-        return (None, None)
+        logging.debug('_udevadm_db_properties(): udevadm info failed: %s', str(e))
+        return {}
+
+    result = {}
+    props = None
+    for line in out.splitlines():
+        if line.startswith('P: '):
+            props = result.setdefault(line[3:], {})
+        elif line.startswith('E: ') and props is not None and '=' in line:
+            (k, v) = line[3:].split('=', 1)
+            props[k] = v
+    return result
+
+
+def _get_db_names(devices):
+    '''Return (vendor, model) names for a list of (syspath, alias) devices.
+
+    The names come from the compiled udev hardware database. Without one,
+    they come from udev's record of the device, and a single "udevadm info"
+    call covers the devices which are not in /run/udev/data.
+
+    The names only depend on the modalias, so every modalias is only looked
+    up once per process. Names from hwdb.bin are also kept in the cache
+    directory (see get_cache_dir()) until hwdb.bin changes.
+
+    Return a map alias → (vendor, model); values are None if unknown.
+    '''
+    memo = _get_db_names.memo
+    missing = dict((alias, syspath) for (syspath, alias) in devices if alias not in memo)
+    if missing:
+        hwdb = _get_hwdb()
+        if hwdb is not None:
+            _load_db_names(hwdb)
+            missing = dict((alias, syspath) for (alias, syspath) in missing.items() if alias not in memo)
+
+    if missing:
+        unresolved = []
+        for (alias, syspath) in missing.items():
+            if hwdb is not None:
+                props = hwdb.lookup(alias)
+            else:
+                props = udev_data_properties(syspath)
+            if props is None:
+                unresolved.append((syspath, alias))
+            else:
+                memo[alias] = _db_names(syspath, alias, hwdb is None and _udev_hwdb_names(props) or props)
+
+        if unresolved:
+            db = _udevadm_db_properties()
+            for (syspath, alias) in unresolved:
+                devpath = syspath.startswith('/sys/') and syspath[4:] or None
+                memo[alias] = _db_names(syspath, alias, _udev_hwdb_names(db.get(devpath, {})))
+
+        if hwdb is not None:
+            _save_db_names(hwdb)
 
-    logging.debug('_get_db_name: output\n%s\n', out)
+    return dict((alias, memo[alias]) for (syspath, alias) in devices)
 
+
+_get_db_names.memo = {}
+_get_db_names.loaded = None
+
+# bump this whenever the on-disk format changes
+DB_NAMES_FORMAT = 1
+
+
+def _db_names_path():
+    return os.path.join(get_cache_dir(), 'device-names.json')
+
+
+def _db_names_key(hwdb):
+    '''Return what identifies the hwdb.bin version of cached names'''
+    try:
+        st = os.stat(hwdb.path)
+    except OSError:
+        return None
+    return [hwdb.path, st.st_mtime_ns, st.st_size]
+
+
+def _load_db_names(hwdb):
+    '''Add the names of the device names cache file to the memo.
+
+    This only reads the file once per process, and only if it belongs to the
+    current hwdb.bin.
+    '''
+    key = _db_names_key(hwdb)
+    if _get_db_names.loaded == key:
+        return
+    _get_db_names.loaded = key
+
+    path = _db_names_path()
+    data = load_json_cache(path, 'device names cache')
+    try:
+        if data is None or data['format'] != DB_NAMES_FORMAT or data['key'] != key:
+            return
+        for alias, (vendor, model) in data['names'].items():
+            _get_db_names.memo.setdefault(alias, (vendor, model))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        logging.debug('Ignoring invalid device names cache %s: %s', path, e)
+        return
+    logging.debug('Loaded device names cache %s', path)
+
+
+def _save_db_names(hwdb):
+    key = _db_names_key(hwdb)
+    if key is not None:
+        save_json_cache(_db_names_path(),
+                        {'format': DB_NAMES_FORMAT, 'key': key, 'names': _get_db_names.memo},
+                        'device names cache')
+
+
+def _db_names(syspath, alias, props):
+    '''Return (vendor, model) from hardware database properties'''
     vendor = None
     model = None
-    for line in out.splitlines():
-        (k, v) = line.split('=', 1)
+    for (k, v) in props.items():
         if '_VENDOR' in k:
             vendor = v
         if '_MODEL' in k:
@@ -529,6 +1226,14 @@ def _get_db_name(syspath, alias):
     return (vendor, model)
 
 
+def _get_db_name(syspath, alias):
+    '''Return (vendor, model) names for given device.
+
+    Values are None if unknown. See _get_db_names().
+    '''
+    return _get_db_names([(syspath, alias)])[alias]
+
+
 def set_nvidia_kms(value):
     '''Set KMS on or off for NVIDIA'''
     nvidia_kms_file = '/lib/modprobe.d/nvidia-kms.conf'
@@ -540,20 +1245,30 @@ options nvidia-drm modeset=%d\n''' % (value)
     kms_fd.close()
 
 
-def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, include_oem=True):
+# optional information keys of system_driver_packages(); see its fields argument
+driver_package_fields = ('free', 'from_distro', 'support', 'runtimepm', 'vendor', 'model')
+
+
+def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, include_oem=True, fields=None):
     '''Get driver packages that are available for the system.
 
-    This calls system_modaliases() to determine the system's hardware and then
+    This takes the system's hardware from hardware_snapshot(sys_path) and then
     queries apt about which packages provide drivers for those. It also adds
     available packages from detect_plugin_packages().
 
     If you already have an apt_pkg.Cache() object, you should pass it as an
     argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    one by itself. When calling several of these functions, pass them the same
+    DetectionContext instead, so that they share the apt lookups.
 
     If freeonly is set to True, only free packages (from main and universe) are
     considered
 
+    fields is the list of optional information keys (see
+    driver_package_fields) to determine; it defaults to all of them. Callers
+    which only need some of them (or just the package names) should pass
+    these, as some keys are expensive to compute.
+
     Return a dictionary which maps package names to information about them:
 
       driver_package → {'modalias': 'pci:...', ...}
@@ -572,12 +1287,20 @@ def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, includ
                      third party source.
       'vendor':      Human readable vendor name, if available.
       'model':       Human readable product name, if available.
+      'support':     Support level of the driver (e. g. 'PB' or 'LTSB'), or None.
+      'runtimepm':   Boolean flag whether the driver supports runtime power
+                     management of the device.
       'recommended': Some drivers (nvidia, fglrx) come in multiple variants and
                      versions; these have this flag, where exactly one has
                      recommended == True, and all others False.
     '''
-    global lookup_cache
-    modaliases = system_modaliases(sys_path)
+    if fields is None:
+        fields = driver_package_fields
+    else:
+        unknown = set(fields) - set(driver_package_fields)
+        if unknown:
+            raise ValueError('unknown driver package fields: %s' % ', '.join(sorted(unknown)))
+    modaliases = hardware_snapshot(sys_path).modaliases
 
     if not apt_cache:
         try:
@@ -585,53 +1308,67 @@ def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, includ
         except Exception as ex:
             logging.error(ex)
             return {}
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
 
     packages = {}
+    # support levels of the NVIDIA packages, for ranking them
+    nvidia_support = {}
+    modalias_packages = packages_for_modaliases(ctx, modaliases)
+    if 'vendor' in fields or 'model' in fields:
+        db_names = _get_db_names([(syspath, alias) for alias, syspath in modaliases.items()
+                                  if modalias_packages[alias]])
     for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
-            if freeonly and not _is_package_free(apt_cache, p):
-                continue
+        for p in modalias_packages[alias]:
             if not include_oem and fnmatch.fnmatch(p.name, 'oem-*-meta'):
                 continue
-            packages[p.name] = {
-                    'modalias': alias,
-                    'syspath': syspath,
-                    'free': _is_package_free(apt_cache, p),
-                    'from_distro': _is_package_from_distro(apt_cache, p),
-                    'support': _pkg_get_support(apt_cache, p),
-                    'runtimepm': _is_runtimepm_supported(apt_cache, p, alias)
-                }
-            (vendor, model) = _get_db_name(syspath, alias)
-            if vendor is not None:
-                packages[p.name]['vendor'] = vendor
-            if model is not None:
-                packages[p.name]['model'] = model
+            info = {'modalias': alias, 'syspath': syspath}
+            if freeonly or 'free' in fields:
+                free = _is_package_free(ctx, p)
+                if freeonly and not free:
+                    continue
+                if 'free' in fields:
+                    info['free'] = free
+            if 'from_distro' in fields:
+                info['from_distro'] = _is_package_from_distro(ctx, p)
+            if 'support' in fields or p.name.startswith('nvidia-'):
+                support = _pkg_get_support(ctx, p)
+                if 'support' in fields:
+                    info['support'] = support
+                if p.name.startswith('nvidia-'):
+                    nvidia_support[p.name] = {'support': support}
+            if 'runtimepm' in fields:
+                info['runtimepm'] = _is_runtimepm_supported(ctx, p, alias)
+            packages[p.name] = info
+            if 'vendor' in fields or 'model' in fields:
+                (vendor, model) = db_names[alias]
+                if vendor is not None and 'vendor' in fields:
+                    info['vendor'] = vendor
+                if model is not None and 'model' in fields:
+                    info['model'] = model
 
     # Add "recommended" flags for NVidia alternatives
     nvidia_packages = [p for p in packages if p.startswith('nvidia-')]
     if nvidia_packages:
-        # Create a cache for looking up drivers to pick the best
-        # candidate
-        for key, value in packages.items():
-            if key.startswith('nvidia-'):
-                lookup_cache[key] = value
-        nvidia_packages.sort(key=functools.cmp_to_key(_cmp_gfx_alternatives))
-        recommended = nvidia_packages[-1]
+        recommended = desktop_driver_ranking.best(nvidia_support, nvidia_packages)
         for p in nvidia_packages:
             packages[p]['recommended'] = (p == recommended)
 
     # add available packages which need custom detection code
-    for plugin, pkgs in detect_plugin_packages(apt_cache).items():
+    for plugin, pkgs in detect_plugin_packages(ctx, sys_path=sys_path).items():
         for p in pkgs:
             try:
                 apt_p = apt_cache[p]
-                packages[p] = {
-                        'free': _is_package_free(apt_cache, apt_p),
-                        'from_distro': _is_package_from_distro(apt_cache, apt_p),
-                        'plugin': plugin,
-                    }
             except KeyError:
                 logging.debug('Package %s plugin not available. Skipping.' % p)
+                continue
+            info = {}
+            if 'free' in fields:
+                info['free'] = _is_package_free(ctx, apt_p)
+            if 'from_distro' in fields:
+                info['from_distro'] = _is_package_from_distro(ctx, apt_p)
+            info['plugin'] = plugin
+            packages[p] = info
 
     return packages
 
@@ -654,7 +1391,9 @@ def get_userspace_lrm_meta(apt_cache, pkg_name):
 
     This is useful to see whether any such package is available.
     '''
-    depcache = apt_pkg.DepCache(apt_cache)
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
+    depcache = ctx.depcache
 
     nvidia_info = NvidiaPkgNameInfo(pkg_name)
     if not nvidia_info.is_valid:
@@ -690,7 +1429,9 @@ def _get_headless_no_dkms_metapackage(pkg, apt_cache):
     This is useful when dealing with packages such as nvidia-driver-$flavour
     whose headless-no-dkms metapackage would be nvidia-headless-no-dkms-$flavour
     '''
-    depcache = apt_pkg.DepCache(apt_cache)
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
+    depcache = ctx.depcache
     name = pkg.name
 
     nvidia_info = NvidiaPkgNameInfo(name)
@@ -722,13 +1463,14 @@ def _get_headless_no_dkms_metapackage(pkg, apt_cache):
 def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_oem=True):
     '''Get device specific metapackages for this system
 
-    This calls system_modaliases() to determine the system's hardware and then
+    This takes the system's hardware from hardware_snapshot(sys_path) and then
     queries apt about which packages provide hardware enablement support for
     those.
 
     If you already have an apt_pkg.Cache() object, you should pass it as an
     argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    one by itself. When calling several of these functions, pass them the same
+    DetectionContext instead, so that they share the apt lookups.
 
     Return a dictionary which maps package names to information about them:
 
@@ -754,7 +1496,7 @@ def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_o
     if not include_oem:
         return {}
 
-    modaliases = system_modaliases(sys_path)
+    modaliases = hardware_snapshot(sys_path).modaliases
 
     if not apt_cache:
         try:
@@ -762,19 +1504,22 @@ def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_o
         except Exception as ex:
             logging.error(ex)
             return {}
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
 
     packages = {}
+    modalias_packages = packages_for_modaliases(ctx, modaliases)
     for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
+        for p in modalias_packages[alias]:
             if not fnmatch.fnmatch(p.name, 'oem-*-meta'):
                 continue
             packages[p.name] = {
                     'modalias': alias,
                     'syspath': syspath,
-                    'free': _is_package_free(apt_cache, p),
-                    'from_distro': _is_package_from_distro(apt_cache, p),
+                    'free': _is_package_free(ctx, p),
+                    'from_distro': _is_package_from_distro(ctx, p),
                     'recommended': True,
-                    'support': _pkg_get_support(apt_cache, p),
+                    'support': _pkg_get_support(ctx, p),
                 }
 
     return packages
@@ -783,13 +1528,14 @@ def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_o
 def system_gpgpu_driver_packages(apt_cache=None, sys_path=None):
     '''Get driver packages, for gpgpu purposes, that are available for the system.
 
-    This calls system_modaliases() to determine the system's hardware and then
+    This takes the system's hardware from hardware_snapshot(sys_path) and then
     queries apt about which packages provide drivers for those. Finally, it looks
     for the correct metapackage, by calling _get_headless_no_dkms_metapackage().
 
     If you already have an apt_pkg.Cache() object, you should pass it as an
     argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    one by itself. When calling several of these functions, pass them the same
+    DetectionContext instead, so that they share the apt lookups.
 
     Return a dictionary which maps package names to information about them:
 
@@ -813,9 +1559,8 @@ def system_gpgpu_driver_packages(apt_cache=None, sys_path=None):
                      versions; these have this flag, where exactly one has
                      recommended == True, and all others False.
     '''
-    global lookup_cache
     vendors_whitelist = ['10de']
-    modaliases = system_modaliases(sys_path)
+    modaliases = hardware_snapshot(sys_path).modaliases
 
     if not apt_cache:
         try:
@@ -823,56 +1568,86 @@ def system_gpgpu_driver_packages(apt_cache=None, sys_path=None):
         except Exception as ex:
             logging.error(ex)
             return {}
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
 
     packages = {}
+    modalias_packages = packages_for_modaliases(ctx, modaliases)
+    devices = []
     for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
-            (vendor, model) = _get_db_name(syspath, alias)
-            vendor_id, model_id = _get_vendor_model_from_alias(alias)
-            if (vendor_id is not None) and (vendor_id.lower() in vendors_whitelist):
-                packages[p.name] = {
-                        'modalias': alias,
-                        'syspath': syspath,
-                        'free': _is_package_free(apt_cache, p),
-                        'from_distro': _is_package_from_distro(apt_cache, p),
-                        'support': _pkg_get_support(apt_cache, p),
-                    }
-                if vendor is not None:
-                    packages[p.name]['vendor'] = vendor
-                if model is not None:
-                    packages[p.name]['model'] = model
-                metapackage = _get_headless_no_dkms_metapackage(p, apt_cache)
-
-                if metapackage is not None:
-                    packages[p.name]['metapackage'] = metapackage
+        vendor_id, model_id = _get_vendor_model_from_alias(alias)
+        if modalias_packages[alias] and (vendor_id is not None) and (vendor_id.lower() in vendors_whitelist):
+            devices.append((syspath, alias))
+    db_names = _get_db_names(devices)
+    for (syspath, alias) in devices:
+        (vendor, model) = db_names[alias]
+        for p in modalias_packages[alias]:
+            packages[p.name] = {
+                    'modalias': alias,
+                    'syspath': syspath,
+                    'free': _is_package_free(ctx, p),
+                    'from_distro': _is_package_from_distro(ctx, p),
+                    'support': _pkg_get_support(ctx, p),
+                }
+            if vendor is not None:
+                packages[p.name]['vendor'] = vendor
+            if model is not None:
+                packages[p.name]['model'] = model
+            metapackage = _get_headless_no_dkms_metapackage(p, ctx)
+
+            if metapackage is not None:
+                packages[p.name]['metapackage'] = metapackage
 
     # Add "recommended" flags for NVidia alternatives
     nvidia_packages = [p for p in packages if p.startswith('nvidia-')]
     if nvidia_packages:
-        # Create a cache for looking up drivers to pick the best
-        # candidate
-        for key, value in packages.items():
-            if key.startswith('nvidia-'):
-                lookup_cache[key] = value
-        nvidia_packages.sort(key=functools.cmp_to_key(_cmp_gfx_alternatives_gpgpu))
-        recommended = nvidia_packages[-1]
+        recommended = gpgpu_driver_ranking.best(packages, nvidia_packages)
         for p in nvidia_packages:
             packages[p]['recommended'] = (p == recommended)
 
     return packages
 
 
+def system_runtimepm_table(apt_cache=None, sys_path=None):
+    '''Get runtime power management support of the system's NVIDIA devices.
+
+    This takes the system's hardware from hardware_snapshot(sys_path) and then
+    checks every NVIDIA driver package which matches an NVIDIA device.
+
+    Return a dictionary which maps the modalias of each such device to a
+    dictionary package name -> True if the package supports runtime power
+    management for the device, False otherwise.
+    '''
+    if not apt_cache:
+        try:
+            apt_cache = apt_pkg.Cache(None)
+        except Exception as ex:
+            logging.error(ex)
+            return {}
+    ctx = _detection_context(apt_cache)
+
+    modaliases = [alias for alias in hardware_snapshot(sys_path).modaliases
+                  if _get_vendor_model_from_alias(alias)[0] == '10DE']
+    table = {}
+    for alias, pkgs in packages_for_modaliases(ctx, modaliases).items():
+        pkgs = [p for p in pkgs if p.name.startswith('nvidia')]
+        if pkgs:
+            table[alias] = dict((p.name, _is_runtimepm_supported(ctx, p, alias)) for p in pkgs)
+    return table
+
+
 def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
     '''Get by-device driver packages that are available for the system.
 
-    This calls system_modaliases() to determine the system's hardware and then
+    This takes the system's hardware from hardware_snapshot(sys_path) and then
     queries apt about which packages provide drivers for each of those. It also
     adds available packages from detect_plugin_packages(), using the name of
     the detction plugin as device name.
 
     If you already have an apt_pkg.Cache() object, you should pass it as an
     argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    one by itself. When calling several of these functions, pass them the same
+    DetectionContext instead, so that they share the apt lookups.
 
     If freeonly is set to True, only free packages (from main and universe) are
     considered
@@ -922,10 +1697,12 @@ def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
         except Exception as ex:
             logging.error(ex)
             return {}
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
 
     # copy the system_driver_packages() structure into the by-device structure
-    for pkg, pkginfo in system_driver_packages(apt_cache, sys_path,
-                                               freeonly=freeonly).items():
+    for pkg, pkginfo in system_driver_packages(ctx, sys_path, freeonly=freeonly,
+                                               fields=('free', 'from_distro', 'vendor', 'model')).items():
         if 'syspath' in pkginfo:
             device_name = pkginfo['syspath']
         else:
@@ -943,7 +1720,7 @@ def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
     # packages are "manually installed"
     for driver, info in result.items():
         for pkg in info['drivers']:
-            if not _is_manual_install(apt_cache, apt_cache[pkg]):
+            if not _is_manual_install(ctx, apt_cache[pkg]):
                 break
         else:
             info['manual_install'] = True
@@ -956,17 +1733,16 @@ def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
 
 def get_desktop_package_list(apt_cache, sys_path=None, free_only=False, include_oem=True, driver_string=''):
     '''Return the list of packages that should be installed'''
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
     packages = system_driver_packages(
-        apt_cache, sys_path, freeonly=free_only,
-        include_oem=include_oem)
+        ctx, sys_path, freeonly=free_only,
+        include_oem=include_oem, fields=())
     packages = auto_install_filter(packages, driver_string)
     if not packages:
         logging.debug('No drivers found for installation.')
         return packages
 
-    depcache = apt_pkg.DepCache(apt_cache)
-    records = apt_pkg.PackageRecords(apt_cache)
-
     # ignore packages which are already installed
     to_install = []
     for p in packages:
@@ -974,11 +1750,8 @@ def get_desktop_package_list(apt_cache, sys_path=None, free_only=False, include_
         if not package_obj.current_ver:
             to_install.append(p)
 
-            candidate = depcache.get_candidate_ver(package_obj)
-            records.lookup(candidate.file_list[0])
-
             # See if runtimepm is supported
-            if records['runtimepm']:
+            if ctx.package_digest(package_obj).runtimepm:
                 # Create a file for nvidia-prime
                 try:
                     pm_fd = open('/run/nvidia_runtimepm_supported', 'w')
@@ -990,11 +1763,11 @@ def get_desktop_package_list(apt_cache, sys_path=None, free_only=False, include_
                     pass
             # Add the matching linux modules package when available
             try:
-                modules_package = get_linux_modules_metapackage(apt_cache, p)
+                modules_package = get_linux_modules_metapackage(ctx, p)
                 if modules_package and not apt_cache[modules_package].current_ver:
                     to_install.append(modules_package)
 
-                    lrm_meta = get_userspace_lrm_meta(apt_cache, p)
+                    lrm_meta = get_userspace_lrm_meta(ctx, p)
                     if lrm_meta and not apt_cache[lrm_meta].current_ver:
                         # Add the lrm meta and drop the non lrm one
                         to_install.append(lrm_meta)
@@ -1198,7 +1971,7 @@ def auto_install_filter(packages, drivers_str=''):
     return result
 
 
-def detect_plugin_packages(apt_cache=None):
+def detect_plugin_packages(apt_cache=None, timeout=None, sys_path=None):
     '''Get driver packages from custom detection plugins.
 
     Some driver packages cannot be identified by modaliases, but need some
@@ -1211,9 +1984,23 @@ def detect_plugin_packages(apt_cache=None):
     If you already have an existing apt_pkg.Cache() object, you can pass it as an
     argument for efficiency.
 
-    Return pluginname -> [package, ...] map.
+    Plugins are loaded with detect_plugin_packages.loader, which keeps them
+    for later calls, and their compiled code in the cache directory (see
+    get_cache_dir()) for later runs. They run concurrently, and a plugin which
+    does not finish within timeout seconds (default: get_plugin_timeout()) is
+    ignored. Plugins whose declared requirements the system (with the sysfs in
+    sys_path) does not meet are skipped (see _plugin_skip_reason()). Results
+    of plugins which declare their inputs are kept in the cache directory,
+    and reused while these files, the plugin and the apt cache are unchanged
+    (see UbuntuDrivers.plugins.PluginResultCache), unless
+    detect_plugin_packages.use_result_cache is False. The outcome of each
+    plugin (see UbuntuDrivers.plugins.PluginRun) is kept in
+    detect_plugin_packages.runs until the next call.
+
+    Return pluginname -> [package, ...] map, ordered by plugin name.
     '''
     packages = {}
+    detect_plugin_packages.runs = []
     plugindir = os.environ.get('UBUNTU_DRIVERS_DETECT_DIR',
                                '/usr/share/ubuntu-drivers-common/detect/')
     if not os.path.isdir(plugindir):
@@ -1226,155 +2013,154 @@ def detect_plugin_packages(apt_cache=None):
         except Exception as ex:
             logging.error(ex)
             return {}
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
 
-    for fname in os.listdir(plugindir):
-        if not fname.endswith('.py'):
-            continue
-        plugin = os.path.join(plugindir, fname)
+    plugins = [os.path.join(plugindir, fname) for fname in sorted(os.listdir(plugindir)) if fname.endswith('.py')]
+    for plugin in plugins:
         logging.debug('Loading custom detection plugin %s', plugin)
+    if timeout is None:
+        timeout = get_plugin_timeout()
+    results = None
+    if detect_plugin_packages.use_result_cache:
+        results = PluginResultCache(os.path.join(get_cache_dir(), 'plugin-results.json'),
+                                    apt_cache_fingerprint(apt_cache))
+    runs = run_plugins(detect_plugin_packages.loader, plugins, apt_cache, timeout,
+                       os.path.join(get_cache_dir(), 'plugins'),
+                       lambda plugin: _plugin_skip_reason(ctx, plugin, sys_path),
+                       results)
+    detect_plugin_packages.runs = runs
+
+    for run in runs:
+        if run.status != 'ok':
+            continue
+        plugin = run.path
+        result = run.result
+        logging.debug('plugin %s return value: %s', plugin, result)
+
+        if result is None:
+            continue
+        if type(result) not in (list, set):
+            logging.error('plugin %s returned a bad type %s (must be list or set)', plugin, type(result))
+            run.status = 'invalid'
+            continue
 
-        symb = {}
-        with open(plugin) as f:
+        for pkg in result:
             try:
-                exec(compile(f.read(), plugin, 'exec'), symb)
-                result = symb['detect'](apt_cache)
-                logging.debug('plugin %s return value: %s', plugin, result)
-            except Exception:
-                logging.exception('plugin %s failed:', plugin)
-                continue
+                package = apt_cache[pkg]
+                if _check_video_abi_compat(ctx, package):
+                    packages.setdefault(run.name, []).append(pkg)
+            except KeyError:
+                logging.debug('Ignoring unavailable package %s from plugin %s', pkg, plugin)
 
-            if result is None:
-                continue
-            if type(result) not in (list, set):
-                logging.error('plugin %s returned a bad type %s (must be list or set)', plugin, type(result))
-                continue
+    return packages
 
-            for pkg in result:
-                try:
-                    package = apt_cache[pkg]
-                    if _check_video_abi_compat(apt_cache, package):
-                        packages.setdefault(fname, []).append(pkg)
-                except KeyError:
-                    logging.debug('Ignoring unavailable package %s from plugin %s', pkg, plugin)
 
-    return packages
+detect_plugin_packages.loader = PluginLoader()
+detect_plugin_packages.runs = []
+detect_plugin_packages.use_result_cache = True
 
 
-def _pkg_support_from_cache(x):
-    '''Look up driver package and return their support level'''
-    if lookup_cache.get(x):
-        return lookup_cache.get(x).get('support')
-    return None
+def _plugin_skip_reason(apt_cache, plugin, sys_path=None):
+    '''Return why a detection plugin does not apply to the system, or None.
 
+    This checks the plugin's requirements (see DetectionPlugin.requires). Every
+    requirement must be met, by at least one of its values:
 
-def _cmp_gfx_alternatives(x, y):
-    '''Compare two graphics driver names in terms of preference. (desktop)
+      'architectures': the dpkg architecture of the system,
+      'sysfs':         a path relative to sys_path (default: /sys) which exists,
+      'modaliases':    a prefix of the modalias of a device in the system,
+      'packages':      the name of a package in the apt cache.
 
-    -open always sorts after non-open.
-    -server always sorts after non-server.
-    LTSB (Long Term Support Branch) always sorts before NFB (New Feature Branch).
-    Legacy always sorts before Beta.
+    sys_path can also be a HardwareSnapshot (see hardware_snapshot()).
     '''
+    snapshot = hardware_snapshot(sys_path)
+    sys_dir = snapshot.sys_path or '/sys'
+    for requirement, values in plugin.requires.items():
+        if requirement == 'architectures':
+            if get_apt_arch() not in values:
+                return 'architecture %s is not one of %s' % (get_apt_arch(), ', '.join(values))
+        elif requirement == 'sysfs':
+            if not any(os.path.exists(os.path.join(sys_dir, path)) for path in values):
+                return 'none of %s exists in %s' % (', '.join(values), sys_dir)
+        elif requirement == 'modaliases':
+            prefixes = tuple(prefix.lower() for prefix in values)
+            if not any(alias.lower().startswith(prefixes) for alias in snapshot.modaliases):
+                return 'no device has a modalias starting with %s' % ', '.join(values)
+        elif requirement == 'packages':
+            apt_cache = _detection_context(apt_cache).apt_cache
+            if not any(name in apt_cache for name in values):
+                return 'none of the packages %s is available' % ', '.join(values)
+        else:
+            logging.warning('plugin %s has an unknown requirement %s, ignoring it', plugin.path, requirement)
+    return None
+
 
-    if x.endswith('-open') and not y.endswith('-open'):
-        return -1
-    if not x.endswith('-open') and y.endswith('-open'):
-        return 1
-
-    if x.endswith('-server') and not y.endswith('-server'):
-        return -1
-    if not x.endswith('-server') and y.endswith('-server'):
-        return 1
-
-    preferred_support = ['PB', 'LTSB']
-
-    x_score = 0
-    y_score = 0
-
-    x_support = _pkg_support_from_cache(x)
-    y_support = _pkg_support_from_cache(y)
-
-    if x_support in preferred_support:
-        x_score += 100
-
-    if y_support in preferred_support:
-        y_score += 100
-
-    if x > y:
-        x_score += 1
-    elif x < y:
-        y_score += 1
-
-    if ((x_score >= 100) or (y_score >= 100)):
-        if x_score > y_score:
-            return 1
-        elif x_score < y_score:
-            return -1
-
-    if _pkg_support_from_cache(x) == 'PB' and _pkg_support_from_cache(y) != 'PB':
-        return 1
-    if _pkg_support_from_cache(x) != 'PB' and _pkg_support_from_cache(y) == 'PB':
-        return -1
-    if _pkg_support_from_cache(x) == 'LTSB' and _pkg_support_from_cache(y) != 'LTSB':
-        return 1
-    if _pkg_support_from_cache(x) != 'LTSB' and _pkg_support_from_cache(y) == 'LTSB':
-        return -1
-    if _pkg_support_from_cache(x) == 'Legacy' and _pkg_support_from_cache(y) != 'Legacy':
-        return -1
-    if _pkg_support_from_cache(x) != 'Legacy' and _pkg_support_from_cache(y) == 'Legacy':
-        return 1
-    if _pkg_support_from_cache(x) == 'Beta' and _pkg_support_from_cache(y) != 'Beta':
-        return -1
-    if _pkg_support_from_cache(x) != 'Beta' and _pkg_support_from_cache(y) == 'Beta':
-        return 1
-    if x < y:
-        return -1
-    if x > y:
-        return 1
-    assert x == y
-    return 0
-
-
-def _cmp_gfx_alternatives_gpgpu(x, y):
-    '''Compare two graphics driver names in terms of preference. (server)
-
-    -open always sorts after non-open.
-    -server always sorts before non-server.
-    LTSB (Long Term Support Branch) always sorts before NFB (New Feature Branch).
-    Legacy always sorts before Beta.
+class DriverRanking(object):
+    '''Policy for recommending one of several alternative driver packages.
+
+    Every package gets one sort key, and the package with the biggest key is
+    recommended. The key consists of:
+
+      - whether the package is not an "-open" one (these always rank lower),
+      - whether it is a "-server" package if prefer_server is True, or not a
+        "-server" package otherwise,
+      - the tier of its support level, from support_tiers (default_tier for
+        levels which are not in there),
+      - its name, so that newer driver series rank higher.
+
+    The packages are described by a name → info map like the one returned by
+    system_driver_packages(); only the 'support' field is used.
     '''
-    if x.endswith('-open') and not y.endswith('-open'):
-        return -1
-    if not x.endswith('-open') and y.endswith('-open'):
-        return 1
-
-    if x.endswith('-server') and not y.endswith('-server'):
-        return 1
-    if not x.endswith('-server') and y.endswith('-server'):
-        return -1
-
-    if _pkg_support_from_cache(x) == 'PB' and _pkg_support_from_cache(y) != 'PB':
-        return 1
-    if _pkg_support_from_cache(x) != 'PB' and _pkg_support_from_cache(y) == 'PB':
-        return -1
-    if _pkg_support_from_cache(x) == 'LTSB' and _pkg_support_from_cache(y) != 'LTSB':
-        return 1
-    if _pkg_support_from_cache(x) != 'LTSB' and _pkg_support_from_cache(y) == 'LTSB':
-        return -1
-    if _pkg_support_from_cache(x) == 'Legacy' and _pkg_support_from_cache(y) != 'Legacy':
-        return -1
-    if _pkg_support_from_cache(x) != 'Legacy' and _pkg_support_from_cache(y) == 'Legacy':
-        return 1
-    if _pkg_support_from_cache(x) == 'Beta' and _pkg_support_from_cache(y) != 'Beta':
-        return -1
-    if _pkg_support_from_cache(x) != 'Beta' and _pkg_support_from_cache(y) == 'Beta':
-        return 1
-    if x < y:
-        return -1
-    if x > y:
-        return 1
-    assert x == y
-    return 0
+    def __init__(self, name, prefer_server, support_tiers, default_tier):
+        self.name = name
+        self.prefer_server = prefer_server
+        self.support_tiers = support_tiers
+        self.default_tier = default_tier
+
+    def key(self, name, info):
+        '''Return the sort key of a package'''
+        return (not name.endswith('-open'),
+                name.endswith('-server') == self.prefer_server,
+                self.support_tiers.get(info.get('support'), self.default_tier),
+                name)
+
+    def rank(self, packages, names=None):
+        '''Return the names of packages from the lowest to the highest rank'''
+        if names is None:
+            names = list(packages)
+        return sorted(names, key=lambda name: self.key(name, packages[name]))
+
+    def best(self, packages, names=None):
+        '''Return the name of the package with the highest rank'''
+        return self.rank(packages, names)[-1]
+
+    def explain(self, packages, names=None):
+        '''Return a line for every package, best first, which explains its rank'''
+        lines = []
+        for i, name in enumerate(reversed(self.rank(packages, names))):
+            support = packages[name].get('support')
+            lines.append('%i. %s: %s, %s, support level %s (tier %i of %s policy)' % (
+                i + 1, name,
+                name.endswith('-open') and 'open' or 'not open',
+                name.endswith('-server') and 'server' or 'not server',
+                support or '<none>',
+                self.support_tiers.get(support, self.default_tier),
+                self.name))
+        return lines
+
+
+# desktops prefer the non-server drivers; PB (Production Branch) and LTSB
+# (Long Term Support Branch) drivers are equally good, so that the newest
+# one of them wins
+desktop_driver_ranking = DriverRanking('desktop', prefer_server=False,
+                                       support_tiers={'PB': 3, 'LTSB': 3, 'Beta': 1, 'Legacy': 0},
+                                       default_tier=2)
+
+# servers prefer the server drivers, and PB over LTSB
+gpgpu_driver_ranking = DriverRanking('gpgpu', prefer_server=True,
+                                     support_tiers={'PB': 4, 'LTSB': 3, 'Beta': 1, 'Legacy': 0},
+                                     default_tier=2)
 
 
 def _add_builtins(drivers):
@@ -1401,30 +2187,28 @@ def _add_builtins(drivers):
 
 def get_linux_headers(apt_cache):
     '''Return the linux headers for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_headers_metapackage()
+    return _detection_context(apt_cache).kernel.headers
 
 
 def get_linux_image(apt_cache):
     '''Return the linux image for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_image_metapackage()
+    return _detection_context(apt_cache).kernel.image
 
 
 def get_linux_version(apt_cache):
     '''Return the linux image for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_version()
+    return _detection_context(apt_cache).kernel.version
 
 
 def get_linux(apt_cache):
     '''Return the linux metapackage for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_metapackage()
+    return _detection_context(apt_cache).kernel.linux
 
 
 def get_linux_image_from_meta(apt_cache, pkg):
-    depcache = apt_pkg.DepCache(apt_cache)
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
+    depcache = ctx.depcache
 
     try:
         candidate = depcache.get_candidate_ver(apt_cache[pkg])
@@ -1457,12 +2241,13 @@ def get_linux_image_from_meta(apt_cache, pkg):
 
 def get_linux_modules_metapackage(apt_cache, candidate):
     '''Return the linux-modules-$driver metapackage for the system's kernel'''
+    ctx = _detection_context(apt_cache)
+    apt_cache = ctx.apt_cache
     assert candidate is not None
     metapackage = None
-    linux_flavour = ''
     linux_modules_match = ''
 
-    depcache = apt_pkg.DepCache(apt_cache)
+    depcache = ctx.depcache
 
     nvidia_info = NvidiaPkgNameInfo(candidate)
     if not nvidia_info.is_valid:
@@ -1473,13 +2258,9 @@ def get_linux_modules_metapackage(apt_cache, candidate):
         logging.debug('Legacy driver detected: %s. Skipping.' % candidate)
         return metapackage
 
-    linux_image_meta = get_linux_image(apt_cache)
     # Check the actual image package, and find the flavour from there
-    linux_image = get_linux_image_from_meta(apt_cache, linux_image_meta)
-
-    if linux_image:
-        linux_flavour = linux_image.replace('linux-image-', '')
-    else:
+    linux_flavour = ctx.kernel.flavour
+    if not linux_flavour:
         logging.debug('No linux-image can be found for %s. Skipping.' % candidate)
         return metapackage
 
@@ -1492,7 +2273,7 @@ def get_linux_modules_metapackage(apt_cache, candidate):
         package_candidate = depcache.get_candidate_ver(package)
 
         if (package_candidate and package_candidate.arch in ('all', get_apt_arch())):
-            linux_version = get_linux_version(apt_cache)
+            linux_version = ctx.kernel.version
             linux_modules_abi_candidate = 'linux-modules-nvidia-%s-%s' % (candidate_flavour, linux_version)
             logging.debug('linux_modules_abi_candidate: %s' % (linux_modules_abi_candidate))
 
@@ -1519,7 +2300,7 @@ def get_linux_modules_metapackage(apt_cache, candidate):
 
         pick = ''
         modules_candidate = 'linux-modules-nvidia-%s-%s' % (candidate_flavour,
-                                                            get_linux_image(apt_cache).replace('linux-image-', ''))
+                                                            ctx.kernel.image.replace('linux-image-', ''))
         for dep in reverse_deps:
             if dep == modules_candidate:
                 pick = dep
@@ -0,0 +1,215 @@
+'''Read udev's hardware database without calling udevadm.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import mmap
+import struct
+import fnmatch
+import logging
+
+# where systemd looks for the compiled database, in this order
+default_paths = [
+    '/etc/systemd/hwdb/hwdb.bin',
+    '/etc/udev/hwdb.bin',
+    '/usr/lib/systemd/hwdb/hwdb.bin',
+    '/lib/systemd/hwdb/hwdb.bin',
+    '/lib/udev/hwdb.bin',
+    '/usr/lib/udev/hwdb.bin',
+]
+
+default_udev_data_dir = '/run/udev/data'
+
+SIGNATURE = b'KSLPHHRH'
+
+# see systemd's src/libsystemd/sd-hwdb/hwdb-internal.h
+_header = struct.Struct('<8s9Q')
+_node = struct.Struct('<QB7xQ')
+_child = struct.Struct('<B7xQ')
+_value = struct.Struct('<QQ')
+_value2 = struct.Struct('<QQQIH2x')
+
+
+class Hwdb(object):
+    '''The compiled udev hardware database (hwdb.bin).
+
+    This is a trie of modalias globs, whose nodes carry the properties of the
+    globs that end in them. lookup() finds the same properties as
+    "udevadm hwdb --test=<modalias>" does.
+
+    Raise ValueError if path is not a hwdb.bin file.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (sig, tool_version, file_size, header_size, self._node_size, self._child_size,
+             self._value_size, self._root, nodes_len, strings_len) = _header.unpack_from(self._map)
+        except struct.error:
+            raise ValueError('%s is too small for a hwdb.bin file' % path)
+        if sig != SIGNATURE:
+            raise ValueError('%s is not a hwdb.bin file' % path)
+        if file_size != len(self._map) or self._node_size < _node.size or \
+                self._child_size < _child.size or self._value_size < _value.size:
+            raise ValueError('%s has an unsupported hwdb.bin layout' % path)
+        self._has_priorities = self._value_size >= _value2.size
+        self._nodes = {}
+        self._strings = {}
+
+    @classmethod
+    def open(klass, paths=None):
+        '''Open the first hwdb.bin in paths.
+
+        paths defaults to $SYSTEMD_HWDB_BIN or the places where systemd looks
+        for it. Return None if there is no usable database.
+        '''
+        if paths is None:
+            env = os.environ.get('SYSTEMD_HWDB_BIN')
+            paths = env and [env] or default_paths
+        for path in paths:
+            try:
+                return klass(path)
+            except FileNotFoundError:
+                continue
+            except (OSError, ValueError) as e:
+                logging.debug('Ignoring hardware database %s: %s', path, e)
+        return None
+
+    def _string(self, off):
+        try:
+            return self._strings[off]
+        except KeyError:
+            end = self._map.find(b'\0', off)
+            s = self._map[off:end].decode('UTF-8', errors='replace')
+            self._strings[off] = s
+            return s
+
+    def _node_at(self, off):
+        '''Return (prefix, {char: child offset}, [value entries]) of a node'''
+        try:
+            return self._nodes[off]
+        except KeyError:
+            pass
+        prefix_off, children_count, values_count = _node.unpack_from(self._map, off)
+        pos = off + self._node_size
+        children = {}
+        for i in range(children_count):
+            c, child_off = _child.unpack_from(self._map, pos)
+            children[chr(c)] = child_off
+            pos += self._child_size
+        values = []
+        for i in range(values_count):
+            if self._has_priorities:
+                key_off, value_off, filename_off, line, priority = _value2.unpack_from(self._map, pos)
+            else:
+                (key_off, value_off), line, priority = _value.unpack_from(self._map, pos), 0, 0
+            values.append((key_off, value_off, priority, line))
+            pos += self._value_size
+        node = (prefix_off and self._string(prefix_off) or '', children, values)
+        self._nodes[off] = node
+        return node
+
+    def _add_properties(self, node, props, priorities):
+        for key_off, value_off, priority, line in node[2]:
+            key = self._string(key_off)
+            # properties start with a space; ignore other (future) entries
+            if not key.startswith(' '):
+                continue
+            key = key[1:]
+            # on duplicates, the later line of the more important file wins
+            old = priorities.get(key)
+            if old is not None and (priority, line) < old:
+                continue
+            props[key] = self._string(value_off)
+            priorities[key] = (priority, line)
+
+    def _fnmatch(self, node, p, pattern, search, props, priorities):
+        '''Collect the values of all globs below node which match search'''
+        pattern += node[0][p:]
+        for c, child_off in sorted(node[1].items()):
+            self._fnmatch(self._node_at(child_off), 0, pattern + c, search, props, priorities)
+        if node[2] and fnmatch.fnmatchcase(search, pattern):
+            self._add_properties(node, props, priorities)
+
+    def lookup(self, modalias):
+        '''Return the properties for modalias as a dictionary'''
+        props = {}
+        priorities = {}
+        node = self._node_at(self._root)
+        i = 0
+        while node:
+            prefix, children, values = node
+            for p, c in enumerate(prefix):
+                if c in '*?[':
+                    self._fnmatch(node, p, '', modalias[i + p:], props, priorities)
+                    return props
+                if modalias[i + p:i + p + 1] != c:
+                    return props
+            i += len(prefix)
+
+            for c in '*?[':
+                if c in children:
+                    self._fnmatch(self._node_at(children[c]), 0, c, modalias[i:], props, priorities)
+
+            if i == len(modalias):
+                self._add_properties(node, props, priorities)
+                return props
+
+            child_off = children.get(modalias[i])
+            node = child_off and self._node_at(child_off)
+            i += 1
+        return props
+
+
+def udev_device_id(syspath):
+    '''Return the name of a device in the udev database, or None.
+
+    This is "c<major>:<minor>" or "b<major>:<minor>" for devices with a device
+    node, "n<ifindex>" for network interfaces, and "+<subsystem>:<sysname>"
+    otherwise.
+    '''
+    try:
+        subsystem = os.path.basename(os.readlink(os.path.join(syspath, 'subsystem')))
+    except OSError:
+        return None
+    try:
+        with open(os.path.join(syspath, 'dev')) as f:
+            return '%s%s' % (subsystem == 'block' and 'b' or 'c', f.read().strip())
+    except OSError:
+        pass
+    if subsystem == 'net':
+        try:
+            with open(os.path.join(syspath, 'ifindex')) as f:
+                return 'n' + f.read().strip()
+        except OSError:
+            return None
+    return '+%s:%s' % (subsystem, os.path.basename(syspath))
+
+
+def udev_data_properties(syspath, data_dir=None):
+    '''Return the properties which udev stored for a device.
+
+    data_dir defaults to /run/udev/data. Return None if udev has no record of
+    the device.
+    '''
+    device_id = udev_device_id(syspath)
+    if not device_id:
+        return None
+    try:
+        with open(os.path.join(data_dir or default_udev_data_dir, device_id)) as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+
+    props = {}
+    for line in lines:
+        if line.startswith('E:') and '=' in line:
+            key, value = line[2:].rstrip('\n').split('=', 1)
+            props[key] = value
+    return props
@@ -24,20 +24,22 @@ import apt_pkg
 import logging
 import re
 
-from subprocess import Popen
-
 
 class KernelDetection(object):
 
-    def __init__(self, cache=None):
+    def __init__(self, cache=None, depcache=None):
         if cache:
             self.apt_cache = cache
-            self.apt_depcache = apt_pkg.DepCache(cache)
         else:
             apt_pkg.init_config()
             apt_pkg.init_system()
             self.apt_cache = apt_pkg.Cache(None)
-            self.apt_depcache = apt_pkg.DepCache(cache)
+        # creating a DepCache is expensive, so let callers share theirs
+        if depcache is not None:
+            self.apt_depcache = depcache
+        else:
+            self.apt_depcache = apt_pkg.DepCache(self.apt_cache)
+        self._newest_image = None
 
     def _is_greater_than(self, term1, term2):
         # We don't want to take into account
@@ -52,11 +54,7 @@ class KernelDetection(object):
                                match2.group(2))
 
         logging.debug('Comparing %s with %s' % (term1, term2))
-        command = 'dpkg --compare-versions %s gt %s' % \
-                  (term1, term2)
-        process = Popen(command.split(' '))
-        process.communicate()
-        return not process.returncode
+        return apt_pkg.version_compare(term1, term2) > 0
 
     def _get_linux_flavour(self, candidates, image):
         pattern = re.compile(r'linux-image-([0-9]+\.[0-9]+\.[0-9]+)-([0-9]+)-(.+)')
@@ -76,13 +74,16 @@ class KernelDetection(object):
         else:
             return None
 
-    def _get_linux_metapackage(self, target):
-        '''Get the linux headers, linux-image or linux metapackage'''
-        metapackage = ''
+    def _get_newest_image(self):
+        '''Return (version, package name) of the newest installed kernel image.
+
+        The packages are only scanned on the first call.
+        '''
+        if self._newest_image is not None:
+            return self._newest_image
+
         image_package = ''
         version = ''
-        prefix = 'linux-%s' % ('headers' if target == 'headers' else 'image')
-
         pattern = re.compile('linux-image-(?:unsigned-)?(.+)-([0-9]+)-(.+)')
 
         for package_name in map(self._filter_cache, self.apt_cache.packages):
@@ -101,6 +102,15 @@ class KernelDetection(object):
                         version = current_version
                         image_package = current_package
 
+        self._newest_image = (version, image_package)
+        return self._newest_image
+
+    def _get_linux_metapackage(self, target):
+        '''Get the linux headers, linux-image or linux metapackage'''
+        metapackage = ''
+        prefix = 'linux-%s' % ('headers' if target == 'headers' else 'image')
+
+        version, image_package = self._get_newest_image()
         if version:
             if target == 'headers':
                 target_package = image_package.replace('image', 'headers')
@@ -0,0 +1,138 @@
+'''Persistent index of the Modaliases headers in the apt cache.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import logging
+
+from UbuntuDrivers.cachefile import load_json_cache, save_json_cache
+from UbuntuDrivers.modaliasmatcher import ModaliasMatcher
+
+
+def parse_pm_aliases(value):
+    '''Return the modalias globs of a PmAliases header.
+
+    Only NVIDIA drivers declare runtime power management support this way
+    ("nvidia(glob, glob, ...)"); return an empty list for anything else.
+    '''
+    if not value or not value.startswith('nvidia('):
+        return []
+    return value[value.find('(') + 1:value.find(')')].split(', ')
+
+
+class ModaliasIndex(object):
+    '''Map modalias patterns to the driver packages which provide them.
+
+    aliases is a map bus -> alias glob -> set of package names, where "bus"
+    is the prefix of the alias up to the first ':' (e. g. "pci" or "usb").
+    packages maps the name of every package in the index to a dictionary
+    with the package record fields in RECORD_FIELDS (None if unset).
+    rejected maps the names of packages which were left out because they are
+    not installable with the current X.org video ABI to the reason.
+
+    The PmAliases of the packages are compiled like the aliases (see
+    runtimepm()), so that runtime power management support of a package for a
+    device is a set lookup.
+
+    The index belongs to one apt cache generation, identified by fingerprint
+    (see UbuntuDrivers.detect.apt_cache_fingerprint()).
+    '''
+    # bump this whenever the on-disk format changes
+    FORMAT = 3
+
+    # only what is read from the index; detection reads all other fields
+    # through UbuntuDrivers.detect.PackageDigest
+    RECORD_FIELDS = ('PmAliases',)
+
+    def __init__(self, fingerprint, aliases, packages, rejected=None):
+        self.fingerprint = fingerprint
+        self.aliases = aliases
+        self.packages = packages
+        self.rejected = rejected or {}
+        self._matchers = {}
+        self._matches = {}
+        self._pm_matchers = None
+        self._pm_matches = {}
+
+    def match(self, modalias):
+        '''Return the set of package names whose aliases match modalias'''
+        try:
+            return set(self._matches[modalias])
+        except KeyError:
+            pass
+
+        bus = modalias.split(':', 1)[0]
+        try:
+            matcher = self._matchers[bus]
+        except KeyError:
+            alias_map = self.aliases.get(bus)
+            matcher = alias_map and ModaliasMatcher(alias_map) or None
+            self._matchers[bus] = matcher
+        result = matcher and matcher.match(modalias) or set()
+        self._matches[modalias] = frozenset(result)
+        return result
+
+    def runtimepm(self, modalias):
+        '''Return the set of package names which support runtime PM for modalias'''
+        try:
+            return set(self._pm_matches[modalias])
+        except KeyError:
+            pass
+
+        if self._pm_matchers is None:
+            pm_aliases = {}
+            for package, fields in self.packages.items():
+                for alias in parse_pm_aliases(fields.get('PmAliases')):
+                    bus = alias.split(':', 1)[0]
+                    pm_aliases.setdefault(bus, {}).setdefault(alias, set()).add(package)
+            self._pm_matchers = dict((bus, ModaliasMatcher(alias_map)) for bus, alias_map in pm_aliases.items())
+        matcher = self._pm_matchers.get(modalias.split(':', 1)[0])
+        result = matcher and matcher.match(modalias) or set()
+        self._pm_matches[modalias] = frozenset(result)
+        return result
+
+    def to_json(self):
+        aliases = {}
+        for bus, alias_map in self.aliases.items():
+            aliases[bus] = dict((alias, sorted(pkgs)) for alias, pkgs in alias_map.items())
+        return {'format': self.FORMAT,
+                'fingerprint': self.fingerprint,
+                'aliases': aliases,
+                'packages': self.packages,
+                'rejected': self.rejected}
+
+    @classmethod
+    def from_json(klass, data):
+        aliases = {}
+        for bus, alias_map in data['aliases'].items():
+            aliases[bus] = dict((alias, set(pkgs)) for alias, pkgs in alias_map.items())
+        return klass(data['fingerprint'], aliases, data['packages'], data['rejected'])
+
+    def save(self, path):
+        '''Write the index to path (see UbuntuDrivers.cachefile.atomic_write())'''
+        if save_json_cache(path, self.to_json(), 'modalias index'):
+            logging.debug('Wrote modalias index %s', path)
+
+    @classmethod
+    def load(klass, path, fingerprint):
+        '''Load the index from path.
+
+        Return None if there is no index in path, or if it does not belong to
+        the apt cache generation identified by fingerprint.
+        '''
+        data = load_json_cache(path, 'modalias index')
+        if data is None:
+            return None
+
+        try:
+            if data['format'] != klass.FORMAT or data['fingerprint'] != fingerprint:
+                logging.debug('Modalias index %s is out of date', path)
+                return None
+            return klass.from_json(data)
+        except (KeyError, TypeError, AttributeError) as e:
+            logging.debug('Ignoring invalid modalias index %s: %s', path, e)
+            return None
@@ -0,0 +1,102 @@
+'''Match modaliases against modalias globs.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import re
+import fnmatch
+
+# The leading fields of the modaliases we index, which identify the device
+# (vendor and device/product ID). Every field is its name followed by a
+# fixed size hex value; globs are indexed by these fields, in this order.
+_key_layouts = {
+    'pci': (('v', 8), ('d', 8)),
+    'usb': (('v', 4), ('p', 4)),
+}
+
+_hexdigits = frozenset('0123456789abcdefABCDEF')
+
+
+def _parse_fixed(layout, body):
+    '''Parse the leading fixed width hex fields of a modalias body.
+
+    Return a list of (name, value) pairs, stopping at the first field which is
+    missing or not a literal hex value.
+    '''
+    fields = []
+    pos = 0
+    for name, width in layout:
+        if not body.startswith(name, pos):
+            break
+        value = body[pos + len(name):pos + len(name) + width]
+        if len(value) != width or not _hexdigits.issuperset(value):
+            break
+        fields.append((name, value))
+        pos += len(name) + width
+    return fields
+
+
+def _device_key(modalias):
+    '''Return the identifying fields of a modalias (or glob) as a tuple.
+
+    Only literal values count, so for a glob this is the part of the device
+    ID that every matching modalias shares. The tuple is shorter than the
+    number of key fields if some of them are not literal.
+    '''
+    bus, _, body = modalias.partition(':')
+    layout = _key_layouts.get(bus)
+    if not layout:
+        return ()
+    return tuple(value.lower() for name, value in _parse_fixed(layout, body))
+
+
+class ModaliasMatcher(object):
+    '''Match modaliases against a map of modalias globs.
+
+    patterns maps a glob to a set of values (e. g. package names). Matching is
+    case insensitive, like the kernel's modalias matching.
+
+    Globs are indexed by the literal vendor and device IDs at their start,
+    so a lookup only needs to check the globs for the same device, the same
+    vendor, and the ones which do not name a vendor at all. Globs are only
+    compiled when a lookup first needs them; compiled buckets are published
+    in one step, so a matcher can be shared between threads.
+    '''
+    def __init__(self, patterns):
+        # key -> [(glob, values)]
+        self._buckets = {}
+        # key -> [(match, values)], filled on first use
+        self._compiled = {}
+        for glob, values in patterns.items():
+            glob = glob.lower()
+            self._buckets.setdefault(_device_key(glob), []).append((glob, values))
+
+    def _bucket(self, key):
+        try:
+            return self._compiled[key]
+        except KeyError:
+            pass
+        bucket = [(re.compile(fnmatch.translate(glob)).match, values) for glob, values in self._buckets.get(key, ())]
+        self._compiled[key] = bucket
+        return bucket
+
+    def candidates(self, modalias):
+        '''Return the (glob match function, values) pairs that could match modalias'''
+        key = _device_key(modalias.lower())
+        result = []
+        for i in range(len(key) + 1):
+            result += self._bucket(key[:i])
+        return result
+
+    def match(self, modalias):
+        '''Return the set of values of all globs which match modalias'''
+        result = set()
+        lower = modalias.lower()
+        for match, values in self.candidates(lower):
+            if match(lower):
+                result.update(values)
+        return result
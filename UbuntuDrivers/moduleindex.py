@@ -0,0 +1,68 @@
+'''Index of the kernel modules which are available for a kernel.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import logging
+
+
+def normalize_module_name(name):
+    '''Return the canonical form of a module name or module file path.
+
+    Like kmod, this treats "-" and "_" alike, and strips the directory and
+    the ".ko" (and compression) suffix of file names.
+    '''
+    name = os.path.basename(name)
+    if '.ko' in name:
+        name = name[:name.index('.ko')]
+    return name.replace('-', '_')
+
+
+class ModuleIndex(object):
+    '''The kernel modules of one kernel, as modinfo and modprobe see them.
+
+    modules_dir is the kernel's module directory (e. g.
+    /lib/modules/<release>). The module names are read from its modules.dep
+    and modules.builtin files. Aliases (modules.alias) are only read when a
+    name is not found otherwise.
+    '''
+    def __init__(self, modules_dir):
+        self.modules_dir = modules_dir
+        self.modules = set()
+        self._aliases = None
+        # modules.dep has "path/to/module.ko: dependencies" lines,
+        # modules.builtin just "path/to/module.ko"
+        for index in ('modules.dep', 'modules.builtin'):
+            for line in self._read(index):
+                path = line.split(':', 1)[0].strip()
+                if path:
+                    self.modules.add(normalize_module_name(path))
+
+    def _read(self, index):
+        try:
+            with open(os.path.join(self.modules_dir, index)) as f:
+                return f.readlines()
+        except OSError as e:
+            logging.debug('ModuleIndex: cannot read %s: %s', index, e)
+            return []
+
+    @property
+    def aliases(self):
+        '''The set of (glob free) module aliases'''
+        if self._aliases is None:
+            self._aliases = set()
+            for line in self._read('modules.alias'):
+                fields = line.split()
+                if len(fields) == 3 and fields[0] == 'alias' and not any(c in fields[1] for c in '*?['):
+                    self._aliases.add(fields[1].replace('-', '_'))
+        return self._aliases
+
+    def __contains__(self, name):
+        '''Return whether the module (or module alias) name is available'''
+        name = name.replace('-', '_')
+        return name in self.modules or name in self.aliases
@@ -0,0 +1,328 @@
+'''Load custom detection plugins.'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import time
+import logging
+import marshal
+import hashlib
+import threading
+import importlib.util
+
+from UbuntuDrivers.cachefile import RACY_NS, atomic_write, load_json_cache, read_cache, save_json_cache
+
+
+class DetectionPlugin(object):
+    '''A loaded detection plugin.
+
+    name is the plugin's file name (e. g. "sl-modem.py"), and namespace the
+    global namespace its code ran in.
+    '''
+    def __init__(self, path, namespace):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.namespace = namespace
+
+    def detect(self, apt_cache):
+        '''Call the plugin's detect() function'''
+        return self.namespace['detect'](apt_cache)
+
+    @property
+    def requires(self):
+        '''The plugin's preconditions: requirement -> [value, ...]
+
+        Plugins can declare these in a module level "requires" dictionary, so
+        that they are only run on systems where they can apply (see the
+        README).
+        '''
+        requires = self.namespace.get('requires') or {}
+        if not isinstance(requires, dict):
+            raise TypeError('plugin %s has a bad "requires" type %s (must be dict)' % (self.path, type(requires)))
+        return requires
+
+    @property
+    def inputs(self):
+        '''The files which the plugin's detect() result depends on
+
+        Plugins can declare these in a module level "inputs" list, so that
+        their results can be cached (see PluginResultCache).
+        '''
+        inputs = self.namespace.get('inputs') or []
+        if not isinstance(inputs, (list, tuple)) or not all(isinstance(i, str) for i in inputs):
+            raise TypeError('plugin %s has a bad "inputs" value %r (must be a list of paths)' % (self.path, inputs))
+        return list(inputs)
+
+
+class PluginRun(object):
+    '''The outcome of running one detection plugin (see run_plugins()).
+
+    status is 'ok', 'failed' (loading or running the plugin raised an
+    exception, which is in error), 'skipped' (it does not apply to the
+    system, see reason), 'timeout' (it did not finish in time, so its result
+    is ignored) or 'invalid' (set by callers which reject its result).
+    seconds is the wall time until it finished or timed out, and result the
+    return value of its detect() function. cached is True if result was taken
+    from a PluginResultCache instead of calling detect().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.status = None
+        self.seconds = None
+        self.result = None
+        self.error = None
+        self.reason = None
+        self.cached = False
+        self._lock = threading.Lock()
+
+    def _finish(self, status, start, result=None, error=None, reason=None, cached=False):
+        with self._lock:
+            # a plugin which timed out stays that way
+            if self.status is not None:
+                return
+            self.status = status
+            self.seconds = time.monotonic() - start
+            self.result = result
+            self.error = error
+            self.reason = reason
+            self.cached = cached
+
+
+def run_plugins(loader, paths, apt_cache, timeout, cache_dir=None, check=None, results=None):
+    '''Run the detect() functions of the plugins in paths concurrently.
+
+    Every plugin is loaded with loader (see PluginLoader.load()) and run in a
+    thread of its own. A plugin which does not finish within timeout seconds
+    is given up; as threads cannot be stopped, it runs on in a daemon thread,
+    which does not keep the process from exiting. All plugins share
+    apt_cache, even after a timeout, so they must only read it (see the
+    README).
+
+    If given, check(plugin) is called with each loaded DetectionPlugin before
+    running it; if it returns a reason, the plugin is skipped.
+
+    If results (a PluginResultCache) is given, plugins which declare their
+    inputs are not run if it has a result for them, and their new results
+    are added to it and saved.
+
+    Return a list of PluginRun, in the order of paths.
+    '''
+    runs = [PluginRun(path) for path in paths]
+    start = time.monotonic()
+
+    def run(plugin_run):
+        try:
+            plugin = loader.load(plugin_run.path, cache_dir)
+            reason = check and check(plugin)
+            if reason:
+                logging.debug('Skipping plugin %s: %s', plugin_run.path, reason)
+                plugin_run._finish('skipped', start, reason=reason)
+                return
+            key = results and results.key(plugin, loader.file_key(plugin_run.path))
+            if key:
+                try:
+                    plugin_run._finish('ok', start, result=results.get(plugin_run.path, key), cached=True)
+                    return
+                except KeyError:
+                    pass
+            result = plugin.detect(apt_cache)
+        except Exception as e:
+            logging.exception('plugin %s failed:', plugin_run.path)
+            plugin_run._finish('failed', start, error=e)
+        else:
+            plugin_run._finish('ok', start, result=result)
+            if key:
+                results.put(plugin_run.path, key, result)
+
+    threads = []
+    for plugin_run in runs:
+        thread = threading.Thread(target=run, args=(plugin_run,), name='plugin ' + plugin_run.name, daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    for plugin_run, thread in zip(runs, threads):
+        thread.join(max(0, start + timeout - time.monotonic()))
+        if thread.is_alive():
+            plugin_run._finish('timeout', start)
+            if plugin_run.status == 'timeout':
+                logging.error('plugin %s did not finish within %s seconds, ignoring it', plugin_run.path, timeout)
+    if results:
+        results.save()
+    return runs
+
+
+def _file_digest(path):
+    '''Return the SHA-1 of the contents of path, or None if it cannot be read'''
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            # files in /proc have no size, so read until EOF
+            for block in iter(lambda: f.read(65536), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+class PluginResultCache(object):
+    '''Results of detection plugins which declare their inputs.
+
+    A plugin with a module level "inputs" list promises that its detect()
+    result only depends on the contents of these files and on the apt cache.
+    Such results are kept in the JSON file path, keyed on the plugin file,
+    the digests of its inputs and generation (which identifies the apt
+    cache), so that later runs can skip calling detect().
+    '''
+    # bump this whenever the file format changes
+    FORMAT = 1
+
+    def __init__(self, path, generation):
+        self.path = path
+        self.generation = generation
+        self._lock = threading.Lock()
+        self._dirty = False
+        # plugin path -> {'key': key, 'result': result}
+        self._entries = self._load()
+
+    def _load(self):
+        data = load_json_cache(self.path, 'plugin result cache')
+        if not isinstance(data, dict) or data.get('format') != self.FORMAT or \
+                not isinstance(data.get('plugins'), dict):
+            return {}
+        return data['plugins']
+
+    def key(self, plugin, file_key):
+        '''Return the key for the current inputs of plugin.
+
+        file_key is the plugin's PluginLoader.file_key(). Return None if the
+        plugin's results cannot be cached, as it does not declare its inputs
+        or its file is racy.
+        '''
+        inputs = plugin.inputs
+        if not inputs or file_key is None:
+            return None
+        return [file_key, self.generation, [[path, _file_digest(path)] for path in inputs]]
+
+    def get(self, plugin_path, key):
+        '''Return the cached result of plugin_path for key.
+
+        Raise KeyError if there is none.
+        '''
+        with self._lock:
+            entry = self._entries.get(os.path.abspath(plugin_path))
+            if not isinstance(entry, dict) or entry.get('key') != key or 'result' not in entry:
+                raise KeyError(plugin_path)
+            return entry['result']
+
+    def put(self, plugin_path, key, result):
+        '''Remember the result of plugin_path for key.
+
+        Results which are not None or a list or set of package names are
+        not cached.
+        '''
+        if isinstance(result, set):
+            result = sorted(result)
+        elif result is not None and not isinstance(result, list):
+            return
+        if result is not None and not all(isinstance(p, str) for p in result):
+            return
+        with self._lock:
+            self._entries[os.path.abspath(plugin_path)] = {'key': key, 'result': result}
+            self._dirty = True
+
+    def save(self):
+        '''Write the results to path, if they changed (see UbuntuDrivers.cachefile.atomic_write())'''
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {'format': self.FORMAT, 'plugins': dict(self._entries)}
+            self._dirty = False
+        save_json_cache(self.path, data, 'plugin result cache')
+
+
+class PluginLoader(object):
+    '''Load detection plugins, and keep them for later calls.
+
+    A plugin is only compiled and run again when its file changes. The
+    compiled code is also kept in cache_dir (if given), so that later
+    processes can skip compiling plugins which did not change.
+    '''
+    def __init__(self):
+        # path -> (file key, DetectionPlugin)
+        self._plugins = {}
+
+    @staticmethod
+    def file_key(path):
+        '''Return the identity of the current version of path.
+
+        Return None if the file was changed so recently that it could change
+        again without a different mtime; such a file must not be cached.
+        '''
+        st = os.stat(path)
+        if st.st_mtime_ns > time.time_ns() - RACY_NS:
+            return None
+        return [os.path.abspath(path), st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def load(self, path, cache_dir=None):
+        '''Return the DetectionPlugin for path.
+
+        This raises the exceptions of reading, compiling and running the plugin
+        code.
+        '''
+        key = self.file_key(path)
+        if key is not None:
+            try:
+                plugin_key, plugin = self._plugins[path]
+                if plugin_key == key:
+                    return plugin
+            except KeyError:
+                pass
+
+        code = None
+        code_path = cache_dir and key and self._code_path(cache_dir, path)
+        if code_path:
+            code = self._load_code(code_path, key)
+        if code is None:
+            with open(path) as f:
+                code = compile(f.read(), path, 'exec')
+            if code_path:
+                self._save_code(code_path, key, code)
+
+        namespace = {}
+        exec(code, namespace)
+        plugin = DetectionPlugin(path, namespace)
+        if key is not None:
+            self._plugins[path] = (key, plugin)
+        return plugin
+
+    @staticmethod
+    def _code_path(cache_dir, path):
+        # plugins of different directories can have the same name
+        digest = hashlib.sha1(os.fsencode(os.path.abspath(path))).hexdigest()[:16]
+        return os.path.join(cache_dir, '%s-%s.marshal' % (os.path.basename(path), digest))
+
+    @staticmethod
+    def _load_code(code_path, key):
+        data = read_cache(code_path, 'rb', 'plugin code cache')
+        if data is None or not data.startswith(importlib.util.MAGIC_NUMBER):
+            return None
+        try:
+            data = marshal.loads(data[len(importlib.util.MAGIC_NUMBER):])
+            if data['key'] != key:
+                return None
+            return data['code']
+        except (EOFError, ValueError, KeyError, TypeError) as e:
+            logging.debug('Ignoring invalid plugin code cache %s: %s', code_path, e)
+            return None
+
+    @staticmethod
+    def _save_code(code_path, key, code):
+        '''Write the compiled plugin code to code_path (see UbuntuDrivers.cachefile.atomic_write())'''
+        data = importlib.util.MAGIC_NUMBER + marshal.dumps({'key': key, 'code': code})
+        atomic_write(code_path, data, 'wb', 'plugin code cache')
@@ -0,0 +1,111 @@
+'''Index of NVIDIA supported GPU lists (supported-gpus.json).'''
+
+# (C) 2026 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import json
+import time
+import logging
+import marshal
+
+from UbuntuDrivers.cachefile import RACY_NS, atomic_write, read_cache
+
+
+class SupportedGpus(object):
+    '''The GPUs of a supported-gpus.json file, indexed by device ID.
+
+    chips maps a device ID as written in the file (e. g. "0x1234") to the
+    list of (name, branch, features) of its entries, in file order. branch is
+    the driver series (e. g. "510" for "510.47.03").
+    '''
+    # bump this whenever the sidecar format changes
+    FORMAT = 1
+
+    def __init__(self, chips):
+        self.chips = chips
+
+    @classmethod
+    def from_json(klass, data):
+        chips = {}
+        for gpu in data['chips']:
+            try:
+                entry = (gpu['name'], gpu['branch'].split('.')[0], list(gpu.get('features') or []))
+                chips.setdefault(gpu['devid'], []).append(entry)
+            except (KeyError, TypeError, AttributeError) as e:
+                logging.debug('Ignoring invalid supported GPU entry %s: %s', gpu, e)
+        return klass(chips)
+
+    def branch(self, devid):
+        '''Return (name, branch) of the first entry for devid, or None'''
+        for name, branch, features in self.chips.get(devid, ()):
+            return (name, branch)
+        return None
+
+    def runtimepm_branch(self, devid):
+        '''Return the branch of the first entry for devid which supports runtime PM, or None'''
+        for name, branch, features in self.chips.get(devid, ()):
+            if 'runtimepm' in features:
+                return branch
+        return None
+
+    @staticmethod
+    def file_key(path):
+        '''Return the identity of the current version of path, or None if it does not exist'''
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            logging.debug('Cannot read supported GPUs list %s: %s', path, e)
+            return None
+        return [os.path.abspath(path), st.st_mtime_ns, st.st_size, st.st_ino]
+
+    @staticmethod
+    def is_stable(key):
+        '''Return whether file_key() identifies the file's contents reliably'''
+        return key[1] < time.time_ns() - RACY_NS
+
+    @classmethod
+    def load(klass, path, key, sidecar=None):
+        '''Load the index of path, whose file_key() is key.
+
+        If sidecar is given, this reads the index from there if it belongs to
+        the same version of path, and writes it there otherwise. Return None
+        if path is not a valid supported GPUs list.
+        '''
+        if sidecar:
+            index = klass._load_sidecar(sidecar, key)
+            if index is not None:
+                return index
+
+        try:
+            with open(path) as f:
+                index = klass.from_json(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.debug('Ignoring invalid supported GPUs list %s: %s', path, e)
+            return None
+        if sidecar and klass.is_stable(key):
+            index._save_sidecar(sidecar, key)
+        return index
+
+    @classmethod
+    def _load_sidecar(klass, sidecar, key):
+        data = read_cache(sidecar, 'rb', 'supported GPUs index')
+        if data is None:
+            return None
+        try:
+            data = marshal.loads(data)
+            if data['format'] != klass.FORMAT or data['key'] != key:
+                return None
+            return klass(data['chips'])
+        except (EOFError, ValueError, KeyError, TypeError) as e:
+            logging.debug('Ignoring invalid supported GPUs index %s: %s', sidecar, e)
+            return None
+
+    def _save_sidecar(self, sidecar, key):
+        '''Write the index to sidecar (see UbuntuDrivers.cachefile.atomic_write())'''
+        data = marshal.dumps({'format': self.FORMAT, 'key': key, 'chips': self.chips})
+        atomic_write(sidecar, data, 'wb', 'supported GPUs index')
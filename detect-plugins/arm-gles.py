@@ -22,6 +22,14 @@ db = {'OMAP4 Panda board': 'pvr-omap4',
       'Toshiba AC100 / Dynabook AZ': 'nvidia-tegra',
       }
 
+# only look at /proc/cpuinfo on ARM systems which can install one of the
+# drivers
+requires = {'architectures': ['armel', 'armhf', 'arm64'],
+            'packages': sorted(set(db.values()))}
+
+# the detected board only depends on /proc/cpuinfo
+inputs = ['/proc/cpuinfo']
+
 
 def detect(apt_cache):
     board = ''
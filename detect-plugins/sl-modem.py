@@ -10,21 +10,57 @@ import subprocess
 
 modem_re = re.compile(r'^\s*\d+\s*\[Modem\s*\]')
 modem_as_subdevice_re = re.compile(r'^card [0-9].*[mM]odem')
+# " 0 [Intel          ]: HDA-Intel - HDA Intel" lines of /proc/asound/cards
+card_re = re.compile(r'^\s*(\d+) \[(.*?)\s*\]: .*? - (.*)$')
+
+# ALSA's view of the sound cards and their PCM devices
+asound_dir = '/proc/asound'
 
 pkg = 'sl-modem-daemon'
 
+# only probe ALSA on systems with sound devices which can install the driver
+requires = {'sysfs': ['class/sound'],
+            'packages': [pkg]}
 
-def detect(apt_cache):
-    # Check in /proc/asound/cards
-    try:
-        with open('/proc/asound/cards') as fd:
-            for line in fd:
-                if modem_re.match(line):
-                    return [pkg]
-    except IOError as e:
-        logging.debug('could not open /proc/asound/cards: %s', e)
+# the detection only reads these (unless ALSA's proc files do not exist)
+inputs = [os.path.join(asound_dir, 'cards'), os.path.join(asound_dir, 'pcm')]
+
+
+def pcm_devices(cards):
+    '''Return the PCM playback devices like "aplay -l" lists them.
+
+    cards are the lines of /proc/asound/cards. This reads the devices from
+    /proc/asound/pcm, whose lines look like
+    "00-06: Si3054 Modem : Si3054 Modem : playback 1 : capture 1".
+    '''
+    card_names = {}
+    for line in cards:
+        m = card_re.match(line)
+        if m:
+            card_names[int(m.group(1))] = (m.group(2), m.group(3).strip())
+
+    rows = []
+    with open(os.path.join(asound_dir, 'pcm')) as fd:
+        for line in fd:
+            fields = line.rstrip('\n').split(' : ')
+            try:
+                card_device, device_id = fields[0].split(': ', 1)
+                card, device = (int(n) for n in card_device.split('-'))
+                device_name = fields[1]
+            except (ValueError, IndexError):
+                logging.debug('ignoring invalid line in %s/pcm: %s', asound_dir, line)
+                continue
+            if not any(f.startswith('playback ') for f in fields[2:]):
+                continue
+            card_id, card_name = card_names.get(card, ('', ''))
+            rows.append('card %i: %s [%s], device %i: %s [%s]' % (
+                card, card_id, card_name, device, device_id, device_name))
+    return rows
+
+
+def aplay_devices():
+    '''Return the output lines of "aplay -l", or None if it fails'''
 
-    # Check aplay -l
     try:
         env = os.environ.copy()
         try:
@@ -50,7 +86,35 @@ def detect(apt_cache):
         logging.debug('could not open aplay -l. Skipping sl-modem detection')
         return None
 
-    for row in aplay_out.splitlines():
+    return aplay_out.splitlines()
+
+
+def detect(apt_cache):
+    # Check in /proc/asound/cards
+    try:
+        with open(os.path.join(asound_dir, 'cards')) as fd:
+            cards = fd.readlines()
+    except IOError as e:
+        logging.debug('could not open %s/cards: %s', asound_dir, e)
+        cards = None
+    else:
+        for line in cards:
+            if modem_re.match(line):
+                return [pkg]
+
+    # Check the PCM devices, like aplay -l would show them
+    rows = None
+    if cards is not None:
+        try:
+            rows = pcm_devices(cards)
+        except IOError as e:
+            logging.debug('could not open %s/pcm: %s', asound_dir, e)
+    if rows is None:
+        rows = aplay_devices()
+        if rows is None:
+            return None
+
+    for row in rows:
         if modem_as_subdevice_re.match(row):
             return [pkg]
 
@@ -16,6 +16,11 @@ import sys
 import tempfile
 import shutil
 import logging
+import re
+import time
+import fnmatch
+import struct
+import threading
 
 # from gi.repository import GLib
 from gi.repository import UMockdev
@@ -23,8 +28,15 @@ from unittest.mock import patch
 import apt_pkg
 import aptdaemon.test
 
+import UbuntuDrivers.cachefile
 import UbuntuDrivers.detect
 import UbuntuDrivers.kerneldetection
+import UbuntuDrivers.hwdb
+import UbuntuDrivers.moduleindex
+import UbuntuDrivers.modaliasindex
+import UbuntuDrivers.modaliasmatcher
+import UbuntuDrivers.plugins
+import UbuntuDrivers.supportedgpus
 
 import testarchive
 
@@ -143,12 +155,20 @@ class DetectTest(unittest.TestCase):
         os.environ['UBUNTU_DRIVERS_DETECT_DIR'] = self.plugin_dir
         os.environ['UBUNTU_DRIVERS_SYS_DIR'] = self.umockdev.get_sys_dir()
 
+        # do not touch the system's persistent caches
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = self.cache_dir
+        os.environ['UBUNTU_DRIVERS_RUN_DIR'] = os.path.join(self.cache_dir, 'run')
+
     def tearDown(self):
         shutil.rmtree(self.plugin_dir)
+        shutil.rmtree(self.cache_dir)
 
         # most test cases switch the apt root, so the apt.Cache() cache becomes
         # unreliable; reset it
         UbuntuDrivers.detect.packages_for_modalias.cache_maps = {}
+        UbuntuDrivers.detect.video_abi_index.memo = {}
+        UbuntuDrivers.detect.hardware_snapshot.memo = {}
 
     @unittest.skipUnless(os.path.isdir('/sys/devices'), 'no /sys dir on this system')
     def test_system_modaliases_system(self):
@@ -178,6 +198,139 @@ class DetectTest(unittest.TestCase):
             modalias_nv_2]))
         self.assertTrue(res['pci:vDEADBEEFd00'].endswith('/sys/devices/grey'))
 
+    def test_hardware_snapshot_persistent(self):
+        '''HardwareSnapshot reuses the devices of an earlier run in the same boot'''
+
+        sys_dir = self.umockdev.get_sys_dir()
+        run_dir = os.environ['UBUNTU_DRIVERS_RUN_DIR']
+        os.mkdir(os.path.join(sys_dir, 'kernel'))
+        seqnum_path = os.path.join(sys_dir, 'kernel', 'uevent_seqnum')
+        with open(seqnum_path, 'w') as f:
+            f.write('100\n')
+        boot_id_path = os.path.join(self.cache_dir, 'boot_id')
+        with open(boot_id_path, 'w') as f:
+            f.write('0f1e2d3c-1111-2222-3333-444455556666\n')
+
+        with patch('UbuntuDrivers.detect.boot_id_path', boot_id_path):
+            snapshot = UbuntuDrivers.detect.HardwareSnapshot(sys_dir)
+            expected = snapshot.modaliases
+            self.assertFalse(snapshot.reused)
+            self.assertTrue(os.path.exists(os.path.join(run_dir, 'hardware.json')))
+
+            with patch('UbuntuDrivers.detect.system_modaliases') as scan:
+                snapshot = UbuntuDrivers.detect.HardwareSnapshot(sys_dir)
+                self.assertEqual(list(snapshot.modaliases.items()), list(expected.items()))
+                self.assertTrue(snapshot.reused)
+                self.assertEqual(scan.call_count, 0)
+
+                # not for other sysfs directories
+                other_sys_dir = os.path.join(self.cache_dir, 'sys')
+                os.makedirs(os.path.join(other_sys_dir, 'kernel'))
+                shutil.copy(seqnum_path, os.path.join(other_sys_dir, 'kernel'))
+                UbuntuDrivers.detect.HardwareSnapshot(other_sys_dir).modaliases
+                self.assertEqual(scan.call_count, 1)
+
+            # hotplug
+            self.umockdev.add_device('pci', 'pink', None, ['modalias', 'pci:v0000ABCDd00'], [])
+            with open(seqnum_path, 'w') as f:
+                f.write('102\n')
+            snapshot = UbuntuDrivers.detect.HardwareSnapshot(sys_dir)
+            self.assertIn('pci:v0000ABCDd00', snapshot.modaliases)
+            self.assertFalse(snapshot.reused)
+            with patch('UbuntuDrivers.detect.system_modaliases') as scan:
+                self.assertIn('pci:v0000ABCDd00', UbuntuDrivers.detect.HardwareSnapshot(sys_dir).modaliases)
+                self.assertEqual(scan.call_count, 0)
+
+                # reboot
+                with open(boot_id_path, 'w') as f:
+                    f.write('a0b1c2d3-1111-2222-3333-444455556666\n')
+                UbuntuDrivers.detect.HardwareSnapshot(sys_dir).modaliases
+                self.assertEqual(scan.call_count, 1)
+
+                # disabled
+                UbuntuDrivers.detect.HardwareSnapshot(sys_dir, persistent=False).modaliases
+                self.assertEqual(scan.call_count, 2)
+
+            # broken snapshot
+            with open(os.path.join(run_dir, 'hardware.json'), 'w') as f:
+                f.write('{"format": 1, "key": ')
+            snapshot = UbuntuDrivers.detect.HardwareSnapshot(sys_dir)
+            self.assertIn('pci:v0000ABCDd00', snapshot.modaliases)
+            self.assertFalse(snapshot.reused)
+
+        # no snapshot without uevent sequence number
+        os.unlink(seqnum_path)
+        self.assertIsNone(UbuntuDrivers.detect.HardwareSnapshot(sys_dir).key())
+
+    def test_system_modaliases_performance(self):
+        '''system_modaliases() against an os.walk() over a big sysfs'''
+
+        sys_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sys_dir)
+        os.makedirs(os.path.join(sys_dir, 'bus', 'pci', 'devices'))
+        os.makedirs(os.path.join(sys_dir, 'bus', 'usb', 'devices'))
+        os.makedirs(os.path.join(sys_dir, 'class', 'net'))
+        os.makedirs(os.path.join(sys_dir, 'devices', 'system', 'cpu'))
+        with open(os.path.join(sys_dir, 'devices', 'system', 'cpu', 'modalias'), 'w') as f:
+            f.write('cpu:type:x86,ven0000fam0006mod003A:feature:,0000,0001\n')
+        os.makedirs(os.path.join(sys_dir, 'devices', 'builtin_drv'))
+        os.makedirs(os.path.join(sys_dir, 'devices', 'module_drv'))
+        os.symlink(sys_dir, os.path.join(sys_dir, 'devices', 'module_drv', 'module'))
+
+        # 50 PCI functions with 20 USB devices each, and their attribute
+        # directories, adds up to about 50k directories
+        def add_device(path, bus, modalias, builtin):
+            for attr_dir in ('power', 'msi_irqs', 'resource', 'queues/rx-0', 'queues/tx-0', 'statistics'):
+                os.makedirs(os.path.join(path, attr_dir))
+            with open(os.path.join(path, 'modalias'), 'w') as f:
+                f.write(modalias + '\n')
+            os.symlink(os.path.join(sys_dir, 'devices', builtin and 'builtin_drv' or 'module_drv'),
+                       os.path.join(path, 'driver'))
+            os.symlink(os.path.relpath(path, os.path.join(sys_dir, 'bus', bus, 'devices')),
+                       os.path.join(sys_dir, 'bus', bus, 'devices', os.path.basename(path)))
+
+        for i in range(50):
+            pci = os.path.join(sys_dir, 'devices', 'pci0000:00', '0000:00:%02x.0' % i)
+            add_device(pci, 'pci', 'pci:v00008086d%08Xsv00000000sd00000000bc0Csc03i30' % i, i % 10 == 0)
+            for j in range(20):
+                usb = os.path.join(pci, 'usb%i' % i, '%i-%i' % (i, j))
+                # some devices have the same modalias
+                add_device(usb, 'usb', 'usb:v1234p%04Xd0100dc00dsc00dp00ic03isc01ip02in00' % (j % 15), False)
+                net = os.path.join(usb, 'net', 'eth%i_%i' % (i, j))
+                for k in range(20):
+                    os.makedirs(os.path.join(net, 'queues', 'rx-%i' % k))
+                    os.makedirs(os.path.join(net, 'queues', 'tx-%i' % k))
+                os.symlink(os.path.relpath(net, os.path.join(sys_dir, 'class', 'net')),
+                           os.path.join(sys_dir, 'class', 'net', os.path.basename(net)))
+
+        def walk(devices):
+            # this is what system_modaliases() used to do
+            aliases = {}
+            for path, dirs, files in os.walk(devices):
+                if 'modalias' not in files:
+                    continue
+                with open(os.path.join(path, 'modalias')) as f:
+                    modalias = f.read().strip()
+                driverlink = os.path.join(path, 'driver')
+                if os.path.islink(driverlink) and not os.path.islink(os.path.join(driverlink, 'module')):
+                    continue
+                aliases[modalias] = path
+            return aliases
+
+        start = time.time()
+        expected = walk(os.path.join(sys_dir, 'devices'))
+        walk_time = time.time() - start
+
+        start = time.time()
+        res = UbuntuDrivers.detect.system_modaliases(sys_dir)
+        scan_time = time.time() - start
+
+        sys.stderr.write('[os.walk %.3f s, scan %.3f s] ' % (walk_time, scan_time))
+        # same devices, in the same order
+        self.assertEqual(list(res.items()), list(expected.items()))
+        self.assertEqual(len(res), 61)
+        self.assertLess(scan_time, walk_time)
+
     def test_system_driver_packages_performance(self):
         '''system_driver_packages() performance for a lot of modaliases'''
 
@@ -3345,6 +3498,415 @@ class DetectTest(unittest.TestCase):
             chroot.remove()
         self.assertTrue('oem-pistacchio-meta' in res)
 
+    def test_modalias_map_cache(self):
+        '''modalias map is built once per apt cache generation'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+            fingerprint = UbuntuDrivers.detect.apt_cache_fingerprint(cache)
+
+            stats = UbuntuDrivers.detect.packages_for_modalias.cache_stats
+            misses = stats['misses']
+            hits = stats['hits']
+            res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(stats['misses'], misses + 1)
+            # all devices are resolved with a single lookup
+            self.assertEqual(stats['hits'], hits)
+
+            # a new cache object for the same state shares the map
+            cache = apt_pkg.Cache(None)
+            self.assertEqual(UbuntuDrivers.detect.apt_cache_fingerprint(cache), fingerprint)
+            res2 = UbuntuDrivers.detect.system_device_specific_metapackages(
+                cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(stats['misses'], misses + 1)
+            self.assertEqual(stats['hits'], hits + 1)
+
+            # changing the archive invalidates it
+            archive.create_deb('vanilla', version='2', extra_tags={
+                               'Modaliases': 'vanilla(pci:v00001234d*sv*sd*bc*sc*i*)'})
+            chroot.add_repository(archive.path, True, False)
+            cache = apt_pkg.Cache(None)
+            self.assertNotEqual(UbuntuDrivers.detect.apt_cache_fingerprint(cache), fingerprint)
+            UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(stats['misses'], misses + 2)
+        finally:
+            chroot.remove()
+
+        self.assertTrue('vanilla' in res)
+        self.assertEqual(res2, {})
+
+    def test_modalias_index_persistent(self):
+        '''modalias index is kept on disk for the next run'''
+
+        index_path = os.path.join(self.cache_dir, 'modaliases.json')
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertTrue(os.path.exists(index_path))
+
+            # a new process only needs to load the index
+            UbuntuDrivers.detect.packages_for_modalias.cache_maps = {}
+            with patch('UbuntuDrivers.detect._apt_cache_modalias_map') as mock_build:
+                mock_build.side_effect = AssertionError('index should not be rebuilt')
+                res2 = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(res, res2)
+
+            index = UbuntuDrivers.modaliasindex.ModaliasIndex.load(
+                index_path, UbuntuDrivers.detect.apt_cache_fingerprint(cache))
+            self.assertEqual(index.packages['neapolitan'], {'PmAliases': None})
+            self.assertEqual(index.aliases['usb']['usb:v9876dABCDsv*sd*bc00sc*i*'], set(['chocolate']))
+            # uninstallable for the current X.org video ABI
+            self.assertFalse('nvidia-old' in index.packages)
+
+            # a changed archive invalidates the index
+            archive.create_deb('pistachio', extra_tags={'Modaliases': 'pistachio(pci:v00001234d*sv*sd*bc*sc*i*)'})
+            chroot.add_repository(archive.path, True, False)
+            cache = apt_pkg.Cache(None)
+            UbuntuDrivers.detect.packages_for_modalias.cache_maps = {}
+            res3 = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+        finally:
+            chroot.remove()
+
+        self.assertFalse('pistachio' in res)
+        self.assertTrue('pistachio' in res3)
+        self.assertEqual(UbuntuDrivers.modaliasindex.ModaliasIndex.load(index_path, 'other'), None)
+
+    def test_packages_for_modaliases(self):
+        '''packages_for_modaliases() resolves all devices at once'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            modaliases = list(UbuntuDrivers.detect.system_modaliases(self.umockdev.get_sys_dir()))
+            # a device which is not present, but has a driver
+            extra = 'usb:v9876dABCDsv00sd00bc00sc00i00'
+            stats = UbuntuDrivers.detect.packages_for_modalias.cache_stats
+            lookups = stats['hits'] + stats['misses']
+            res = UbuntuDrivers.detect.packages_for_modaliases(cache, modaliases + [extra])
+            self.assertEqual(stats['hits'] + stats['misses'], lookups + 1)
+
+            self.assertEqual(list(res), modaliases + [extra])
+            for alias in modaliases:
+                self.assertEqual([p.name for p in res[alias]],
+                                 [p.name for p in UbuntuDrivers.detect.packages_for_modalias(cache, alias)])
+            self.assertEqual([p.name for p in res[extra]], ['chocolate'])
+            self.assertEqual(UbuntuDrivers.detect.packages_for_modaliases(cache, []), {})
+        finally:
+            chroot.remove()
+
+    @patch('UbuntuDrivers.detect.path_get_custom_supported_gpus')
+    def test_packages_for_modaliases_allow_list(self, mocked_pgcsg):
+        '''packages_for_modaliases() adds allow-list drivers without changing the modalias index'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            # no Modaliases: only the allow-list selects it
+            archive.create_deb('nvidia-driver-510', dependencies={'Depends': 'xorg-video-abi-4'})
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            csg_file = os.path.join(chroot.path, 'custom_supported_gpus.json')
+            mocked_pgcsg.return_value = csg_file
+            with open(csg_file, 'w') as f:
+                f.write('{"chips": [{"devid": "0x10C3", "name": "TEST 10C3", "branch": "510.1"},'
+                        ' {"devid": "0x10C4", "name": "TEST 10C4", "branch": "999"}]}')
+
+            other_nv = 'pci:v000010DEd000010C4sv00003842sd00002670bc03sc00i00'
+            res = UbuntuDrivers.detect.packages_for_modaliases(cache, [modalias_nv, other_nv])
+            self.assertEqual([p.name for p in res[modalias_nv]], ['nvidia-current', 'nvidia-driver-510'])
+            # nvidia-driver-999 does not exist
+            self.assertEqual([p.name for p in res[other_nv]], ['nvidia-current'])
+            # single lookups go through the same per-call overlay
+            self.assertEqual([p.name for p in UbuntuDrivers.detect.packages_for_modalias(cache, modalias_nv)],
+                             ['nvidia-current', 'nvidia-driver-510'])
+
+            # the shared index does not know about the allow-list
+            cache_map = UbuntuDrivers.detect._cached_modalias_map(cache)
+            self.assertEqual(cache_map.match(modalias_nv), set(['nvidia-current']))
+            self.assertNotIn('nvidia-driver-510', str(cache_map.to_json()))
+
+            # ... so that it does not leak into lookups without the allow-list
+            os.unlink(csg_file)
+            res = UbuntuDrivers.detect.packages_for_modaliases(cache, [modalias_nv])
+            self.assertEqual([p.name for p in res[modalias_nv]], ['nvidia-current'])
+        finally:
+            chroot.remove()
+
+    def test_detection_context(self):
+        '''one DepCache and PackageRecords per detection run'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            ctx = UbuntuDrivers.detect.DetectionContext(cache)
+            with patch('apt_pkg.DepCache', wraps=apt_pkg.DepCache) as mock_depcache:
+                with patch('apt_pkg.PackageRecords', wraps=apt_pkg.PackageRecords) as mock_records:
+                    res = UbuntuDrivers.detect.system_driver_packages(ctx, sys_path=self.umockdev.get_sys_dir())
+                    res_oem = UbuntuDrivers.detect.system_device_specific_metapackages(
+                        ctx, sys_path=self.umockdev.get_sys_dir())
+                    devices = UbuntuDrivers.detect.system_device_drivers(ctx, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(mock_depcache.call_count, 0)
+            self.assertEqual(mock_records.call_count, 0)
+
+            # a plain cache object gets the same results
+            self.assertEqual(UbuntuDrivers.detect.system_driver_packages(
+                cache, sys_path=self.umockdev.get_sys_dir()), res)
+            self.assertEqual(UbuntuDrivers.detect.system_device_drivers(
+                cache, sys_path=self.umockdev.get_sys_dir()), devices)
+        finally:
+            chroot.remove()
+
+        self.assertTrue('vanilla' in res)
+        self.assertEqual(res_oem, {})
+
+    def test_hardware_snapshot(self):
+        '''hardware_snapshot() scans sysfs once until refresh()'''
+
+        sys_dir = self.umockdev.get_sys_dir()
+        snapshot = UbuntuDrivers.detect.hardware_snapshot(sys_dir)
+        self.assertIs(UbuntuDrivers.detect.hardware_snapshot(sys_dir), snapshot)
+        self.assertIs(UbuntuDrivers.detect.hardware_snapshot(snapshot), snapshot)
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            with patch('UbuntuDrivers.detect.system_modaliases',
+                       wraps=UbuntuDrivers.detect.system_modaliases) as scan:
+                res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir)
+                UbuntuDrivers.detect.system_device_specific_metapackages(cache, sys_path=sys_dir)
+                UbuntuDrivers.detect.system_gpgpu_driver_packages(cache, sys_path=sys_dir)
+                UbuntuDrivers.detect.system_device_drivers(cache, sys_path=snapshot)
+                self.assertEqual(scan.call_count, 1)
+                self.assertIn('vanilla', res)
+
+                # new devices only show up after refresh()
+                self.umockdev.add_device('pci', 'pink', None, ['modalias', 'pci:v0000BEEFd00sv00sd00bc00sc00i00'], [])
+                self.assertNotIn('pci:v0000BEEFd00sv00sd00bc00sc00i00', snapshot.modaliases)
+                self.assertEqual(UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir), res)
+                snapshot.refresh()
+                self.assertIn('pci:v0000BEEFd00sv00sd00bc00sc00i00', snapshot.modaliases)
+                UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir)
+                self.assertEqual(scan.call_count, 2)
+        finally:
+            chroot.remove()
+
+    def test_package_digest(self):
+        '''each candidate record is read once per detection run'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('nvidia-driver-525', dependencies={'Depends': 'xorg-video-abi-4'},
+                               extra_tags={'Modaliases': 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)',
+                                           'Support': 'PB',
+                                           'PmAliases': 'nvidia(pci:v000010DEd000010C3sv*sd*bc03sc*i*)'})
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            ctx = UbuntuDrivers.detect.DetectionContext(cache)
+            with patch('UbuntuDrivers.detect.PackageDigest', wraps=UbuntuDrivers.detect.PackageDigest) as mock_digest:
+                res = UbuntuDrivers.detect.system_driver_packages(ctx, sys_path=self.umockdev.get_sys_dir())
+                UbuntuDrivers.detect.system_device_drivers(ctx, sys_path=self.umockdev.get_sys_dir())
+            digested = [c[0][2].get_fullname() for c in mock_digest.call_args_list]
+
+            nv = ctx.package_digest(cache['nvidia-driver-525'])
+            neapolitan = ctx.package_digest(cache['neapolitan'])
+        finally:
+            chroot.remove()
+
+        self.assertEqual(sorted(digested), sorted(set(digested)))
+        self.assertTrue('nvidia-driver-525' in [d.split(':')[0] for d in digested])
+        self.assertEqual(res['nvidia-driver-525']['support'], 'PB')
+        self.assertTrue(res['nvidia-driver-525']['runtimepm'])
+
+        self.assertEqual(nv.name, 'nvidia-driver-525')
+        self.assertEqual(nv.support, 'PB')
+        self.assertEqual(nv.modaliases, 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)')
+        self.assertEqual(nv.pm_aliases, 'nvidia(pci:v000010DEd000010C3sv*sd*bc03sc*i*)')
+        self.assertEqual(neapolitan.component, 'restricted')
+        self.assertEqual(neapolitan.support, '')
+        self.assertEqual(neapolitan.runtimepm, '')
+
+    def test_system_driver_packages_fields(self):
+        '''system_driver_packages() only determines the requested fields'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('nvidia-driver-525', dependencies={'Depends': 'xorg-video-abi-4'},
+                               extra_tags={'Modaliases': 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)',
+                                           'Support': 'PB'})
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+            sys_dir = self.umockdev.get_sys_dir()
+
+            full = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir)
+            self.assertEqual(UbuntuDrivers.detect.system_driver_packages(
+                cache, sys_path=sys_dir, fields=UbuntuDrivers.detect.driver_package_fields), full)
+
+            with patch('UbuntuDrivers.detect._is_package_free',
+                       wraps=UbuntuDrivers.detect._is_package_free) as mock_free:
+                with patch('UbuntuDrivers.detect._is_runtimepm_supported') as mock_runtimepm:
+                    with patch('UbuntuDrivers.detect._get_db_names') as mock_db_names:
+                        names = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir, fields=())
+                        self.assertEqual(mock_free.call_count, 0)
+                        UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir, fields=('free',))
+                        free_calls = mock_free.call_count
+                        mock_free.reset_mock()
+                        free = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir,
+                                                                           freeonly=True, fields=('free',))
+                        # free is checked once per package, also when filtering by it
+                        self.assertEqual(mock_free.call_count, free_calls)
+            self.assertEqual(mock_runtimepm.call_count, 0)
+            self.assertEqual(mock_db_names.call_count, 0)
+
+            self.assertRaises(ValueError, UbuntuDrivers.detect.system_driver_packages,
+                              cache, sys_path=sys_dir, fields=('free', 'bogus'))
+        finally:
+            chroot.remove()
+
+        self.assertEqual(set(names), set(full))
+        for p, info in names.items():
+            # the recommended flag does not depend on the selected fields
+            self.assertEqual(set(info) - set(['modalias', 'syspath', 'plugin', 'recommended']), set(), info)
+            self.assertEqual(info.get('recommended'), full[p].get('recommended'))
+        self.assertTrue(names['nvidia-driver-525']['recommended'])
+        self.assertEqual(names['nvidia-driver-525']['modalias'], full['nvidia-driver-525']['modalias'])
+        self.assertEqual(set(free), set(p for p in full if full[p]['free']))
+        for info in free.values():
+            self.assertTrue(info['free'])
+            self.assertNotIn('from_distro', info)
+
+    def test_system_runtimepm_table(self):
+        '''system_runtimepm_table()'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('nvidia-driver-525', dependencies={'Depends': 'xorg-video-abi-4'},
+                               extra_tags={'Modaliases': 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)',
+                                           'PmAliases': 'nvidia(pci:v000010DEd000010C3sv*sd*bc03sc*i*)'})
+            archive.create_deb('nvidia-driver-535', dependencies={'Depends': 'xorg-video-abi-4'},
+                               extra_tags={'Modaliases': 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)',
+                                           'PmAliases': 'nvidia(pci:v000010DEd00002777sv*sd*bc03sc*i*)'})
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            table = UbuntuDrivers.detect.system_runtimepm_table(cache, sys_path=self.umockdev.get_sys_dir())
+            res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+        finally:
+            chroot.remove()
+
+        self.assertEqual(table, {modalias_nv: {'nvidia-current': False,
+                                               'nvidia-driver-525': True,
+                                               'nvidia-driver-535': False}})
+        for package, supported in table[modalias_nv].items():
+            self.assertEqual(res[package]['runtimepm'], supported)
+
+    def test_video_abi_index(self):
+        '''VideoAbiIndex'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('nvidia-driver-440')
+            archive.create_deb('xserver-xorg-video-nvidia-440', dependencies={'Depends': 'xorg-video-abi-3'})
+            chroot.add_repository(archive.path, True, False)
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            index = UbuntuDrivers.detect.video_abi_index(cache)
+            self.assertEqual(index.abi, 'xorg-video-abi-4')
+            self.assertTrue('nvidia-current' in index.dependents)
+            self.assertFalse('nvidia-old' in index.dependents)
+            # computed once per cache generation
+            self.assertTrue(UbuntuDrivers.detect.video_abi_index(apt_pkg.Cache(None)) is index)
+
+            self.assertTrue(index.check(cache, cache['nvidia-current']))
+            self.assertTrue(index.check(cache, cache['vanilla']))
+            self.assertFalse(index.check(cache, cache['nvidia-old']))
+            self.assertFalse(index.check(cache, cache['nvidia-driver-440']))
+            self.assertEqual(index.explain('nvidia-old'), 'does not support X.org video ABI xorg-video-abi-4')
+            self.assertEqual(index.explain('nvidia-driver-440'),
+                             'xserver-xorg-video-nvidia-440 does not support X.org video ABI xorg-video-abi-4')
+            self.assertEqual(index.explain('vanilla'), None)
+
+            # rejections are remembered in the modalias index
+            UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            UbuntuDrivers.detect.packages_for_modalias.cache_maps = {}
+            UbuntuDrivers.detect.video_abi_index.memo = {}
+            UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            self.assertEqual(UbuntuDrivers.detect.video_abi_index(cache).explain('nvidia-old'),
+                             'does not support X.org video ABI xorg-video-abi-4')
+        finally:
+            chroot.remove()
+
     def test_system_driver_packages_bad_encoding(self):
         '''system_driver_packages() with badly encoded Packages index'''
 
@@ -3478,23 +4040,18 @@ Description: broken \xEB encoding
             apt_pkg.init_system()
             cache = apt_pkg.Cache(None)
 
-            # add a wrapper modinfo binary
-            with open(os.path.join(chroot.path, 'modinfo'), 'w') as f:
-                f.write('''#!/bin/sh -e
-if [ "$1" = nvidia ]; then
-    echo "filename:  /some/path/nvidia.ko"
-    exit 0
-fi
-exec /sbin/modinfo "$@"
-''')
-            os.chmod(os.path.join(chroot.path, 'modinfo'), 0o755)
-            orig_path = os.environ['PATH']
-            os.environ['PATH'] = '%s:%s' % (chroot.path, os.environ['PATH'])
+            # fake a kernel module directory with the nvidia module
+            modules_dir = os.path.join(chroot.path, 'modules')
+            os.mkdir(modules_dir)
+            with open(os.path.join(modules_dir, 'modules.dep'), 'w') as f:
+                f.write('updates/dkms/nvidia.ko: kernel/drivers/i2c/i2c-core.ko.zst\n'
+                        'kernel/drivers/i2c/i2c-core.ko.zst:\n')
+            os.environ['UBUNTU_DRIVERS_MODULES_DIR'] = modules_dir
 
             res = UbuntuDrivers.detect.system_device_drivers(cache, sys_path=self.umockdev.get_sys_dir())
         finally:
             chroot.remove()
-            os.environ['PATH'] = orig_path
+            del os.environ['UBUNTU_DRIVERS_MODULES_DIR']
 
         graphics = '/sys/devices/graphics'
         graphics_dict = [value for key, value in res.items() if key.endswith(graphics)][0]
@@ -3651,6 +4208,200 @@ exec /sbin/modinfo "$@"
             logging.getLogger().setLevel(logging.INFO)
             chroot.remove()
 
+    def test_detect_plugin_packages_runs(self):
+        '''detect_plugin_packages() runs plugins concurrently, with a timeout'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            self._gen_detect_plugins()
+            # each of these only succeeds if the other one runs at the same time
+            for name, other in (('slow', 'slower'), ('slower', 'slow')):
+                with open(os.path.join(self.plugin_dir, name + '.py'), 'w') as f:
+                    f.write('import os, time\n\ndef detect(apt):\n    open(%r, "w").close()\n'
+                            '    for i in range(50):\n        if os.path.exists(%r):\n'
+                            '            return ["special"]\n        time.sleep(0.1)\n    return None\n'
+                            % (os.path.join(self.cache_dir, name), os.path.join(self.cache_dir, other)))
+            with open(os.path.join(self.plugin_dir, 'hang.py'), 'w') as f:
+                f.write('import time\n\ndef detect(apt):\n    time.sleep(30)\n    return ["special"]\n')
+
+            logging.getLogger().setLevel(logging.CRITICAL)
+            start = time.time()
+            res = UbuntuDrivers.detect.detect_plugin_packages(cache, timeout=3)
+            # does not wait for the hanging plugin
+            self.assertLess(time.time() - start, 25)
+            runs = UbuntuDrivers.detect.detect_plugin_packages.runs
+        finally:
+            logging.getLogger().setLevel(logging.INFO)
+            chroot.remove()
+
+        # results are ordered by plugin name
+        self.assertEqual(list(res), ['slow.py', 'slower.py', 'special.py'])
+        self.assertEqual([run.name for run in runs],
+                         ['badreturn.py', 'badreturn2.py', 'empty.py', 'except.py', 'hang.py', 'nodetect.py',
+                          'picky.py', 'slow.py', 'slower.py', 'special.py', 'syntax.py'])
+        status = dict((run.name, run.status) for run in runs)
+        self.assertEqual(status, {'badreturn.py': 'invalid', 'badreturn2.py': 'invalid', 'empty.py': 'ok',
+                                  'except.py': 'failed', 'hang.py': 'timeout', 'nodetect.py': 'failed',
+                                  'picky.py': 'ok', 'slow.py': 'ok', 'slower.py': 'ok', 'special.py': 'ok',
+                                  'syntax.py': 'failed'})
+        self.assertGreaterEqual([run for run in runs if run.name == 'hang.py'][0].seconds, 3)
+        self.assertIsInstance([run for run in runs if run.name == 'except.py'][0].error, ZeroDivisionError)
+
+    def test_detect_plugin_packages_requires(self):
+        '''detect_plugin_packages() skips plugins which do not apply'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('special')
+            chroot.add_repository(archive.path, True, False)
+
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+            sys_dir = self.umockdev.get_sys_dir()
+            arch = UbuntuDrivers.detect.get_apt_arch()
+
+            plugins = {
+                'arch': "{'architectures': ['%s', 'foo']}" % arch,
+                'wrongarch': "{'architectures': ['foo', 'bar']}",
+                'sysfs': "{'sysfs': ['nonexisting', 'devices']}",
+                'nosysfs': "{'sysfs': ['nonexisting']}",
+                'modalias': "{'modaliases': ['usb:v1234', 'PCI:v000010de']}",
+                'nomodalias': "{'modaliases': ['usb:v1234']}",
+                'package': "{'packages': ['nonexisting', 'special']}",
+                'nopackage': "{'packages': ['nonexisting']}",
+                'all': "{'architectures': ['%s'], 'packages': ['special'], 'sysfs': ['devices']}" % arch,
+                'notall': "{'architectures': ['%s'], 'packages': ['nonexisting']}" % arch,
+                'unknown': "{'moon_phase': ['full']}",
+                'badtype': "['special']",
+            }
+            for name, requires in plugins.items():
+                with open(os.path.join(self.plugin_dir, name + '.py'), 'w') as f:
+                    f.write('requires = %s\n\ndef detect(apt):\n    return ["special"]\n' % requires)
+
+            logging.getLogger().setLevel(logging.CRITICAL)
+            res = UbuntuDrivers.detect.detect_plugin_packages(cache, sys_path=sys_dir)
+            runs = dict((run.name, run) for run in UbuntuDrivers.detect.detect_plugin_packages.runs)
+        finally:
+            logging.getLogger().setLevel(logging.INFO)
+            chroot.remove()
+
+        self.assertEqual(sorted(res), ['all.py', 'arch.py', 'modalias.py', 'package.py', 'sysfs.py', 'unknown.py'])
+        self.assertEqual(dict((name, run.status) for name, run in runs.items()),
+                         {'arch.py': 'ok', 'wrongarch.py': 'skipped', 'sysfs.py': 'ok', 'nosysfs.py': 'skipped',
+                          'modalias.py': 'ok', 'nomodalias.py': 'skipped', 'package.py': 'ok',
+                          'nopackage.py': 'skipped', 'all.py': 'ok', 'notall.py': 'skipped',
+                          'unknown.py': 'ok', 'badtype.py': 'failed'})
+        self.assertEqual(runs['wrongarch.py'].reason, 'architecture %s is not one of foo, bar' % arch)
+        self.assertEqual(runs['nosysfs.py'].reason, 'none of nonexisting exists in %s' % sys_dir)
+        self.assertEqual(runs['nomodalias.py'].reason, 'no device has a modalias starting with usb:v1234')
+        self.assertEqual(runs['nopackage.py'].reason, 'none of the packages nonexisting is available')
+        self.assertEqual(runs['notall.py'].reason, 'none of the packages nonexisting is available')
+        self.assertIsNone(runs['all.py'].reason)
+        self.assertIsInstance(runs['badtype.py'].error, TypeError)
+
+    def test_system_driver_packages_plugin_requires(self):
+        '''system_driver_packages() checks plugin sysfs requirements in the hardware snapshot'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('special')
+            chroot.add_repository(archive.path, True, False)
+
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+            sys_dir = self.umockdev.get_sys_dir()
+
+            for name, path in (('sysfs', 'devices'), ('nosysfs', 'nonexisting')):
+                with open(os.path.join(self.plugin_dir, name + '.py'), 'w') as f:
+                    f.write('requires = {"sysfs": ["%s"]}\n\ndef detect(apt):\n    return ["special"]\n' % path)
+
+            snapshot = UbuntuDrivers.detect.hardware_snapshot(sys_dir)
+            res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=snapshot)
+            runs = dict((run.name, run) for run in UbuntuDrivers.detect.detect_plugin_packages.runs)
+        finally:
+            chroot.remove()
+
+        self.assertEqual(res['special']['plugin'], 'sysfs.py')
+        self.assertEqual(dict((name, run.status) for name, run in runs.items()),
+                         {'sysfs.py': 'ok', 'nosysfs.py': 'skipped'})
+        self.assertEqual(runs['nosysfs.py'].reason, 'none of nonexisting exists in %s' % sys_dir)
+
+    def test_detect_plugin_packages_result_cache(self):
+        '''detect_plugin_packages() reuses results of plugins with unchanged inputs'''
+
+        input_path = os.path.join(self.cache_dir, 'cpuinfo')
+        calls_path = os.path.join(self.cache_dir, 'calls')
+        with open(input_path, 'w') as f:
+            f.write('special\n')
+        plugin = os.path.join(self.plugin_dir, 'special.py')
+        with open(plugin, 'w') as f:
+            f.write('inputs = [%r]\n\ndef detect(apt):\n'
+                    '    with open(%r, "a") as f:\n        f.write("x")\n'
+                    '    with open(inputs[0]) as f:\n        return f.read().split()\n' % (input_path, calls_path))
+        os.utime(plugin, (time.time() - 10, time.time() - 10))
+
+        def calls():
+            with open(calls_path) as f:
+                return len(f.read())
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('special')
+            chroot.add_repository(archive.path, True, False)
+
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+
+            self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'special.py': ['special']})
+            self.assertEqual(calls(), 1)
+            self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'special.py': ['special']})
+            self.assertEqual(calls(), 1)
+            self.assertTrue(UbuntuDrivers.detect.detect_plugin_packages.runs[0].cached)
+
+            # cached results are still filtered by the current apt cache
+            with open(input_path, 'w') as f:
+                f.write('special nonexisting\n')
+            self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'special.py': ['special']})
+            self.assertEqual(calls(), 2)
+            self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'special.py': ['special']})
+            self.assertEqual(calls(), 2)
+
+            # --no-plugin-cache
+            UbuntuDrivers.detect.detect_plugin_packages.use_result_cache = False
+            try:
+                self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'special.py': ['special']})
+            finally:
+                UbuntuDrivers.detect.detect_plugin_packages.use_result_cache = True
+            self.assertEqual(calls(), 3)
+            self.assertFalse(UbuntuDrivers.detect.detect_plugin_packages.runs[0].cached)
+        finally:
+            chroot.remove()
+
     def _gen_detect_plugins(self):
         '''Generate some custom detection plugins in self.plugin_dir.'''
 
@@ -3862,6 +4613,50 @@ def detect(apt):
         finally:
             chroot.remove()
 
+    def test_kernel_info_chroot(self):
+        '''kernel packages are resolved with a single scan'''
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('linux-image-5.4.0-24-generic')
+            archive.create_deb('linux-image-5.4.0-25-generic')
+            archive.create_deb('linux-headers-5.4.0-25-generic')
+            archive.create_deb('linux-image-generic',
+                               dependencies={'Depends': 'linux-image-5.4.0-25-generic'})
+            archive.create_deb('linux-headers-generic',
+                               dependencies={'Depends': 'linux-headers-5.4.0-25-generic'})
+            archive.create_deb('linux-generic',
+                               dependencies={'Depends': 'linux-image-generic, linux-headers-generic'})
+            chroot.add_repository(archive.path, True, False)
+
+            apt_pkg.init_config()
+            dpkg_status = os.path.abspath(os.path.join(chroot.path, "var", "lib", "dpkg", "status"))
+            apt_pkg.config.set("Dir::State::status", dpkg_status)
+            apt_pkg.init_system()
+            cache = apt_pkg.Cache(None)
+            depcache = apt_pkg.DepCache(cache)
+            for pkg in ('linux-image-5.4.0-24-generic', 'linux-image-5.4.0-25-generic',
+                        'linux-headers-5.4.0-25-generic', 'linux-image-generic',
+                        'linux-headers-generic', 'linux-generic'):
+                depcache.mark_install(cache[pkg])
+
+            ctx = UbuntuDrivers.detect.DetectionContext(cache)
+            kd = UbuntuDrivers.kerneldetection.KernelDetection
+            with patch.object(kd, '_filter_cache', autospec=True, side_effect=kd._filter_cache) as mock_filter:
+                for i in range(2):
+                    self.assertEqual(UbuntuDrivers.detect.get_linux_image(ctx), 'linux-image-generic')
+                    self.assertEqual(UbuntuDrivers.detect.get_linux_headers(ctx), 'linux-headers-generic')
+                    self.assertEqual(UbuntuDrivers.detect.get_linux(ctx), 'linux-generic')
+                    self.assertEqual(UbuntuDrivers.detect.get_linux_version(ctx), '5.4.0-25-generic')
+                    self.assertEqual(ctx.kernel.flavour, '5.4.0-25-generic')
+                    UbuntuDrivers.detect.get_linux_modules_metapackage(ctx, 'nvidia-driver-510')
+            # one call per package, i. e. a single scan
+            self.assertEqual(mock_filter.call_count, len(cache.packages))
+        finally:
+            chroot.remove()
+
 
 class ToolTest(unittest.TestCase):
     '''Test ubuntu-drivers tool'''
@@ -3891,6 +4686,10 @@ APT::Get::AllowUnauthenticated "true";
 
         klass.tool_path = os.path.join(ROOT_DIR, 'ubuntu-drivers')
 
+        # do not touch the system's persistent caches
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = os.path.join(klass.chroot.path, 'cache')
+        os.environ['UBUNTU_DRIVERS_RUN_DIR'] = os.path.join(klass.chroot.path, 'run')
+
         # no custom detection plugins by default
         klass.plugin_dir = os.path.join(klass.chroot.path, 'detect')
         os.environ['UBUNTU_DRIVERS_DETECT_DIR'] = klass.plugin_dir
@@ -4067,6 +4866,8 @@ APT::Get::AllowUnauthenticated "true";
 
         with open(os.path.join(self.plugin_dir, 'special.py'), 'w') as f:
             f.write('def detect(apt): return ["special", "special-uninst", "special-unavail"]\n')
+        with open(os.path.join(self.plugin_dir, 'needy.py'), 'w') as f:
+            f.write('requires = {"packages": ["nonexisting"]}\n\ndef detect(apt): return ["special"]\n')
 
         ud = subprocess.Popen(
             [self.tool_path, 'debug'],
@@ -4082,6 +4883,69 @@ APT::Get::AllowUnauthenticated "true";
         self.assertTrue(modalias_nv in out, out)
         # driver packages
         self.assertTrue('available: 1 (auto-install)  [third party]  free  modalias:' in out, out)
+        # packages filtered out by the video ABI
+        self.assertTrue('xserver-xorg-core provides: xorg-video-abi-4' in out, out)
+        self.assertTrue('nvidia-old: filtered out, does not support X.org video ABI xorg-video-abi-4' in out, out)
+        self.assertTrue('special-uninst: filtered out, does not support X.org video ABI xorg-video-abi-4' in out, out)
+        # ranking of the NVIDIA alternatives
+        self.assertTrue('=== NVIDIA driver ranking ===\n1. nvidia-current: not open, not server, '
+                        'support level <none> (tier 2 of desktop policy)' in out, out)
+        # runtime power management table
+        # detection plugins
+        self.assertTrue(re.search(r'=== detection plugins ===\nneedy.py: skipped after [0-9.]+ s '
+                                  r'\(none of the packages nonexisting is available\)\n'
+                                  r'special.py: ok after [0-9.]+ s\n', out), out)
+        self.assertTrue('=== NVIDIA runtime power management ===\n%s\n  nvidia-current: not supported\n'
+                        % modalias_nv in out, out)
+
+    def test_debug_hw_cache(self):
+        '''ubuntu-drivers debug reuses the hardware snapshot'''
+
+        os.mkdir(os.path.join(self.umockdev.get_sys_dir(), 'kernel'))
+        with open(os.path.join(self.umockdev.get_sys_dir(), 'kernel', 'uevent_seqnum'), 'w') as f:
+            f.write('42\n')
+
+        outputs = []
+        for args in (['debug'], ['debug'], ['--no-hw-cache', 'debug']):
+            ud = subprocess.Popen(
+                [self.tool_path] + args,
+                universal_newlines=True, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            out, err = ud.communicate()
+            self.assertEqual(err, '', err)
+            self.assertEqual(ud.returncode, 0)
+            self.assertTrue(modalias_nv in out, out)
+            outputs.append(out)
+
+        self.assertFalse('Reusing hardware snapshot' in outputs[0], outputs[0])
+        self.assertTrue('Reusing hardware snapshot' in outputs[1], outputs[1])
+        self.assertFalse('Reusing hardware snapshot' in outputs[2], outputs[2])
+
+    def test_debug_plugin_cache(self):
+        '''ubuntu-drivers debug reuses plugin results'''
+
+        input_path = os.path.join(self.plugin_dir, 'cards')
+        with open(input_path, 'w') as f:
+            f.write('special\n')
+        plugin = os.path.join(self.plugin_dir, 'special.py')
+        with open(plugin, 'w') as f:
+            f.write('inputs = [%r]\n\ndef detect(apt): return ["special"]\n' % input_path)
+        os.utime(plugin, (time.time() - 10, time.time() - 10))
+
+        outputs = []
+        for args in (['debug'], ['debug'], ['--no-plugin-cache', 'debug']):
+            ud = subprocess.Popen(
+                [self.tool_path] + args,
+                universal_newlines=True, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            out, err = ud.communicate()
+            self.assertEqual(err, '', err)
+            self.assertEqual(ud.returncode, 0)
+            outputs.append(out)
+
+        self.assertTrue(re.search(r'special.py: ok after [0-9.]+ s\n', outputs[0]), outputs[0])
+        self.assertTrue(re.search(r'special.py: ok after [0-9.]+ s \(cached result\)\n', outputs[1]), outputs[1])
+        self.assertTrue(re.search(r'special.py: ok after [0-9.]+ s\n', outputs[2]), outputs[2])
 
 
 class PluginsTest(unittest.TestCase):
@@ -4092,6 +4956,9 @@ class PluginsTest(unittest.TestCase):
 
         env = os.environ.copy()
         env['UBUNTU_DRIVERS_DETECT_DIR'] = os.path.join(ROOT_DIR, 'detect-plugins')
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        env['UBUNTU_DRIVERS_CACHE_DIR'] = cache_dir
 
         ud = subprocess.Popen(
             [os.path.join(ROOT_DIR, 'ubuntu-drivers'), 'debug'],
@@ -4104,6 +4971,1023 @@ class PluginsTest(unittest.TestCase):
         self.assertFalse('Traceback' in out, out)
         self.assertEqual(ud.returncode, 0)
 
+    # ALSA proc files (cards, pcm) of some sound setups
+    asound_fixtures = {
+        'modem_card': (' 0 [Intel          ]: HDA-Intel - HDA Intel\n'
+                       '                      HDA Intel at 0xf7f10000 irq 30\n'
+                       ' 1 [Modem          ]: ICH-MODEM - Intel 82801DB-ICH4 Modem\n'
+                       '                      Intel 82801DB-ICH4 Modem with AD1981B at irq 17\n',
+                       '00-00: ALC269VB Analog : ALC269VB Analog : playback 1 : capture 1\n'
+                       '01-00: Intel ICH - Modem : Intel 82801DB-ICH4 Modem - Modem : playback 1 : capture 1\n'),
+        'modem_device': (' 0 [Intel          ]: HDA-Intel - HDA Intel\n'
+                         '                      HDA Intel at 0xf7f10000 irq 30\n',
+                         '00-00: ALC269VB Analog : ALC269VB Analog : playback 1 : capture 1\n'
+                         '00-06: Si3054 Modem : Si3054 Modem : playback 1 : capture 1\n'),
+        'modem_capture': (' 0 [Intel          ]: HDA-Intel - HDA Intel\n'
+                          '                      HDA Intel at 0xf7f10000 irq 30\n',
+                          '00-00: ALC269VB Analog : ALC269VB Analog : playback 1 : capture 1\n'
+                          '00-06: Si3054 Modem : Si3054 Modem : capture 1\n'),
+        'modem_card_name': (' 0 [Intel          ]: HDA-Intel - HDA Intel Modem\n'
+                            '                      HDA Intel at 0xf7f10000 irq 30\n',
+                            '00-00: ALC269VB Analog : ALC269VB Analog : playback 1 : capture 1\n'),
+        'no_modem': (' 0 [PCH            ]: HDA-Intel - HDA Intel PCH\n'
+                     '                      HDA Intel PCH at 0xf7f10000 irq 30\n'
+                     ' 1 [NVidia         ]: HDA-Intel - HDA NVidia\n'
+                     '                      HDA NVidia at 0xf7080000 irq 17\n',
+                     '00-00: ALC3246 Analog : ALC3246 Analog : playback 1 : capture 1\n'
+                     '01-03: HDMI 0 : HDMI 0 : playback 1\n'),
+    }
+
+    def test_sl_modem(self):
+        '''sl-modem plugin reads ALSA's proc files'''
+
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+
+        # aplay -l must only be used without ALSA proc files
+        bin_dir = os.path.join(workdir, 'bin')
+        os.mkdir(bin_dir)
+        aplay_log = os.path.join(workdir, 'aplay.log')
+        with open(os.path.join(bin_dir, 'aplay'), 'w') as f:
+            f.write('#!/bin/sh\necho "$@" >> %s\n'
+                    'echo "**** List of PLAYBACK Hardware Devices ****"\n'
+                    'echo "card 0: Intel [HDA Intel], device 6: Si3054 Modem [Si3054 Modem]"\n' % aplay_log)
+        os.chmod(os.path.join(bin_dir, 'aplay'), 0o755)
+
+        plugin = UbuntuDrivers.plugins.PluginLoader().load(os.path.join(ROOT_DIR, 'detect-plugins', 'sl-modem.py'))
+        self.assertEqual(plugin.inputs, ['/proc/asound/cards', '/proc/asound/pcm'])
+
+        with patch.dict(os.environ, {'PATH': bin_dir + ':' + os.environ.get('PATH', '')}):
+            for name, (cards, pcm) in self.asound_fixtures.items():
+                asound_dir = os.path.join(workdir, name)
+                os.mkdir(asound_dir)
+                with open(os.path.join(asound_dir, 'cards'), 'w') as f:
+                    f.write(cards)
+                with open(os.path.join(asound_dir, 'pcm'), 'w') as f:
+                    f.write(pcm)
+                plugin.namespace['asound_dir'] = asound_dir
+                self.assertEqual(plugin.detect(None), name.startswith('modem_') and name != 'modem_capture'
+                                 and ['sl-modem-daemon'] or None, name)
+            plugin.namespace['asound_dir'] = os.path.join(workdir, 'modem_device')
+            self.assertEqual(plugin.namespace['pcm_devices'](self.asound_fixtures['modem_device'][0].splitlines()),
+                             ['card 0: Intel [HDA Intel], device 0: ALC269VB Analog [ALC269VB Analog]',
+                              'card 0: Intel [HDA Intel], device 6: Si3054 Modem [Si3054 Modem]'])
+            self.assertFalse(os.path.exists(aplay_log))
+
+            # without ALSA proc files, fall back to aplay
+            plugin.namespace['asound_dir'] = os.path.join(workdir, 'nonexisting')
+            self.assertEqual(plugin.detect(None), ['sl-modem-daemon'])
+            with open(aplay_log) as f:
+                self.assertEqual(f.read(), '-l\n')
+
+
+class ModaliasMatcherTest(unittest.TestCase):
+    '''Test UbuntuDrivers.modaliasmatcher'''
+
+    @staticmethod
+    def gen_globs(count):
+        '''Generate a synthetic archive of alias globs'''
+
+        globs = {}
+        for i in range(count):
+            pkg = 'driver%i' % (i % 500)
+            if i % 10 == 0:
+                # vendor wide
+                glob = 'pci:v0000%04Xd*sv*sd*bc*sc*i*' % (0x1000 + i)
+            elif i % 10 == 1:
+                glob = 'usb:v%04Xp%04Xd*dc*dsc*dp*ic*isc*ip*in*' % (0x2000 + i % 50, i)
+            elif i % 97 == 0:
+                # no literal vendor at all
+                glob = 'pci:v*d*sv*sd*bc%02Xsc*i*' % (i % 256)
+            else:
+                glob = 'pci:v0000%04Xd0000%04xsv*sd*bc*sc*i*' % (0x10DE + i % 20, i)
+            globs.setdefault(glob, set()).add(pkg)
+        return globs
+
+    def test_device_key(self):
+        '''_device_key()'''
+
+        key = UbuntuDrivers.modaliasmatcher._device_key
+        self.assertEqual(key('pci:v000010DEd000010C3sv00003842sd00002670bc03sc00i00'), ('000010de', '000010c3'))
+        self.assertEqual(key('usb:v1D6Bp0002d0504dc09dsc00dp03ic09isc00ip00in00'), ('1d6b', '0002'))
+        # only literal IDs count
+        self.assertEqual(key('pci:v000010DEd*sv*'), ('000010de',))
+        self.assertEqual(key('pci:v*d000010C3sv*'), ())
+        self.assertEqual(key('pci:s0001'), ())
+        self.assertEqual(key('dmi:bvnLENOVO:bvrN1EET:svnLENOVO:pn20A7:'), ())
+
+    def test_match(self):
+        '''ModaliasMatcher.match()'''
+
+        matcher = UbuntuDrivers.modaliasmatcher.ModaliasMatcher({
+            'pci:v000010DEd000010C3sv*sd*bc03sc*i*': set(['exact']),
+            'pci:v000010DEd*sv*sd*bc03sc*i*': set(['vendor']),
+            'pci:v*d*sv*sd*bc03sc*i*': set(['any']),
+            'pci:v000010ded000010c4*': set(['lower']),
+            'pci:v0000[01]0DEd000010C3*': set(['charclass']),
+            'usb:v9876pABCD*': set(['usb']),
+        })
+        self.assertEqual(matcher.match('pci:v000010DEd000010C3sv00003842sd00002670bc03sc00i00'),
+                         set(['exact', 'vendor', 'any', 'charclass']))
+        self.assertEqual(matcher.match('pci:v000010DEd000010C4sv00003842sd00002670bc03sc00i00'),
+                         set(['vendor', 'any', 'lower']))
+        self.assertEqual(matcher.match('pci:v000010DEd000010C3sv00003842sd00002670bc02sc00i00'),
+                         set(['charclass']))
+        self.assertEqual(matcher.match('pci:v00001234d000010C3sv00003842sd00002670bc03sc00i00'),
+                         set(['any']))
+        self.assertEqual(matcher.match('usb:v9876pabcdd0001'), set(['usb']))
+        self.assertEqual(matcher.match('usb:v9876pABCE'), set())
+        self.assertEqual(matcher.match('pci:s0001'), set())
+
+        # the result is a copy
+        matcher.match('usb:v9876pABCD').add('bogus')
+        self.assertEqual(matcher.match('usb:v9876pABCD'), set(['usb']))
+
+    def test_modalias_index_runtimepm(self):
+        '''ModaliasIndex.runtimepm()'''
+
+        self.assertEqual(UbuntuDrivers.modaliasindex.parse_pm_aliases(
+            'nvidia(pci:v000010DEd000010C3sv*sd*bc03sc*i*, pci:v000010DEd00002777sv*sd*bc03sc*i*)'),
+            ['pci:v000010DEd000010C3sv*sd*bc03sc*i*', 'pci:v000010DEd00002777sv*sd*bc03sc*i*'])
+        self.assertEqual(UbuntuDrivers.modaliasindex.parse_pm_aliases('foo(pci:v*)'), [])
+        self.assertEqual(UbuntuDrivers.modaliasindex.parse_pm_aliases(None), [])
+
+        index = UbuntuDrivers.modaliasindex.ModaliasIndex('fp', {}, {
+            'nvidia-driver-510': {'PmAliases': 'nvidia(pci:v000010DEd000010C3sv*sd*bc03sc*i*, '
+                                               'pci:v000010DEd00002777sv*sd*bc03sc*i*)'},
+            'nvidia-driver-535': {'PmAliases': 'nvidia(pci:v000010DEd00002777sv*sd*bc03sc*i*)'},
+            'nvidia-driver-470': {'PmAliases': None},
+            'bcmwl-kernel-source': {'PmAliases': 'wl(pci:v000014E4d*sv*sd*bc*sc*i*)'},
+        })
+        self.assertEqual(index.runtimepm('pci:v000010DEd000010C3sv00003842sd00002670bc03sc00i00'),
+                         set(['nvidia-driver-510']))
+        self.assertEqual(index.runtimepm('pci:v000010dEd00002777sv00003842sd00002670bc03sc00i00'),
+                         set(['nvidia-driver-510', 'nvidia-driver-535']))
+        self.assertEqual(index.runtimepm('pci:v000014E4d00004311sv00003842sd00002670bc02sc80i00'), set())
+        self.assertEqual(index.runtimepm('usb:v9876pABCD'), set())
+
+        # the result is a copy
+        index.runtimepm('pci:v000010DEd000010C3sv00003842sd00002670bc03sc00i00').add('bogus')
+        self.assertEqual(index.runtimepm('pci:v000010DEd000010C3sv00003842sd00002670bc03sc00i00'),
+                         set(['nvidia-driver-510']))
+
+    def test_match_threads(self):
+        '''ModaliasMatcher can be shared between threads'''
+
+        globs = self.gen_globs(1000)
+        modaliases = [g.replace('*', '00') for g in sorted(globs)][::5]
+        expected = [UbuntuDrivers.modaliasmatcher.ModaliasMatcher(globs).match(m) for m in modaliases]
+
+        matcher = UbuntuDrivers.modaliasmatcher.ModaliasMatcher(globs)
+        results = {}
+
+        def run(i):
+            results[i] = [matcher.match(m) for m in modaliases]
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in range(8):
+            self.assertEqual(results[i], expected)
+
+    def test_match_performance(self):
+        '''ModaliasMatcher against an fnmatch loop over 10k globs'''
+
+        globs = self.gen_globs(10000)
+        # instances of some of the globs, and devices without a driver
+        modaliases = [g.replace('*', '00') for g in sorted(globs)[::40]]
+        for i in range(250):
+            modaliases.append('pci:v0000%04Xd0000%04Xsv00001234sd00005678bc%02Xsc00i00' %
+                              (0x8086 + i % 20, i * 7, i % 256))
+            modaliases.append('usb:v%04Xp%04Xd0100dc00dsc00dp00ic03isc01ip02in00' % (0x3000 + i % 50, i * 3))
+
+        def naive(modalias):
+            # this is what packages_for_modalias() used to do
+            result = set()
+            if not pat.match(modalias):
+                return result
+            for alias in bus_globs[modalias.split(':', 1)[0]]:
+                if fnmatch.fnmatchcase(modalias.lower(), alias.lower()):
+                    result.update(globs[alias])
+            return result
+
+        bus_globs = {}
+        for glob in globs:
+            bus_globs.setdefault(glob.split(':', 1)[0], []).append(glob)
+        pat = re.compile('|'.join([fnmatch.translate(g) for g in globs]), re.IGNORECASE)
+        start = time.time()
+        expected = [naive(m) for m in modaliases]
+        naive_time = time.time() - start
+
+        start = time.time()
+        matcher = UbuntuDrivers.modaliasmatcher.ModaliasMatcher(globs)
+        result = [matcher.match(m) for m in modaliases]
+        matcher_time = time.time() - start
+
+        sys.stderr.write('[fnmatch %.3f s, matcher %.3f s] ' % (naive_time, matcher_time))
+        self.assertEqual(result, expected)
+        self.assertGreater(len([r for r in result if r]), 250)
+        # even including the index build time
+        self.assertLess(matcher_time, naive_time)
+
+
+class DriverRankingTest(unittest.TestCase):
+    '''Test UbuntuDrivers.detect.DriverRanking'''
+
+    packages = {
+        'nvidia-driver-390': {'support': 'Legacy'},
+        'nvidia-driver-470': {'support': 'LTSB'},
+        'nvidia-driver-470-server': {'support': 'LTSB'},
+        'nvidia-driver-510': {'support': 'PB'},
+        'nvidia-driver-510-server': {'support': 'PB'},
+        'nvidia-driver-510-open': {'support': 'PB'},
+        'nvidia-driver-515': {'support': 'Beta'},
+        'nvidia-driver-520': {'support': 'NFB'},
+        'nvidia-driver-450': {},
+    }
+
+    def test_desktop(self):
+        '''desktop policy'''
+
+        self.assertEqual(UbuntuDrivers.detect.desktop_driver_ranking.rank(self.packages),
+                         ['nvidia-driver-510-open',
+                          'nvidia-driver-470-server',
+                          'nvidia-driver-510-server',
+                          'nvidia-driver-390',
+                          'nvidia-driver-515',
+                          'nvidia-driver-450',
+                          'nvidia-driver-520',
+                          'nvidia-driver-470',
+                          'nvidia-driver-510'])
+        self.assertEqual(UbuntuDrivers.detect.desktop_driver_ranking.best(self.packages), 'nvidia-driver-510')
+
+        # PB and LTSB are equally good, so the newer one wins
+        packages = {'nvidia-driver-535': {'support': 'LTSB'},
+                    'nvidia-driver-530': {'support': 'PB'}}
+        self.assertEqual(UbuntuDrivers.detect.desktop_driver_ranking.best(packages), 'nvidia-driver-535')
+
+        # only the given names are ranked
+        self.assertEqual(UbuntuDrivers.detect.desktop_driver_ranking.best(
+            self.packages, ['nvidia-driver-390', 'nvidia-driver-515', 'nvidia-driver-510-open']),
+            'nvidia-driver-515')
+
+    def test_gpgpu(self):
+        '''gpgpu policy'''
+
+        self.assertEqual(UbuntuDrivers.detect.gpgpu_driver_ranking.rank(self.packages),
+                         ['nvidia-driver-510-open',
+                          'nvidia-driver-390',
+                          'nvidia-driver-515',
+                          'nvidia-driver-450',
+                          'nvidia-driver-520',
+                          'nvidia-driver-470',
+                          'nvidia-driver-510',
+                          'nvidia-driver-470-server',
+                          'nvidia-driver-510-server'])
+
+        # PB wins over a newer LTSB
+        packages = {'nvidia-driver-535-server': {'support': 'LTSB'},
+                    'nvidia-driver-530-server': {'support': 'PB'}}
+        self.assertEqual(UbuntuDrivers.detect.gpgpu_driver_ranking.best(packages), 'nvidia-driver-530-server')
+
+    def test_explain(self):
+        '''explain() lists the packages best first'''
+
+        packages = {'nvidia-driver-510-open': {'support': 'PB'},
+                    'nvidia-driver-470-server': {'support': 'LTSB'},
+                    'nvidia-driver-450': {}}
+        self.assertEqual(UbuntuDrivers.detect.desktop_driver_ranking.explain(packages),
+                         ['1. nvidia-driver-450: not open, not server, support level <none> '
+                          '(tier 2 of desktop policy)',
+                          '2. nvidia-driver-470-server: not open, server, support level LTSB '
+                          '(tier 3 of desktop policy)',
+                          '3. nvidia-driver-510-open: open, not server, support level PB '
+                          '(tier 3 of desktop policy)'])
+
+
+class HwdbTest(unittest.TestCase):
+    '''Test UbuntuDrivers.hwdb'''
+
+    # (glob, key, value, file priority, line)
+    entries = [
+        ('pci:v000010DEd*', 'ID_VENDOR_FROM_DATABASE', 'NVIDIA Corporation', 1, 10),
+        ('pci:v000010DEd000010C3*', 'ID_MODEL_FROM_DATABASE', 'GT218 [GeForce 8400 GS Rev. 3]', 1, 11),
+        ('pci:v000010DEd000010C3sv00003842sd00002670*', 'ID_MODEL_FROM_DATABASE', 'GeForce 8400 GS Rev. 3', 1, 12),
+        # less important file
+        ('pci:v000010DEd000010C3*', 'ID_MODEL_FROM_DATABASE', 'overridden', 0, 99),
+        ('pci:v000010DEd00002?77*', 'ID_MODEL_FROM_DATABASE', 'question mark', 1, 13),
+        ('pci:v000010DEd*bc03sc*', 'ID_PCI_CLASS_FROM_DATABASE', 'Display controller', 1, 14),
+        ('pci:v00001234d*', 'ID_VENDOR_FROM_DATABASE', 'Technical Corp.', 1, 15),
+        ('usb:v9876p*', 'ID_VENDOR_FROM_DATABASE', 'Chocolate Inc.', 1, 16),
+        ('usb:v9876pABCD*', 'ID_MODEL_FROM_DATABASE', 'Chocolate Fountain', 1, 17),
+        ('dmi:*:pnXPS1[0-9]*', 'ID_MODEL', 'XPS', 1, 18),
+        ('*:pnXPS137390:*', 'EXACT', 'yes', 1, 19),
+    ]
+
+    @staticmethod
+    def gen_hwdb(path, entries):
+        '''Write a hwdb.bin file for (glob, key, value, priority, line) entries'''
+
+        def new_node():
+            return {'prefix': '', 'children': {}, 'values': []}
+
+        root = new_node()
+        for glob, key, value, priority, line in entries:
+            node = root
+            for c in glob:
+                node = node['children'].setdefault(c, new_node())
+            node['values'].append((key, value, priority, line))
+
+        # merge chains of single children into prefixes, like systemd-hwdb
+        nodes = []
+
+        def compress(node):
+            while len(node['children']) == 1 and not node['values']:
+                (c, child), = node['children'].items()
+                node['prefix'] += c + child['prefix']
+                node['children'] = child['children']
+                node['values'] = child['values']
+            nodes.append(node)
+            for c in sorted(node['children']):
+                compress(node['children'][c])
+
+        compress(root)
+
+        off = 80
+        for node in nodes:
+            node['off'] = off
+            off += 24 + 16 * len(node['children']) + 32 * len(node['values'])
+
+        strings = bytearray(b'\0')
+        string_offs = {}
+
+        def string(s):
+            if s not in string_offs:
+                string_offs[s] = off + len(strings)
+                strings.extend(s.encode() + b'\0')
+            return string_offs[s]
+
+        body = bytearray()
+        for node in nodes:
+            body += struct.pack('<QB7xQ', node['prefix'] and string(node['prefix']) or 0,
+                                len(node['children']), len(node['values']))
+            for c in sorted(node['children']):
+                body += struct.pack('<B7xQ', ord(c), node['children'][c]['off'])
+            for key, value, priority, line in node['values']:
+                body += struct.pack('<QQQIH2x', string(' ' + key), string(value), string('test.hwdb'),
+                                    line, priority)
+
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<8s9Q', b'KSLPHHRH', 245, 80 + len(body) + len(strings), 80, 24, 16, 32,
+                                root['off'], len(body), len(strings)))
+            f.write(body)
+            f.write(strings)
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.hwdb_path = os.path.join(self.workdir, 'hwdb.bin')
+        self.gen_hwdb(self.hwdb_path, self.entries)
+
+        # do not touch the system's persistent caches
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = os.path.join(self.workdir, 'cache')
+
+        self.addCleanup(self.reset_memo)
+        self.reset_memo()
+
+    def reset_memo(self):
+        UbuntuDrivers.detect._get_hwdb.memo = {}
+        UbuntuDrivers.detect._get_db_names.memo = {}
+        UbuntuDrivers.detect._get_db_names.loaded = None
+
+    def test_lookup(self):
+        '''Hwdb.lookup()'''
+
+        hwdb = UbuntuDrivers.hwdb.Hwdb(self.hwdb_path)
+        self.assertEqual(hwdb.lookup(modalias_nv), {
+            'ID_VENDOR_FROM_DATABASE': 'NVIDIA Corporation',
+            'ID_MODEL_FROM_DATABASE': 'GeForce 8400 GS Rev. 3',
+            'ID_PCI_CLASS_FROM_DATABASE': 'Display controller'})
+        self.assertEqual(hwdb.lookup('pci:v000010DEd000010C3sv00001111sd00002222bc00sc00i00'), {
+            'ID_VENDOR_FROM_DATABASE': 'NVIDIA Corporation',
+            'ID_MODEL_FROM_DATABASE': 'GT218 [GeForce 8400 GS Rev. 3]'})
+        self.assertEqual(hwdb.lookup(modalias_nv_2)['ID_MODEL_FROM_DATABASE'], 'question mark')
+        self.assertEqual(hwdb.lookup('usb:v9876p0001d0100'), {'ID_VENDOR_FROM_DATABASE': 'Chocolate Inc.'})
+        self.assertEqual(hwdb.lookup('usb:v9876dABCDsv01sd02bc00sc01i05'), {})
+        self.assertEqual(hwdb.lookup('usb:v9876pABCDd0100'),
+                         {'ID_VENDOR_FROM_DATABASE': 'Chocolate Inc.',
+                          'ID_MODEL_FROM_DATABASE': 'Chocolate Fountain'})
+        self.assertEqual(hwdb.lookup('dmi:bvnDell:pnXPS137390:a'), {'ID_MODEL': 'XPS', 'EXACT': 'yes'})
+        self.assertEqual(hwdb.lookup('dmi:bvnDell:pnXPS9:a'), {})
+        self.assertEqual(hwdb.lookup('pci:vDEADBEEFd00'), {})
+        self.assertEqual(hwdb.lookup('pci:v0000'), {})
+        self.assertEqual(hwdb.lookup(''), {})
+
+        # same result as trying every glob
+        for modalias in [modalias_nv, modalias_nv_2, 'pci:v00001234d00sv00000001sd00bc00sc00i00',
+                         'usb:v9876pABCDd0100', 'dmi:bvnDell:pnXPS137390:a', 'pci:v000010DEd00001234bc03sc00i00']:
+            expected = {}
+            for glob, key, value, priority, line in sorted(self.entries, key=lambda e: (e[3], e[4])):
+                if fnmatch.fnmatchcase(modalias, glob):
+                    expected[key] = value
+            self.assertEqual(hwdb.lookup(modalias), expected, modalias)
+
+    def test_open(self):
+        '''Hwdb.open()'''
+
+        missing = os.path.join(self.workdir, 'missing.bin')
+        broken = os.path.join(self.workdir, 'broken.bin')
+        with open(broken, 'wb') as f:
+            f.write(b'KSLPHHRH' + b'\0' * 20)
+        empty = os.path.join(self.workdir, 'empty.bin')
+        open(empty, 'w').close()
+
+        self.assertIsNone(UbuntuDrivers.hwdb.Hwdb.open([missing, broken, empty]))
+        self.assertEqual(UbuntuDrivers.hwdb.Hwdb.open([missing, broken, self.hwdb_path]).path, self.hwdb_path)
+        with patch.dict(os.environ, {'SYSTEMD_HWDB_BIN': self.hwdb_path}):
+            self.assertEqual(UbuntuDrivers.hwdb.Hwdb.open().path, self.hwdb_path)
+
+    def test_get_db_names(self):
+        '''_get_db_names() uses hwdb.bin'''
+
+        devices = [('/sys/devices/graphics', modalias_nv), ('/sys/devices/graphics_2', modalias_nv_2),
+                   ('/sys/devices/grey', 'pci:vDEADBEEFd00')]
+        with patch.dict(os.environ, {'SYSTEMD_HWDB_BIN': self.hwdb_path}):
+            with patch('subprocess.check_output') as udevadm:
+                names = UbuntuDrivers.detect._get_db_names(devices)
+                # cached
+                self.assertEqual(UbuntuDrivers.detect._get_db_name('/sys/devices/graphics', modalias_nv),
+                                 ('NVIDIA Corporation', 'GeForce 8400 GS Rev. 3'))
+            self.assertEqual(udevadm.call_count, 0)
+        self.assertEqual(names, {
+            modalias_nv: ('NVIDIA Corporation', 'GeForce 8400 GS Rev. 3'),
+            modalias_nv_2: ('NVIDIA Corporation', 'question mark'),
+            'pci:vDEADBEEFd00': (None, None)})
+
+    def test_get_db_names_cache(self):
+        '''_get_db_names() looks up every modalias only once'''
+
+        devices = [('/sys/devices/graphics', modalias_nv), ('/sys/devices/graphics_2', modalias_nv_2),
+                   ('/sys/devices/graphics_3', modalias_nv)]
+        cache_file = os.path.join(os.environ['UBUNTU_DRIVERS_CACHE_DIR'], 'device-names.json')
+        lookup = UbuntuDrivers.hwdb.Hwdb.lookup
+        with patch.dict(os.environ, {'SYSTEMD_HWDB_BIN': self.hwdb_path}):
+            with patch('UbuntuDrivers.hwdb.Hwdb.lookup', autospec=True, side_effect=lookup) as mock_lookup:
+                names = UbuntuDrivers.detect._get_db_names(devices)
+                UbuntuDrivers.detect._get_db_names(devices)
+                self.assertEqual(UbuntuDrivers.detect._get_db_name('/sys/devices/other', modalias_nv),
+                                 names[modalias_nv])
+                self.assertEqual(mock_lookup.call_count, 2)
+                self.assertTrue(os.path.exists(cache_file))
+
+                # next run uses the persistent cache
+                self.reset_memo()
+                self.assertEqual(UbuntuDrivers.detect._get_db_names(devices), names)
+                self.assertEqual(mock_lookup.call_count, 2)
+
+                # until hwdb.bin changes
+                self.reset_memo()
+                st = os.stat(self.hwdb_path)
+                os.utime(self.hwdb_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+                self.assertEqual(UbuntuDrivers.detect._get_db_names(devices), names)
+                self.assertEqual(mock_lookup.call_count, 4)
+
+                # broken cache file
+                self.reset_memo()
+                with open(cache_file, 'w') as f:
+                    f.write('{"format": 1, "key": [], "names": {"')
+                self.assertEqual(UbuntuDrivers.detect._get_db_names(devices), names)
+                self.assertEqual(mock_lookup.call_count, 6)
+
+    def test_get_db_names_fallback(self):
+        '''_get_db_names() without hwdb.bin'''
+
+        # a device that udev knows about
+        sys_dir = os.path.join(self.workdir, 'sys')
+        known = os.path.join(sys_dir, 'devices', 'pci0000:00', '0000:00:02.0')
+        os.makedirs(known)
+        os.makedirs(os.path.join(sys_dir, 'bus', 'pci'))
+        os.symlink(os.path.join(sys_dir, 'bus', 'pci'), os.path.join(known, 'subsystem'))
+        data_dir = os.path.join(self.workdir, 'data')
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, '+pci:0000:00:02.0'), 'w') as f:
+            f.write('I:1234\nE:ID_PCI_CLASS_FROM_DATABASE=Display controller\n'
+                    'E:ID_VENDOR_FROM_DATABASE=Intel Corporation\nE:ID_MODEL_FROM_DATABASE=HD Graphics\n')
+
+        export_db = '''P: /devices/pci0000:00/0000:01:00.0
+E: DEVPATH=/devices/pci0000:00/0000:01:00.0
+E: ID_VENDOR_FROM_DATABASE=NVIDIA Corporation
+E: ID_MODEL_FROM_DATABASE=GT218
+
+P: /devices/pci0000:00/0000:02:00.0
+E: ID_VENDOR_FROM_DATABASE=Other
+
+'''
+        devices = [(known, 'pci:v00008086d00000412sv00sd00bc03sc00i00'),
+                   ('/sys/devices/pci0000:00/0000:01:00.0', modalias_nv),
+                   ('/sys/devices/pci0000:00/0000:03:00.0', 'pci:vDEADBEEFd00')]
+        with patch.dict(os.environ, {'SYSTEMD_HWDB_BIN': os.path.join(self.workdir, 'missing.bin')}):
+            with patch('UbuntuDrivers.hwdb.default_udev_data_dir', data_dir):
+                with patch('subprocess.check_output', return_value=export_db) as udevadm:
+                    names = UbuntuDrivers.detect._get_db_names(devices)
+                    UbuntuDrivers.detect._get_db_names(devices)
+        # one call for all unknown devices
+        self.assertEqual(udevadm.call_count, 1)
+        self.assertEqual(names, {
+            'pci:v00008086d00000412sv00sd00bc03sc00i00': ('Intel Corporation', 'HD Graphics'),
+            modalias_nv: ('NVIDIA Corporation', 'GT218'),
+            'pci:vDEADBEEFd00': (None, None)})
+        # names from udev are not kept
+        self.assertFalse(os.path.exists(os.path.join(os.environ['UBUNTU_DRIVERS_CACHE_DIR'], 'device-names.json')))
+
+    def test_get_db_names_fallback_udev_properties(self):
+        '''_get_db_names() without hwdb.bin ignores udev properties which are not names'''
+
+        sys_dir = os.path.join(self.workdir, 'sys')
+        wifi = os.path.join(sys_dir, 'devices', 'pci0000:00', '0000:00:14.0', 'usb1', '1-2')
+        os.makedirs(wifi)
+        os.makedirs(os.path.join(sys_dir, 'bus', 'usb'))
+        os.symlink(os.path.join(sys_dir, 'bus', 'usb'), os.path.join(wifi, 'subsystem'))
+        with open(os.path.join(wifi, 'dev'), 'w') as f:
+            f.write('189:2\n')
+        data_dir = os.path.join(self.workdir, 'data')
+        os.mkdir(data_dir)
+        with open(os.path.join(data_dir, 'c189:2'), 'w') as f:
+            f.write('''I:5284017
+E:ID_VENDOR=Realtek
+E:ID_VENDOR_ENC=Realtek
+E:ID_VENDOR_ID=0bda
+E:ID_MODEL=802.11n_WLAN_Adapter
+E:ID_MODEL_ENC=802.11n\\x20WLAN\\x20Adapter
+E:ID_MODEL_ID=8179
+E:ID_REVISION=0000
+E:ID_SERIAL=Realtek_802.11n_WLAN_Adapter_00e04c000001
+E:ID_BUS=usb
+E:ID_USB_INTERFACES=:ff0000:
+E:ID_VENDOR_FROM_DATABASE=Realtek Semiconductor Corp.
+E:ID_MODEL_FROM_DATABASE=RTL8188EUS 802.11n Wireless Network Adapter
+E:ID_PATH=pci-0000:00:14.0-usb-0:2
+G:seat
+''')
+
+        # a device which is only in "udevadm info --export-db", without names
+        export_db = '''P: /devices/pci0000:00/0000:00:14.0/usb1/1-3
+E: DEVPATH=/devices/pci0000:00/0000:00:14.0/usb1/1-3
+E: ID_VENDOR=046d
+E: ID_VENDOR_ENC=046d
+E: ID_VENDOR_ID=046d
+E: ID_MODEL=USB_Receiver
+E: ID_MODEL_ID=c52b
+
+'''
+        devices = [(wifi, 'usb:v0BDAp8179d0000dc00dsc00dp00icFFiscFFipFFin00'),
+                   ('/sys/devices/pci0000:00/0000:00:14.0/usb1/1-3',
+                    'usb:v046DpC52Bd1211dc00dsc00dp00ic03isc01ip01in00')]
+        with patch.dict(os.environ, {'SYSTEMD_HWDB_BIN': os.path.join(self.workdir, 'missing.bin')}):
+            with patch('UbuntuDrivers.hwdb.default_udev_data_dir', data_dir):
+                with patch('subprocess.check_output', return_value=export_db):
+                    names = UbuntuDrivers.detect._get_db_names(devices)
+        self.assertEqual(names, {
+            'usb:v0BDAp8179d0000dc00dsc00dp00icFFiscFFipFFin00':
+                ('Realtek Semiconductor Corp.', 'RTL8188EUS 802.11n Wireless Network Adapter'),
+            'usb:v046DpC52Bd1211dc00dsc00dp00ic03isc01ip01in00': (None, None)})
+
+
+class ModuleIndexTest(unittest.TestCase):
+    '''Test UbuntuDrivers.moduleindex'''
+
+    def setUp(self):
+        self.modules_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.modules_dir)
+        with open(os.path.join(self.modules_dir, 'modules.dep'), 'w') as f:
+            f.write('''kernel/drivers/gpu/drm/nouveau/nouveau.ko.zst: kernel/drivers/gpu/drm/drm.ko.zst
+kernel/drivers/gpu/drm/drm.ko.zst:
+updates/dkms/nvidia.ko: kernel/drivers/gpu/drm/drm.ko.zst
+kernel/drivers/net/wireless/broadcom/b43/b43-legacy.ko:
+''')
+        with open(os.path.join(self.modules_dir, 'modules.builtin'), 'w') as f:
+            f.write('kernel/drivers/video/fbdev/core/fb.ko\nkernel/fs/ext4/ext4.ko\n')
+        with open(os.path.join(self.modules_dir, 'modules.alias'), 'w') as f:
+            f.write('''# Aliases extracted from modules themselves.
+alias pci:v000010DEd*sv*sd*bc03sc*i* nouveau
+alias fs-ext4 ext4
+alias char-major-195-* nvidia
+''')
+
+    def test_index(self):
+        '''ModuleIndex'''
+
+        index = UbuntuDrivers.moduleindex.ModuleIndex(self.modules_dir)
+        self.assertEqual(index.modules, set(['nouveau', 'drm', 'nvidia', 'b43_legacy', 'fb', 'ext4']))
+        for name in ('nouveau', 'nvidia', 'b43-legacy', 'b43_legacy', 'fb', 'fs-ext4'):
+            self.assertIn(name, index)
+        for name in ('wl', 'fglrx', 'nvidia.ko', 'char-major-195-1', 'pci:v000010DEd*sv*sd*bc03sc*i*'):
+            self.assertNotIn(name, index)
+
+        # aliases are only read when needed
+        index = UbuntuDrivers.moduleindex.ModuleIndex(self.modules_dir)
+        self.assertIn('nvidia', index)
+        self.assertIsNone(index._aliases)
+
+    def test_index_missing(self):
+        '''ModuleIndex for a kernel without modules'''
+
+        index = UbuntuDrivers.moduleindex.ModuleIndex(os.path.join(self.modules_dir, 'nonexisting'))
+        self.assertEqual(index.modules, set())
+        self.assertNotIn('nvidia', index)
+
+    def test_kernel_module_index(self):
+        '''_kernel_module_index() for $UBUNTU_DRIVERS_MODULES_DIR'''
+
+        self.addCleanup(setattr, UbuntuDrivers.detect._kernel_module_index, 'memo', {})
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_MODULES_DIR': self.modules_dir}):
+            index = UbuntuDrivers.detect._kernel_module_index()
+            self.assertEqual(index.modules_dir, self.modules_dir)
+            self.assertIs(UbuntuDrivers.detect._kernel_module_index(), index)
+            self.assertIn('nvidia', index)
+
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_MODULES_DIR': ''}):
+            self.assertEqual(UbuntuDrivers.detect._kernel_module_index().modules_dir,
+                             '/lib/modules/' + os.uname().release)
+
+
+class CacheFileTest(unittest.TestCase):
+    '''Test UbuntuDrivers.cachefile'''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'cache', 'test.json')
+
+    def test_atomic_write(self):
+        '''atomic_write() and read_cache()'''
+
+        self.assertIsNone(UbuntuDrivers.cachefile.read_cache(self.path))
+        self.assertTrue(UbuntuDrivers.cachefile.atomic_write(self.path, b'\x00\x01', 'wb'))
+        self.assertEqual(UbuntuDrivers.cachefile.read_cache(self.path, 'rb'), b'\x00\x01')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+        self.assertTrue(UbuntuDrivers.cachefile.atomic_write(self.path, 'new'))
+        self.assertEqual(UbuntuDrivers.cachefile.read_cache(self.path), 'new')
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['test.json'])
+
+        # a bad data type does not leave a broken file
+        self.assertFalse(UbuntuDrivers.cachefile.atomic_write(self.path, 'text', 'wb'))
+        self.assertEqual(UbuntuDrivers.cachefile.read_cache(self.path), 'new')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), ['test.json'])
+
+    def test_atomic_write_unwritable(self):
+        '''atomic_write() silently fails on unwritable directories'''
+
+        with open(os.path.join(self.workdir, 'cache'), 'w'):
+            pass
+        self.assertFalse(UbuntuDrivers.cachefile.atomic_write(self.path, 'data'))
+        self.assertIsNone(UbuntuDrivers.cachefile.read_cache(self.path))
+
+    def test_json_cache(self):
+        '''save_json_cache() and load_json_cache()'''
+
+        self.assertIsNone(UbuntuDrivers.cachefile.load_json_cache(self.path))
+        self.assertTrue(UbuntuDrivers.cachefile.save_json_cache(self.path, {'key': [1, 'a']}))
+        self.assertEqual(UbuntuDrivers.cachefile.load_json_cache(self.path), {'key': [1, 'a']})
+        self.assertFalse(UbuntuDrivers.cachefile.save_json_cache(self.path, {'key': object()}))
+        self.assertEqual(UbuntuDrivers.cachefile.load_json_cache(self.path), {'key': [1, 'a']})
+
+        with open(self.path, 'w') as f:
+            f.write('{"key": [')
+        self.assertIsNone(UbuntuDrivers.cachefile.load_json_cache(self.path))
+
+
+class PluginLoaderTest(unittest.TestCase):
+    '''Test UbuntuDrivers.plugins'''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'special.py')
+        self.cache_dir = os.path.join(self.workdir, 'cache')
+
+    def write(self, code, age=10):
+        '''Write the plugin with an mtime age seconds in the past'''
+
+        with open(self.path, 'w') as f:
+            f.write(code)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def test_load(self):
+        '''PluginLoader.load() reuses plugins until they change'''
+
+        self.write('calls = []\ndef detect(apt):\n    calls.append(apt)\n    return ["special"]\n')
+        loader = UbuntuDrivers.plugins.PluginLoader()
+        plugin = loader.load(self.path)
+        self.assertEqual(plugin.name, 'special.py')
+        self.assertEqual(plugin.detect(None), ['special'])
+        self.assertEqual(plugin.detect(None), ['special'])
+        self.assertIs(loader.load(self.path), plugin)
+        self.assertEqual(plugin.namespace['calls'], [None, None])
+
+        self.write('def detect(apt):\n    return ["special2"]\n', age=5)
+        plugin2 = loader.load(self.path)
+        self.assertIsNot(plugin2, plugin)
+        self.assertEqual(plugin2.detect(None), ['special2'])
+
+        # a plugin which just changed is not kept, as it might change again
+        # without a different mtime
+        self.write('def detect(apt):\n    return ["special3"]\n', age=0)
+        plugin3 = loader.load(self.path)
+        self.assertEqual(plugin3.detect(None), ['special3'])
+        self.assertIsNot(loader.load(self.path), plugin3)
+
+        self.write('def detect(apt):\n    syntax error\n')
+        self.assertRaises(SyntaxError, loader.load, self.path)
+        self.assertRaises(FileNotFoundError, loader.load, os.path.join(self.workdir, 'nonexisting.py'))
+
+    def test_code_cache(self):
+        '''PluginLoader.load() keeps the compiled code in cache_dir'''
+
+        self.write('def detect(apt):\n    return ["special"]\n')
+        UbuntuDrivers.plugins.PluginLoader().load(self.path, self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        with patch('UbuntuDrivers.plugins.compile', create=True) as mock_compile:
+            plugin = UbuntuDrivers.plugins.PluginLoader().load(self.path, self.cache_dir)
+            self.assertEqual(mock_compile.call_count, 0)
+        self.assertEqual(plugin.detect(None), ['special'])
+
+        # changed plugin
+        self.write('def detect(apt):\n    return ["special2"]\n', age=5)
+        plugin = UbuntuDrivers.plugins.PluginLoader().load(self.path, self.cache_dir)
+        self.assertEqual(plugin.detect(None), ['special2'])
+
+        # code cache of a different Python version
+        code_path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(code_path, 'r+b') as f:
+            f.write(b'\0\0\0\0')
+        with patch('UbuntuDrivers.plugins.compile', create=True, wraps=compile) as mock_compile:
+            plugin = UbuntuDrivers.plugins.PluginLoader().load(self.path, self.cache_dir)
+            self.assertEqual(mock_compile.call_count, 1)
+        self.assertEqual(plugin.detect(None), ['special2'])
+
+        # a plugin of the same name in another directory
+        other = os.path.join(self.workdir, 'other')
+        os.mkdir(other)
+        with open(os.path.join(other, 'special.py'), 'w') as f:
+            f.write('def detect(apt):\n    return ["other"]\n')
+        os.utime(os.path.join(other, 'special.py'), (time.time() - 10, time.time() - 10))
+        plugin = UbuntuDrivers.plugins.PluginLoader().load(os.path.join(other, 'special.py'), self.cache_dir)
+        self.assertEqual(plugin.detect(None), ['other'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_run_plugins(self):
+        '''run_plugins()'''
+
+        plugins = {'a.py': 'import time\ndef detect(apt):\n    time.sleep(0.5)\n    return [apt]\n',
+                   'b.py': 'import time\ndef detect(apt):\n    time.sleep(0.5)\n    return [apt, 1]\n',
+                   'c.py': 'def detect(apt):\n    raise KeyError("c")\n',
+                   'd.py': 'import time\ndef detect(apt):\n    time.sleep(10)\n'}
+        for name, code in plugins.items():
+            with open(os.path.join(self.workdir, name), 'w') as f:
+                f.write(code)
+
+        paths = [os.path.join(self.workdir, name) for name in ('d.py', 'c.py', 'b.py', 'a.py')]
+        logging.getLogger().setLevel(logging.CRITICAL)
+        self.addCleanup(logging.getLogger().setLevel, logging.INFO)
+        start = time.time()
+        runs = UbuntuDrivers.plugins.run_plugins(UbuntuDrivers.plugins.PluginLoader(), paths, 'apt', 1.5)
+        # does not wait for d.py
+        self.assertLess(time.time() - start, 8)
+
+        self.assertEqual([run.name for run in runs], ['d.py', 'c.py', 'b.py', 'a.py'])
+        self.assertEqual([run.status for run in runs], ['timeout', 'failed', 'ok', 'ok'])
+        self.assertEqual([run.result for run in runs], [None, None, ['apt', 1], ['apt']])
+        self.assertIsInstance(runs[1].error, KeyError)
+        self.assertGreaterEqual(runs[0].seconds, 1.5)
+        self.assertGreaterEqual(runs[2].seconds, 0.5)
+
+    def test_run_plugins_check(self):
+        '''run_plugins() skips plugins which check() rejects'''
+
+        for name in ('a.py', 'b.py'):
+            with open(os.path.join(self.workdir, name), 'w') as f:
+                f.write('requires = {"name": ["%s"]}\ndef detect(apt):\n    return ["%s"]\n' % (name, name))
+
+        def check(plugin):
+            self.assertEqual(plugin.requires, {'name': [plugin.name]})
+            return plugin.name == 'b.py' and 'no b today' or None
+
+        runs = UbuntuDrivers.plugins.run_plugins(
+            UbuntuDrivers.plugins.PluginLoader(),
+            [os.path.join(self.workdir, name) for name in ('a.py', 'b.py')], None, 5, check=check)
+        self.assertEqual([(run.status, run.result, run.reason) for run in runs],
+                         [('ok', ['a.py'], None), ('skipped', None, 'no b today')])
+
+    def test_run_plugins_results(self):
+        '''run_plugins() reuses results of plugins with unchanged inputs'''
+
+        input_path = os.path.join(self.workdir, 'board')
+        with open(input_path, 'w') as f:
+            f.write('one')
+        self.write('inputs = [%r]\ncalls = []\n'
+                   'def detect(apt):\n    calls.append(apt)\n'
+                   '    with open(inputs[0]) as f:\n        return {f.read()}\n' % input_path)
+        noinputs = os.path.join(self.workdir, 'noinputs.py')
+        with open(noinputs, 'w') as f:
+            f.write('def detect(apt):\n    return ["noinputs"]\n')
+        os.utime(noinputs, (time.time() - 10, time.time() - 10))
+        results_path = os.path.join(self.cache_dir, 'plugin-results.json')
+        loader = UbuntuDrivers.plugins.PluginLoader()
+
+        def run(generation='gen1'):
+            results = UbuntuDrivers.plugins.PluginResultCache(results_path, generation)
+            runs = UbuntuDrivers.plugins.run_plugins(loader, [self.path, noinputs], None, 5, results=results)
+            return [(r.status, r.result, r.cached) for r in runs]
+
+        self.assertEqual(run(), [('ok', {'one'}, False), ('ok', ['noinputs'], False)])
+        self.assertTrue(os.path.exists(results_path))
+        # the result comes from the file, the plugin is not called again
+        self.assertEqual(run(), [('ok', ['one'], True), ('ok', ['noinputs'], False)])
+        calls = loader.load(self.path).namespace['calls']
+        self.assertEqual(len(calls), 1)
+
+        # changed input
+        with open(input_path, 'w') as f:
+            f.write('two')
+        self.assertEqual(run(), [('ok', {'two'}, False), ('ok', ['noinputs'], False)])
+        self.assertEqual(run(), [('ok', ['two'], True), ('ok', ['noinputs'], False)])
+
+        # changed apt cache
+        self.assertEqual(run('gen2'), [('ok', {'two'}, False), ('ok', ['noinputs'], False)])
+
+        # changed plugin
+        self.write('inputs = [%r]\ndef detect(apt):\n    return None\n' % input_path, age=5)
+        self.assertEqual(run('gen2'), [('ok', None, False), ('ok', ['noinputs'], False)])
+        self.assertEqual(run('gen2'), [('ok', None, True), ('ok', ['noinputs'], False)])
+
+        # a just changed plugin is not cached
+        self.write('inputs = [%r]\ndef detect(apt):\n    return ["racy"]\n' % input_path, age=0)
+        self.assertEqual(run('gen2'), [('ok', ['racy'], False), ('ok', ['noinputs'], False)])
+        self.assertEqual(run('gen2'), [('ok', ['racy'], False), ('ok', ['noinputs'], False)])
+
+    def test_result_cache_invalid(self):
+        '''PluginResultCache ignores broken files and does not cache bad results'''
+
+        os.mkdir(self.cache_dir)
+        results_path = os.path.join(self.cache_dir, 'plugin-results.json')
+        with open(results_path, 'w') as f:
+            f.write('{"format": 1, "plugins": [')
+        self.write('inputs = ["/nonexisting"]\ndef detect(apt):\n    return "special"\n')
+        results = UbuntuDrivers.plugins.PluginResultCache(results_path, 'gen')
+        runs = UbuntuDrivers.plugins.run_plugins(UbuntuDrivers.plugins.PluginLoader(), [self.path], None, 5,
+                                                 results=results)
+        self.assertEqual([(r.status, r.result, r.cached) for r in runs], [('ok', 'special', False)])
+        key = results.key(UbuntuDrivers.plugins.PluginLoader().load(self.path),
+                          UbuntuDrivers.plugins.PluginLoader.file_key(self.path))
+        self.assertEqual(key[2], [['/nonexisting', None]])
+        self.assertRaises(KeyError, results.get, self.path, key)
+
+        self.write('inputs = "/proc/cpuinfo"\ndef detect(apt):\n    return ["special"]\n', age=5)
+        runs = UbuntuDrivers.plugins.run_plugins(UbuntuDrivers.plugins.PluginLoader(), [self.path], None, 5,
+                                                 results=results)
+        self.assertEqual(runs[0].status, 'failed')
+        self.assertIsInstance(runs[0].error, TypeError)
+
+    def test_plugin_timeout(self):
+        '''get_plugin_timeout()'''
+
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_PLUGIN_TIMEOUT': '2.5'}):
+            self.assertEqual(UbuntuDrivers.detect.get_plugin_timeout(), 2.5)
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_PLUGIN_TIMEOUT': 'soon'}):
+            self.assertEqual(UbuntuDrivers.detect.get_plugin_timeout(),
+                             UbuntuDrivers.detect.default_plugin_timeout)
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_PLUGIN_TIMEOUT': ''}):
+            self.assertEqual(UbuntuDrivers.detect.get_plugin_timeout(),
+                             UbuntuDrivers.detect.default_plugin_timeout)
+
+    def test_code_cache_unwritable(self):
+        '''PluginLoader.load() works without a writable cache_dir'''
+
+        self.write('def detect(apt):\n    return ["special"]\n')
+        with open(self.cache_dir, 'w'):
+            pass
+        plugin = UbuntuDrivers.plugins.PluginLoader().load(self.path, self.cache_dir)
+        self.assertEqual(plugin.detect(None), ['special'])
+
+
+class SupportedGpusTest(unittest.TestCase):
+    '''Test UbuntuDrivers.supportedgpus'''
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        self.path = os.path.join(self.workdir, 'custom_supported_gpus.json')
+        self.sidecar = os.path.join(self.workdir, 'cache', 'supported-gpus.marshal')
+        self.write('510')
+        self.addCleanup(setattr, UbuntuDrivers.detect.supported_gpus, 'memo', {})
+
+    def write(self, branch, age=10):
+        '''Write the supported GPUs list with an mtime age seconds in the past'''
+
+        with open(self.path, 'w') as f:
+            f.write('''{
+ "chips": [
+   {"devid": "0x10C3", "name": "TEST 10C3", "branch": "%s.47.03", "features": ["runtimepm"]},
+   {"devid": "0x25BA", "name": "TEST 25BA", "branch": "580.1234"},
+   {"devid": "0x25BA", "name": "TEST 25BA (2)", "branch": "575", "features": ["runtimepm"]},
+   {"name": "no device ID", "branch": "390"}
+ ]
+}''' % branch)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def test_index(self):
+        '''SupportedGpus lookups'''
+
+        index = UbuntuDrivers.supportedgpus.SupportedGpus.load(
+            self.path, UbuntuDrivers.supportedgpus.SupportedGpus.file_key(self.path))
+        self.assertEqual(index.branch('0x10C3'), ('TEST 10C3', '510'))
+        self.assertEqual(index.branch('0x25BA'), ('TEST 25BA', '580'))
+        self.assertEqual(index.branch('0x25ba'), None)
+        self.assertEqual(index.branch('0x1234'), None)
+        self.assertEqual(index.runtimepm_branch('0x10C3'), '510')
+        self.assertEqual(index.runtimepm_branch('0x25BA'), '575')
+        self.assertEqual(index.runtimepm_branch('0x1234'), None)
+
+    def test_invalid(self):
+        '''SupportedGpus for missing and invalid files'''
+
+        SupportedGpus = UbuntuDrivers.supportedgpus.SupportedGpus
+        self.assertIsNone(SupportedGpus.file_key(os.path.join(self.workdir, 'nonexisting')))
+        with open(self.path, 'w') as f:
+            f.write('{"chips": [ # comment\n]}')
+        self.assertIsNone(SupportedGpus.load(self.path, SupportedGpus.file_key(self.path), self.sidecar))
+        self.assertFalse(os.path.exists(self.sidecar))
+
+    def test_sidecar(self):
+        '''SupportedGpus sidecar is used while the list is unchanged'''
+
+        SupportedGpus = UbuntuDrivers.supportedgpus.SupportedGpus
+        key = SupportedGpus.file_key(self.path)
+        index = SupportedGpus.load(self.path, key, self.sidecar)
+        self.assertTrue(os.path.exists(self.sidecar))
+
+        with patch('json.load') as mock_load:
+            cached = SupportedGpus.load(self.path, key, self.sidecar)
+            self.assertFalse(mock_load.called)
+        self.assertEqual(cached.chips, index.chips)
+
+        # changed list
+        self.write('470', age=5)
+        key = SupportedGpus.file_key(self.path)
+        self.assertEqual(SupportedGpus.load(self.path, key, self.sidecar).branch('0x10C3'), ('TEST 10C3', '470'))
+        self.assertEqual(SupportedGpus.load(self.path, key, None).branch('0x10C3'), ('TEST 10C3', '470'))
+
+        # a list which just changed is not written, as it might change again
+        # without a different mtime
+        self.write('390', age=0)
+        key = SupportedGpus.file_key(self.path)
+        self.assertFalse(SupportedGpus.is_stable(key))
+        os.unlink(self.sidecar)
+        self.assertEqual(SupportedGpus.load(self.path, key, self.sidecar).branch('0x10C3'), ('TEST 10C3', '390'))
+        self.assertFalse(os.path.exists(self.sidecar))
+
+    @patch('UbuntuDrivers.detect.path_get_custom_supported_gpus')
+    def test_supported_gpus(self, mocked_pgcsg):
+        '''supported_gpus() and its callers'''
+
+        mocked_pgcsg.return_value = self.path
+        with patch.dict(os.environ, {'UBUNTU_DRIVERS_CACHE_DIR': os.path.join(self.workdir, 'cache')}):
+            index = UbuntuDrivers.detect.supported_gpus()
+            self.assertIs(UbuntuDrivers.detect.supported_gpus(), index)
+            self.assertTrue(os.path.exists(self.sidecar))
+
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x10C3'), '510')
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x1234'), None)
+            alias = 'pci:v000010DEd000010C3sv0000103Csd000089C6bc03sc00i00'
+            self.assertTrue(UbuntuDrivers.detect._is_nv_allowing_runtimepm_supported(alias, '510'))
+            self.assertFalse(UbuntuDrivers.detect._is_nv_allowing_runtimepm_supported(alias, '470'))
+
+            # the list changes
+            self.write('470', age=5)
+            self.assertIsNot(UbuntuDrivers.detect.supported_gpus(), index)
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x10C3'), '470')
+            self.assertTrue(UbuntuDrivers.detect._is_nv_allowing_runtimepm_supported(alias, '470'))
+
+            # ... very quickly, with the same size and mtime
+            self.write('390', age=0)
+            mtime = os.stat(self.path).st_mtime_ns
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x10C3'), '390')
+            self.write('418', age=0)
+            os.utime(self.path, ns=(mtime, mtime))
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x10C3'), '418')
+
+            os.unlink(self.path)
+            self.assertIsNone(UbuntuDrivers.detect.supported_gpus())
+            self.assertEqual(UbuntuDrivers.detect.package_get_nv_allowing_driver('0x10C3'), None)
+            self.assertFalse(UbuntuDrivers.detect._is_nv_allowing_runtimepm_supported(alias, '470'))
+
 
 class KernelDectionTest(unittest.TestCase):
     '''Test UbuntuDrivers.kerneldetection'''
@@ -4121,6 +6005,60 @@ class KernelDectionTest(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.plugin_dir)
 
+    def test_linux_image_detection_performance(self):
+        '''get_linux_image_metapackage() performance for many installed kernels'''
+
+        class FakePackage(object):
+            def __init__(self, name, installed):
+                self.name = name
+                self.current_ver = installed
+                self.rev_depends_list = []
+
+        class FakeCache(object):
+            def __init__(self, packages):
+                self.packages = packages
+
+            def __getitem__(self, name):
+                for p in self.packages:
+                    if p.name == name:
+                        return p
+                raise KeyError(name)
+
+        class FakeDepCache(object):
+            def marked_install(self, pkg):
+                return False
+
+        # for apt_pkg.version_compare()
+        apt_pkg.init_config()
+        apt_pkg.init_system()
+
+        if 'arm' in os.uname().machine:
+            target = 3.0
+        elif 'i386' == get_deb_arch():
+            target = 1.5
+        else:
+            target = 1.0
+
+        for count in (10, 100, 1000):
+            packages = [FakePackage('linux-image-4.15.0-%i-generic' % i, True) for i in range(count)]
+            # version ordering, not string ordering
+            packages.append(FakePackage('linux-image-5.10.0-9-generic', True))
+            packages.append(FakePackage('linux-image-5.9.0-99-generic', True))
+            # not installed
+            packages.append(FakePackage('linux-image-6.0.0-1-generic', None))
+            packages += [FakePackage('pkg%i' % i, True) for i in range(count)]
+
+            kernel_detection = UbuntuDrivers.kerneldetection.KernelDetection(FakeCache(packages), FakeDepCache())
+            start = time.time()
+            with patch.object(kernel_detection, '_is_greater_than',
+                              wraps=kernel_detection._is_greater_than) as mock_compare:
+                self.assertEqual(kernel_detection.get_linux_image_metapackage(), '')
+            sec = time.time() - start
+            sys.stderr.write('[%i kernels: %.3f s] ' % (count, sec))
+            self.assertEqual(mock_compare.call_count, count + 2)
+            self.assertEqual(mock_compare.call_args_list[-1][0], ('5.9.0-99', '5.10.0-9'))
+            self.assertLess(sec, target)
+
     def test_linux_headers_detection_chroot(self):
         '''get_linux_headers_metapackage() for test package repository'''
         chroot = aptdaemon.test.Chroot()